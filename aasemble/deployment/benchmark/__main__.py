@@ -0,0 +1,3 @@
+from aasemble.deployment.benchmark.runner import main
+
+main()
@@ -0,0 +1,276 @@
+import argparse
+import json
+import logging
+import math
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+from aasemble.deployment import exceptions, loader
+from aasemble.deployment.benchmark.simulated import DEFAULT_PAGE_SIZE, SimulatedCloud, SimulatedDriver
+from aasemble.deployment.cloud.limiter import AdaptiveLimiter
+from aasemble.deployment.cloud.retry import RetryPolicy
+from aasemble.deployment.snapshot import fingerprint
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SCALES = (10, 1000, 10000)
+SCENARIOS = ('load', 'apply', 'detect', 'clean')
+
+wall_time = getattr(time, 'perf_counter', time.time)
+
+
+def percentile(samples, q):
+    # Nearest rank, so it is always one of the samples.
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[max(0, int(math.ceil(q * len(samples))) - 1)]
+
+
+def stack_data(nodes):
+    # Two tiers, so the stack has security groups that refer to each other
+    # and more than one node spec to batch by.
+    web = max(1, nodes // 2)
+    data = {'security_groups': {'web': [{'cidr': '0.0.0.0/0', 'from_port': 443, 'to_port': 443, 'protocol': 'tcp'},
+                                        {'cidr': '0.0.0.0/0', 'from_port': 80, 'to_port': 80, 'protocol': 'tcp'}],
+                                'app': [{'source_group': 'web', 'from_port': 8000, 'to_port': 8080, 'protocol': 'tcp'}]},
+            'nodes': {'web': {'count': web, 'flavor': 'small', 'image': 'trusty', 'disk': 10, 'security_groups': ['web']}}}
+    if nodes > web:
+        data['nodes']['app'] = {'count': nodes - web, 'flavor': 'large', 'image': 'trusty', 'disk': 50,
+                                'security_groups': ['app']}
+    return data
+
+
+def write_stack(directory, nodes):
+    path = os.path.join(directory, 'stack-%d.yaml' % (nodes,))
+    with open(path, 'w') as fp:
+        yaml.safe_dump(stack_data(nodes), fp)
+    return path
+
+
+class OperationTimings(object):
+    # Passed to the driver as its profiler, so every limited() call is
+    # timed, retries and backoff included.
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def task(self, operation):
+        return _Timed(self, operation)
+
+    def record(self, kind, seconds):
+        # Only whole operations are timed here, waits included.
+        pass
+
+    def instrument(self, driver):
+        return driver
+
+    def add(self, operation, duration):
+        with self.lock:
+            self.samples.setdefault(operation, []).append(duration)
+
+    def summary(self):
+        with self.lock:
+            return dict((operation, {'count': len(samples),
+                                     'p50': percentile(samples, 0.5),
+                                     'p99': percentile(samples, 0.99)})
+                        for operation, samples in self.samples.items())
+
+
+class _Timed(object):
+    def __init__(self, timings, operation):
+        self.timings = timings
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = wall_time()
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.operation, wall_time() - self.started)
+
+
+class Benchmark(object):
+    def __init__(self, options):
+        self.options = options
+
+    def cloud(self):
+        return SimulatedCloud(latency=self.options.latency,
+                              jitter=self.options.jitter,
+                              page_size=self.options.page_size,
+                              throttle_rate=self.options.throttle_rate,
+                              failure_rate=self.options.failure_rate,
+                              seed=self.options.seed)
+
+    def driver(self, cloud, timings):
+        if self.options.engine == 'asyncio':
+            from concurrent.futures import ThreadPoolExecutor
+            kwargs = {'engine': 'asyncio', 'executor': ThreadPoolExecutor(self.options.threads)}
+        else:
+            from multiprocessing.pool import ThreadPool
+            kwargs = {'pool': ThreadPool(self.options.threads)}
+
+        return SimulatedDriver(cloud=cloud,
+                               namespace='benchmark',
+                               limiter=AdaptiveLimiter(self.options.threads, backoff=self.options.backoff,
+                                                       max_backoff=self.options.backoff * 30),
+                               retry=RetryPolicy(backoff=self.options.backoff, max_backoff=self.options.backoff * 30),
+                               profiler=timings,
+                               **kwargs)
+
+    def run_once(self, path, measure_memory=False):
+        # One pass through every scenario against a fresh cloud. Returns
+        # {scenario: (seconds, peak bytes, failed, timings)}.
+        cloud = self.cloud()
+        state = {}
+        results = {}
+
+        def load():
+            state['stack'] = loader.load(path)
+
+        def apply():
+            state['driver'].apply_resources(state['stack'], fingerprint(state['stack']))
+
+        def detect():
+            state['detected'] = state['driver'].detect_resources()
+
+        def clean():
+            state['driver'].clean_resources(state['detected'])
+
+        for scenario, func in zip(SCENARIOS, (load, apply, detect, clean)):
+            timings = OperationTimings()
+            state['driver'] = self.driver(cloud, timings)
+            failed = 0
+
+            if measure_memory:
+                tracemalloc.start()
+            started = wall_time()
+            try:
+                func()
+            except exceptions.ResourcesFailedException as e:
+                failed = len(e.failures) + len(e.skipped)
+            duration = wall_time() - started
+            peak = None
+            if measure_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            if self.options.engine == 'asyncio':
+                state['driver'].executor.shutdown()
+            else:
+                state['driver'].pool.terminate()
+            results[scenario] = (duration, peak, failed, timings)
+
+        results['provider'] = {'requests': cloud.requests, 'throttled': cloud.throttled, 'failed': cloud.failed}
+        return results
+
+    def run_scale(self, path, nodes):
+        durations = dict((scenario, []) for scenario in SCENARIOS)
+        failures = dict((scenario, 0) for scenario in SCENARIOS)
+        timings = dict((scenario, OperationTimings()) for scenario in SCENARIOS)
+        provider = {'requests': 0, 'throttled': 0, 'failed': 0}
+
+        for _ in range(self.options.repeat):
+            results = self.run_once(path)
+            for scenario in SCENARIOS:
+                duration, _, failed, run_timings = results[scenario]
+                durations[scenario].append(duration)
+                failures[scenario] += failed
+                for operation, samples in run_timings.samples.items():
+                    for sample in samples:
+                        timings[scenario].add(operation, sample)
+            for key in provider:
+                provider[key] += results['provider'][key]
+
+        # Tracing allocations slows everything down, so memory gets a run
+        # of its own rather than skewing the timed ones.
+        peaks = {}
+        if self.options.memory and tracemalloc is not None:
+            results = self.run_once(path, measure_memory=True)
+            peaks = dict((scenario, results[scenario][1]) for scenario in SCENARIOS)
+
+        report = {'nodes': nodes, 'provider': provider, 'scenarios': {}}
+        for scenario in SCENARIOS:
+            p50 = percentile(durations[scenario], 0.5)
+            report['scenarios'][scenario] = {'runs': len(durations[scenario]),
+                                             'p50': p50,
+                                             'p99': percentile(durations[scenario], 0.99),
+                                             'throughput': p50 and nodes / p50,
+                                             'peak_memory': peaks.get(scenario),
+                                             'failed': failures[scenario],
+                                             'operations': timings[scenario].summary()}
+        return report
+
+    def run(self):
+        directory = tempfile.mkdtemp()
+        try:
+            return {'settings': dict((k, v) for k, v in vars(self.options).items() if k not in ('json',)),
+                    'results': [self.run_scale(write_stack(directory, nodes), nodes) for nodes in self.options.scales]}
+        finally:
+            shutil.rmtree(directory)
+
+
+def format_report(report):
+    lines = []
+    for result in report['results']:
+        provider = result['provider']
+        lines.append('%d nodes (%d requests, %d throttled, %d failed)' % (result['nodes'], provider['requests'],
+                                                                          provider['throttled'], provider['failed']))
+        for scenario in SCENARIOS:
+            info = result['scenarios'][scenario]
+            peak = info['peak_memory']
+            lines.append('  %-7s p50 %9.4fs  p99 %9.4fs  %10.1f nodes/s  peak %s%s' % (
+                scenario, info['p50'], info['p99'], info['throughput'] or 0,
+                peak is None and '-' or '%.1f MiB' % (peak / 1048576.0,),
+                info['failed'] and '  (%d failed)' % (info['failed'],) or ''))
+            for operation, timing in sorted(info['operations'].items()):
+                lines.append('    %-30s %7d calls  p50 %9.4fs  p99 %9.4fs' % (operation, timing['count'], timing['p50'], timing['p99']))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_scales(value):
+    return [int(scale) for scale in value.split(',')]
+
+
+def main(args=sys.argv[1:], out=sys.stdout):
+    parser = argparse.ArgumentParser(description='Benchmark loading, applying, detecting and cleaning stacks against a simulated provider')
+    parser.add_argument('--scales', type=parse_scales, default=list(DEFAULT_SCALES), metavar='N[,N...]',
+                        help='Stack sizes in nodes [default={}]'.format(','.join(str(scale) for scale in DEFAULT_SCALES)))
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stack size [default=3]')
+    parser.add_argument('--threads', type=int, default=10, help='Maximum number of concurrent provider calls [default=10]')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Execution engine for provider calls [default=threads]')
+    parser.add_argument('--latency', type=float, default=0.005, metavar='SECONDS',
+                        help='Mean latency of a provider request [default=0.005]')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='Latency varies by up to this fraction either way [default=0.5]')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='Nodes per page of the listing [default={}]'.format(DEFAULT_PAGE_SIZE))
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests throttled [default=0]')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of requests failing with a 503 [default=0]')
+    parser.add_argument('--backoff', type=float, default=0.01, metavar='SECONDS',
+                        help='Base retry backoff, scaled down from the real one to suit the simulated latency [default=0.01]')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the simulated latency, throttling and failures')
+    parser.add_argument('--no-memory', action='store_false', dest='memory',
+                        help='Skip the extra run that measures peak memory')
+    parser.add_argument('--json', metavar='PATH', help='Also write the report as JSON to this file')
+
+    options = parser.parse_args(args)
+    report = Benchmark(options).run()
+
+    out.write(format_report(report))
+    if options.json:
+        with open(options.json, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+    return report
@@ -0,0 +1,279 @@
+import itertools
+import random
+import threading
+import time
+
+from libcloud.common.exceptions import BaseHTTPError, RateLimitReachedError
+from libcloud.compute.base import Node as LibcloudNode
+from libcloud.compute.types import NodeState
+
+import aasemble.deployment.cloud.models as cloud_models
+from aasemble.deployment.cloud.base import CloudDriver
+
+DEFAULT_PAGE_SIZE = 500
+
+
+class SimulatedCloud(object):
+    # The provider side: state shared by every connection, and the latency,
+    # pagination, throttling and failures each request is subject to.
+    def __init__(self, latency=0.005, jitter=0.5, page_size=DEFAULT_PAGE_SIZE, throttle_rate=0.0, failure_rate=0.0,
+                 seed=None, sleep=time.sleep):
+        self.latency = latency
+        self.jitter = jitter
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.nodes = {}
+        self.security_groups = {}
+        self.client_tokens = {}
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def request(self, action, params=None, data=None, method='GET'):
+        with self.lock:
+            self.requests += 1
+            roll = self.random.random()
+            delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+
+        if delay > 0:
+            self.sleep(delay)
+
+        if roll < self.throttle_rate:
+            with self.lock:
+                self.throttled += 1
+            raise RateLimitReachedError()
+        if roll < self.throttle_rate + self.failure_rate:
+            with self.lock:
+                self.failed += 1
+            raise BaseHTTPError(503, 'ServiceUnavailable: simulated failure')
+
+        handler = getattr(self, '_%s_%s' % (method.lower(), action.strip('/').split('/')[0]))
+        with self.lock:
+            return handler(action, params or {}, data)
+
+    def _get_nodes(self, action, params, data):
+        nodes = sorted(self.nodes.values(), key=lambda node: node['id'])
+        if params.get('namespace') is not None:
+            nodes = [node for node in nodes if node['namespace'] == params['namespace']]
+        start = int(params.get('page') or 0)
+        end = start + self.page_size
+        return {'nodes': [dict(node) for node in nodes[start:end]],
+                'next': end if end < len(nodes) else None}
+
+    def _post_nodes(self, action, params, data):
+        token = data.get('client_token')
+        if token is not None and token in self.client_tokens:
+            return {'nodes': [dict(self.nodes[node_id]) for node_id in self.client_tokens[token] if node_id in self.nodes]}
+
+        created = []
+        for name in data['names']:
+            node_id = 'sim-%d' % (next(self.ids),)
+            self.nodes[node_id] = {'id': node_id,
+                                   'name': name,
+                                   'size': data['size'],
+                                   'image': data['image'],
+                                   'disk': data['disk'],
+                                   'security_groups': list(data.get('security_groups', [])),
+                                   'namespace': data.get('namespace'),
+                                   'public_ips': ['192.0.2.%d' % (len(self.nodes) % 250 + 1,)]}
+            created.append(node_id)
+
+        if token is not None:
+            self.client_tokens[token] = created
+        return {'nodes': [dict(self.nodes[node_id]) for node_id in created]}
+
+    def _delete_nodes(self, action, params, data):
+        self.nodes.pop(action.strip('/').split('/')[1], None)
+        return {}
+
+    def _get_security_groups(self, action, params, data):
+        return {'security_groups': dict((name, [dict(rule) for rule in rules])
+                                        for name, rules in self.security_groups.items())}
+
+    def _post_security_groups(self, action, params, data):
+        parts = action.strip('/').split('/')
+        if len(parts) == 1:
+            self.security_groups.setdefault(data['name'], [])
+        else:
+            rules = self.security_groups[parts[1]]
+            rules.extend(rule for rule in data['rules'] if rule not in rules)
+        return {}
+
+    def _delete_security_groups(self, action, params, data):
+        parts = action.strip('/').split('/')
+        if len(parts) == 2:
+            self.security_groups.pop(parts[1], None)
+        else:
+            rules = self.security_groups.get(parts[1], [])
+            if data in rules:
+                rules.remove(data)
+        return {}
+
+
+class SimulatedResponse(object):
+    def __init__(self, obj):
+        self.object = obj
+        self.body = None
+
+
+class SimulatedConnection(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def request(self, action, params=None, data=None, headers=None, method='GET'):
+        return SimulatedResponse(self.cloud.request(action, params, data, method))
+
+
+class SimulatedNodeDriver(object):
+    # Just enough of a libcloud NodeDriver for SimulatedDriver, talking to
+    # the simulated cloud through a connection like libcloud's.
+    name = 'Simulated'
+
+    def __init__(self, cloud):
+        self.connection = SimulatedConnection(cloud)
+
+    def _to_node(self, data):
+        return LibcloudNode(id=data['id'], name=data['name'], state=NodeState.RUNNING,
+                            public_ips=data['public_ips'], private_ips=[], driver=self,
+                            extra=dict((k, data[k]) for k in ('size', 'image', 'disk', 'security_groups', 'namespace')))
+
+    def ex_list_nodes_page(self, page=None, namespace=None):
+        response = self.connection.request('/nodes', params={'page': page, 'namespace': namespace}).object
+        return [self._to_node(data) for data in response['nodes']], response['next']
+
+    def list_nodes(self):
+        nodes = []
+        page = None
+        while True:
+            batch, page = self.ex_list_nodes_page(page)
+            nodes.extend(batch)
+            if page is None:
+                return nodes
+
+    def create_node(self, name, size, image, ex_disk=None, ex_security_groups=(), ex_namespace=None,
+                    ex_names=None, ex_client_token=None):
+        data = {'names': ex_names or [name],
+                'size': size,
+                'image': image,
+                'disk': ex_disk,
+                'security_groups': list(ex_security_groups),
+                'namespace': ex_namespace,
+                'client_token': ex_client_token}
+        nodes = [self._to_node(node) for node in self.connection.request('/nodes', data=data, method='POST').object['nodes']]
+        return nodes if ex_names else nodes[0]
+
+    def destroy_node(self, node):
+        self.connection.request('/nodes/%s' % (node.id,), method='DELETE')
+        return True
+
+    def ex_list_security_groups(self):
+        return self.connection.request('/security_groups').object['security_groups']
+
+    def ex_create_security_group(self, name):
+        self.connection.request('/security_groups', data={'name': name}, method='POST')
+
+    def ex_delete_security_group(self, name):
+        self.connection.request('/security_groups/%s' % (name,), method='DELETE')
+
+    def ex_authorize_security_group_rules(self, name, rules):
+        self.connection.request('/security_groups/%s/rules' % (name,), data={'rules': rules}, method='POST')
+
+    def ex_revoke_security_group_rule(self, name, rule):
+        self.connection.request('/security_groups/%s/rules' % (name,), data=rule, method='DELETE')
+
+
+class SimulatedDriver(CloudDriver):
+    provider = 'simulated'
+    name = 'Simulated'
+    max_node_batch_size = 100
+    max_security_group_rule_batch_size = 50
+    # Detection doesn't report scripts.
+    node_plan_fields = ('flavor', 'image', 'disk', 'security_groups')
+
+    def __init__(self, *args, **kwargs):
+        self.cloud = kwargs.pop('cloud')
+        super(SimulatedDriver, self).__init__(*args, **kwargs)
+
+    def _create_connection(self):
+        return SimulatedNodeDriver(self.cloud)
+
+    def get_namespace(self, node):
+        return node.extra['namespace']
+
+    def _list_candidate_node_pages(self, names=None):
+        page = None
+        while True:
+            nodes, page = self.connection.ex_list_nodes_page(page, namespace=self.namespace)
+            yield nodes
+            if page is None:
+                break
+
+    def _aasemble_node_from_provider_node(self, provider_node):
+        node = cloud_models.Node(name=provider_node.name,
+                                 flavor=provider_node.extra['size'],
+                                 image=provider_node.extra['image'],
+                                 disk=provider_node.extra['disk'],
+                                 networks=[],
+                                 private=provider_node)
+        node.security_group_names = set(provider_node.extra['security_groups'])
+        return node
+
+    def detect_firewalls(self, names=None):
+        security_groups = set()
+        security_group_rules = set()
+
+        for name, rules in self.connection.ex_list_security_groups().items():
+            if names is not None and name not in names:
+                continue
+            security_group = cloud_models.SecurityGroup(name=name)
+            security_groups.add(security_group)
+            for rule in rules:
+                security_group_rules.add(cloud_models.SecurityGroupRule(security_group=security_group, **rule))
+
+        return security_groups, security_group_rules
+
+    def _launch(self, nodes):
+        node = nodes[0]
+        return self.connection.create_node(name=node.name,
+                                           size=self.apply_mappings('flavors', node.flavor),
+                                           image=self.apply_mappings('images', node.image),
+                                           ex_disk=node.disk,
+                                           ex_security_groups=sorted(sg.name for sg in node.security_groups),
+                                           ex_namespace=self.namespace,
+                                           ex_names=[n.name for n in nodes],
+                                           ex_client_token=self.idempotency_key(nodes))
+
+    def create_node(self, node):
+        node.private, = self._launch([node])
+
+    def create_nodes(self, nodes):
+        for node, provider_node in zip(nodes, self._launch(nodes)):
+            node.private = provider_node
+
+    def create_security_group(self, security_group):
+        self.connection.ex_create_security_group(security_group.name)
+
+    def _rule(self, security_group_rule):
+        return {'from_port': security_group_rule.from_port,
+                'to_port': security_group_rule.to_port,
+                'protocol': security_group_rule.protocol,
+                'source_ip': security_group_rule.source_ip,
+                'source_group': security_group_rule.source_group}
+
+    def create_security_group_rule(self, security_group_rule):
+        self.create_security_group_rules([security_group_rule])
+
+    def create_security_group_rules(self, security_group_rules):
+        self.connection.ex_authorize_security_group_rules(security_group_rules[0].security_group.name,
+                                                          [self._rule(rule) for rule in security_group_rules])
+
+    def delete_security_group(self, security_group):
+        self.connection.ex_delete_security_group(security_group.name)
+
+    def delete_security_group_rule(self, security_group_rule):
+        self.connection.ex_revoke_security_group_rule(security_group_rule.security_group.name, self._rule(security_group_rule))
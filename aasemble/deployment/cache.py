@@ -0,0 +1,56 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '~/.aasemble/cache'
+
+
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def cache_path(cache_dir, prefix, *parts):
+    return os.path.join(os.path.expanduser(cache_dir), '%s-%s.json' % (prefix, cache_key(*parts)))
+
+
+def is_fresh(timestamp, ttl, now=None):
+    if not ttl or timestamp is None:
+        return False
+    return ((now or time.time()) - timestamp) < ttl
+
+
+def load(path):
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError) as e:
+        LOG.debug('Could not load cache file %s: %s' % (path, e))
+        return None
+
+
+def save(path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.rename(tmppath, path)
+    except Exception:
+        os.unlink(tmppath)
+        raise
+
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
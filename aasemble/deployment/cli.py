@@ -3,12 +3,23 @@ import json
 import logging
 import os.path
 import sys
+import time
 
 from multiprocessing.pool import ThreadPool
 
+import six
+
 import aasemble.client as client
-from aasemble.deployment import loader
+import aasemble.deployment.cloud.models as cloud_models
+import aasemble.deployment.cloud.plan as cloud_plan
+from aasemble.deployment import cache, exceptions, loader
+from aasemble.deployment.cloud.catalog import Catalog
+from aasemble.deployment.cloud.limiter import AdaptiveLimiter
+from aasemble.deployment.cloud.metrics import Metrics
+from aasemble.deployment.cloud.retry import RetryPolicy
 from aasemble.deployment.cloudconfigparser import load_cloud_config
+from aasemble.deployment.profiling import Profiler
+from aasemble.deployment.snapshot import ApplyRecord, Snapshot, fingerprint, merge
 
 DEFAULT_THREADS = 10
 
@@ -47,52 +58,245 @@ def cloud_config_path(name):
     return os.path.expanduser('~/.aasemble/{name}.ini'.format(name=name))
 
 
-def apply(options):
-    substitutions = extract_substitutions(options.substitutions)
+def get_catalog(options, cloud_driver_class, cloud_driver_kwargs):
+    path = cache.cache_path(options.cache_dir, 'catalog', cloud_driver_class.__name__, cloud_driver_kwargs)
+    return Catalog(path=path, ttl=options.catalog_ttl)
 
-    cluster = handle_cluster_opts(options, substitutions)
-    LOG.info('Cluster ID: %s', cluster)
 
-    resources = loader.load(options.stack, substitutions)
+def get_snapshot(options, cloud_driver_class, cloud_driver_kwargs):
+    path = cache.cache_path(options.cache_dir, 'snapshot', cloud_driver_class.__name__, cloud_driver_kwargs, options.namespace)
+    return Snapshot(path=path, ttl=options.snapshot_ttl)
+
+
+def get_apply_record(options):
+    path = cache.cache_path(options.cache_dir, 'applied', options.cloud, options.namespace)
+    return ApplyRecord(path)
+
+
+def extract_operation_limits(limitargs):
+    d = {}
+    for arg in limitargs:
+        operation, limit = arg.split('=', 1)
+        d[operation] = int(limit)
+    return d
+
+
+def get_engine_kwargs(options):
+    if options.engine != 'asyncio':
+        return {'pool': ThreadPool(options.threads)}
+
+    # libcloud calls block, so the event loop still hands each of them to
+    # one of --threads executor threads; that is the real concurrency
+    # limit, with --operation-limit capping individual operations below it.
+    from concurrent.futures import ThreadPoolExecutor
+    return {'engine': 'asyncio',
+            'executor': ThreadPoolExecutor(options.threads),
+            'operation_limits': extract_operation_limits(options.operation_limits)}
+
+
+def get_cloud_driver(options, cluster=None):
     cloud_driver_class, cloud_driver_kwargs, mappings = load_cloud_config(cloud_config_path(options.cloud))
-    pool = ThreadPool(options.threads)
+    kwargs = dict(cloud_driver_kwargs)
+    kwargs.update(get_engine_kwargs(options))
+    # Backoff sleeps go through the profiler so it can report them apart
+    # from time spent waiting on the provider.
+    sleep = options.profiler is not None and options.profiler.backoff or time.sleep
     cloud_driver = cloud_driver_class(mappings=mappings,
-                                      pool=pool,
                                       namespace=options.namespace,
                                       cluster=cluster,
-                                      **cloud_driver_kwargs)
+                                      catalog=get_catalog(options, cloud_driver_class, cloud_driver_kwargs),
+                                      limiter=AdaptiveLimiter(options.threads, sleep=sleep),
+                                      retry=RetryPolicy(sleep=sleep),
+                                      compact=options.compact,
+                                      metrics=options.metrics,
+                                      profiler=options.profiler,
+                                      **kwargs)
+
+    return cloud_driver, get_snapshot(options, cloud_driver_class, cloud_driver_kwargs)
+
+
+def detect_resources(cloud_driver, snapshot, refresh=False, desired=None):
+    current_resources = None if refresh else snapshot.load()
+
+    if current_resources is None:
+        if desired is not None:
+            # Only part of the inventory, so it must not end up in the snapshot.
+            return cloud_driver.detect_resources(desired=desired)
 
-    if not options.assume_empty:
         current_resources = cloud_driver.detect_resources()
-        resources = resources - current_resources
+        snapshot.save(current_resources)
+
+    return current_resources
+
+
+def unchanged_since_last_apply(cloud_driver, record, stack_fingerprint):
+    applied = record.load(stack_fingerprint)
+    if applied is None:
+        return False
+
+    nodes = applied['nodes']
+    if not set(nodes.values()) <= cloud_driver.live_node_ids(set(nodes)):
+        LOG.info('Nodes from the last apply are gone')
+        return False
+
+    security_groups = set(applied['security_groups'])
+    if security_groups and not security_groups <= cloud_driver.live_security_group_names(security_groups):
+        LOG.info('Security groups from the last apply are gone')
+        return False
+
+    return True
+
+
+def refresh_created_nodes(cloud_driver, collection):
+    # What a launch returns often predates the node's addresses, so look the
+    # new nodes up again before they go into the snapshot.
+    names = set(node.name for node in collection.nodes)
+    if not names:
+        return True
+
+    fresh = dict((node.name, node.private) for node in cloud_driver.detect_nodes(names))
+    for node in collection.nodes:
+        private = fresh.get(node.name)
+        if private is None or not getattr(private, 'public_ips', None):
+            LOG.info('%s has no address yet, so not keeping a snapshot' % (node.name,))
+            return False
+        node.private = private
+    return True
+
+
+def applied_node_ids(resources, current_resources):
+    ids = {}
+    for node in resources.nodes:
+        private = node.private
+        if private is None and node.name in current_resources.nodes.keys():
+            private = current_resources.nodes[node.name].private
+        ids[node.name] = getattr(private, 'id', None)
+    return ids
+
+
+def apply(options):
+    substitutions = extract_substitutions(options.substitutions)
+
+    cluster = handle_cluster_opts(options, substitutions)
+    LOG.info('Cluster ID: %s', cluster)
+
+    resources = loader.load(options.stack, substitutions)
+    cloud_driver, snapshot = get_cloud_driver(options, cluster=cluster)
+
+    record = get_apply_record(options)
+    stack_fingerprint = fingerprint(resources, cloud_driver.mappings, cluster, options.prune, options.replace)
+    if not (options.assume_empty or options.refresh) and unchanged_since_last_apply(cloud_driver, record, stack_fingerprint):
+        LOG.info('Nothing has changed since the last apply')
+        print(format_collection(cloud_models.Collection()))
+        print('Cluster ID: {}'.format(cluster))
+        return
+
+    if options.assume_empty:
+        current_resources = cloud_models.Collection()
+    else:
+        current_resources = None if options.refresh else snapshot.load()
+    plan = current_resources is not None and cloud_driver.plan(resources, current_resources, prune=options.prune)
+
+    # Deleting needs the live provider objects, which a snapshot doesn't keep.
+    if current_resources is None or (not options.assume_empty and plan.select(cloud_plan.DELETE)):
+        current_resources = detect_resources(cloud_driver, snapshot, refresh=True,
+                                             desired=resources if options.targeted else None)
+        plan = cloud_driver.plan(resources, current_resources, prune=options.prune)
+
+    # Replacing a node destroys it, so that only happens when asked for.
+    skipped = not options.replace and plan.select(cloud_plan.REPLACE) or []
+    for change in skipped:
+        LOG.warning('Skipping replacement of %s %s (%s), use --replace to replace it' % (change.kind, change.name, ', '.join(change.fields)))
+    if skipped:
+        plan = plan.without_replacements()
+
+    for change in plan:
+        LOG.info('Plan: %s %s %s%s' % (change.action, change.kind, change.name,
+                                       change.fields and ' (%s)' % ', '.join(change.fields) or ''))
+
+    try:
+        cloud_driver.apply_plan(plan, stack_fingerprint)
+    except Exception:
+        snapshot.invalidate()
+        record.invalidate()
+        raise
+
+    node_ids = applied_node_ids(resources, current_resources)
+    if skipped or None in node_ids.values():
+        record.invalidate()
+    else:
+        record.save(stack_fingerprint, plan, node_ids, [security_group.name for security_group in resources.security_groups])
+
+    # Only plain creations can be merged into the snapshot.
+    resources = plan.creations()
+    mergeable = not (options.assume_empty or options.targeted) and len(plan.select(cloud_plan.CREATE)) == len(plan)
+    if not (mergeable and snapshot.enabled and refresh_created_nodes(cloud_driver, resources)):
+        snapshot.invalidate()
+    else:
+        snapshot.save(merge(current_resources, resources))
 
-    cloud_driver.apply_resources(resources)
     print(format_collection(resources))
     print('Cluster ID: {}'.format(cluster))
 
 
 def _detect(options, noprint=True):
-    cloud_driver_class, cloud_driver_kwargs, mappings = load_cloud_config(cloud_config_path(options.cloud))
-    pool = ThreadPool(options.threads)
-    cloud_driver = cloud_driver_class(mappings=mappings,
-                                      pool=pool,
-                                      namespace=options.namespace,
-                                      **cloud_driver_kwargs)
+    cloud_driver, snapshot = get_cloud_driver(options)
+    return cloud_driver, detect_resources(cloud_driver, snapshot, refresh=getattr(options, 'refresh', False))
 
-    return cloud_driver, cloud_driver.detect_resources()
 
+def stream_json(cloud_driver, out=sys.stdout):
+    # Writes the same document as json.dumps(collection.as_dict()), but each
+    # node goes out as soon as its page of the listing has been converted.
+    firewalls = cloud_driver.submit(cloud_driver.limited(lambda _: cloud_driver.detect_firewalls(), 'detect_firewalls'), None)
+    collection = None
+
+    out.write('{"nodes": [')
+    for i, node in enumerate(cloud_driver.iter_nodes()):
+        if collection is None:
+            collection = firewalls_collection(*firewalls())
+        collection.connect_node(node)
+        out.write((i and ', ' or '') + json.dumps(node.as_dict()))
+        out.flush()
+
+    if collection is None:
+        collection = firewalls_collection(*firewalls())
+
+    out.write('], "security_groups": %s, "security_group_rules": %s, "urls": []}\n' %
+              (json.dumps([sg.as_dict() for sg in collection.security_groups]),
+               json.dumps([sgr.as_dict() for sgr in collection.security_group_rules])))
 
-def detect(options, noprint=True):
-    _, resources = _detect(options)
 
+def firewalls_collection(security_groups, security_group_rules):
+    collection = cloud_models.Collection()
+    for security_group in security_groups:
+        collection.security_groups.add(security_group)
+    collection.security_group_rules |= set(security_group_rules)
+    return collection
+
+
+def detect(options, noprint=True):
     if getattr(options, 'json', False):
+        cloud_driver, snapshot = get_cloud_driver(options)
+
+        # Without a snapshot to fill in there's no need to hold on to the
+        # whole inventory.
+        if not snapshot.enabled:
+            stream_json(cloud_driver)
+            return
+
+        resources = detect_resources(cloud_driver, snapshot, refresh=getattr(options, 'refresh', False))
         print(json.dumps(resources.as_dict()))
     else:
+        _, resources = _detect(options)
         print(format_collection(resources))
 
 
 def clean(options):
-    cloud_driver, resources = _detect(options)
+    # Deleting needs the live provider objects, so never clean from a snapshot.
+    cloud_driver, snapshot = get_cloud_driver(options)
+    resources = cloud_driver.detect_resources()
+    snapshot.invalidate()
+    get_apply_record(options).invalidate()
     cloud_driver.clean_resources(resources)
 
 
@@ -100,7 +304,25 @@ def main(args=sys.argv[1:]):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
-                        help='Number of threads [default={}]'.format(DEFAULT_THREADS))
+                        help='Maximum number of concurrent provider calls. Concurrency starts lower and adapts to throttling [default={}]'.format(DEFAULT_THREADS))
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Execution engine for provider calls. Provider calls block either way, so at most --threads of them run at once [default=threads]')
+    parser.add_argument('--operation-limit', action='append', default=[], dest='operation_limits', metavar='OPERATION=N',
+                        help='Limit concurrent calls of an operation, e.g. create_node=20 (asyncio engine only)')
+    parser.add_argument('--cache-dir', default=cache.DEFAULT_CACHE_DIR,
+                        help='Directory for cached provider data [default={}]'.format(cache.DEFAULT_CACHE_DIR))
+    parser.add_argument('--catalog-ttl', type=int, default=0, metavar='SECONDS',
+                        help='Keep the image/size/location catalog on disk for this long [default=0, disabled]')
+    parser.add_argument('--snapshot-ttl', type=int, default=0, metavar='SECONDS',
+                        help='Reuse the detected inventory for this long [default=0, disabled]')
+    parser.add_argument('--compact', action='store_true',
+                        help='Keep only the id, state, addresses and boot volume of detected nodes instead of the full provider objects')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='Write latency, payload size, retry and throttle metrics for every provider API call to this file')
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+                        help='Format of the metrics file [default=json]')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='Profile the run (CPU, allocations, and how operations split their time between CPU, provider requests, limiter queueing and backoff) and write the results to this directory')
 
     parser.add_argument('--debug', '-d', action='store_const', const=logging.DEBUG,
                         dest='loglevel', default=logging.INFO, help='Enable debugging')
@@ -113,6 +335,14 @@ def main(args=sys.argv[1:]):
     apply_parser.set_defaults(func=apply)
     apply_parser.add_argument('--assume-empty', action='store_true', help='Ignore current resources')
     apply_parser.add_argument('--namespace', help='Namespace for resources')
+    apply_parser.add_argument('--refresh', action='store_true',
+                              help='Ignore any inventory snapshot and detect current resources, even if nothing has changed since the last apply')
+    apply_parser.add_argument('--prune', action='store_true',
+                              help='Delete detected resources that are no longer in the stack')
+    apply_parser.add_argument('--replace', action='store_true',
+                              help='Replace nodes whose changes cannot be made in place (they are skipped otherwise)')
+    apply_parser.add_argument('--targeted', action='store_true',
+                              help='Only look up the nodes and security groups named in the stack instead of detecting everything')
 
     cluster_group = apply_parser.add_mutually_exclusive_group()
     cluster_group.add_argument('--new-cluster', action='store_true', help='Create new cluster')
@@ -127,6 +357,7 @@ def main(args=sys.argv[1:]):
     detect_parser.add_argument('--cloud', default='default', help='Cloud config')
     detect_parser.add_argument('--namespace', help='Namespace for resources')
     detect_parser.add_argument('--json', action='store_true', help='Output as JSON')
+    detect_parser.add_argument('--refresh', action='store_true', help='Ignore any inventory snapshot and detect current resources')
 
     clean_parser = subparsers.add_parser('clean', help='Clean current resources')
     clean_parser.set_defaults(func=clean)
@@ -134,9 +365,27 @@ def main(args=sys.argv[1:]):
     clean_parser.add_argument('--namespace', help='Namespace for resources')
 
     options = parser.parse_args(args)
-    logging.basicConfig(level=options.loglevel, format='%(asctime)-15s %(message)s')
+    if options.engine == 'asyncio' and six.PY2:
+        parser.error('the asyncio engine needs Python 3')
 
-    options.func(options)
+    logging.basicConfig(level=options.loglevel, format='%(asctime)-15s %(message)s')
+    options.metrics = options.metrics_file and Metrics() or None
+    options.profiler = options.profile and Profiler(options.profile) or None
+
+    if options.profiler is not None:
+        options.profiler.start()
+
+    try:
+        options.func(options)
+    except exceptions.ResourcesFailedException as e:
+        LOG.error(e.report())
+        sys.exit(1)
+    finally:
+        if options.profiler is not None:
+            options.profiler.stop()
+            options.profiler.write()
+        if options.metrics is not None:
+            options.metrics.write(options.metrics_file, options.metrics_format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+
+from aasemble.deployment.cloud.scheduler import Scheduler
+
+LOG = logging.getLogger(__name__)
+
+
+class Unbounded(object):
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class AsyncioScheduler(Scheduler):
+    def __init__(self, executor, operation_limits=None):
+        super(AsyncioScheduler, self).__init__(pool=None)
+        self.executor = executor
+        self.operation_limits = operation_limits or {}
+        self.semaphores = {}
+
+    def run(self):
+        self._prepare()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._run_all())
+        finally:
+            loop.close()
+
+        return self._complete()
+
+    def _semaphore(self, operation):
+        if operation not in self.semaphores:
+            # Operations without a limit of their own are only bounded by
+            # the executor.
+            limit = self.operation_limits.get(operation)
+            self.semaphores[operation] = limit and asyncio.Semaphore(limit) or Unbounded()
+        return self.semaphores[operation]
+
+    async def _run_all(self):
+        self.finished = dict((task.key, asyncio.Event()) for task in self.order)
+        await asyncio.gather(*[self._run_task(task) for task in self.order])
+
+    async def _run_task(self, task):
+        for key in task.pending:
+            await self.finished[key].wait()
+
+        failed = [self.tasks[key] for key in task.pending if self.tasks[key].state != 'done']
+
+        if failed:
+            self._skip(task, failed[0])
+            return
+
+        task.state = 'running'
+        task.ready_at = time.time()
+
+        try:
+            async with self._semaphore(task.operation):
+                LOG.debug('Starting %r after waiting %.2fs for dependencies' % (task.key, task.wait_time))
+                task.result = await asyncio.get_running_loop().run_in_executor(self.executor, task.func, task.arg)
+        except BaseException as e:
+            # Recorded like the thread scheduler does; _complete re-raises
+            # anything that isn't an Exception.
+            task.exception = e
+        finally:
+            self._mark_finished(task)
+            self.finished[task.key].set()
+
+    def _skip(self, task, cause):
+        super(AsyncioScheduler, self)._skip(task, cause)
+        self.finished[task.key].set()
+
+    def _finish(self, task):
+        self._mark_finished(task)
@@ -1,17 +1,36 @@
 import logging
 
 from libcloud.common.exceptions import BaseHTTPError
+from libcloud.compute.drivers.ec2 import NAMESPACE
 from libcloud.compute.types import Provider
+from libcloud.utils.xml import findall, findtext
 
 import aasemble.deployment.cloud.models as cloud_models
+from aasemble.deployment import cache, exceptions
 from aasemble.deployment.cloud.base import CloudDriver
 
 LOG = logging.getLogger(__name__)
 
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+TRANSIENT_ERROR_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable')
+DUPLICATE_RULE_ERROR_CODE = 'InvalidPermission.Duplicate'
+RULE_NOT_FOUND_ERROR_CODE = 'InvalidPermission.NotFound'
+GROUP_NOT_FOUND_ERROR_CODE = 'InvalidGroup.NotFound'
+IDEMPOTENT_INSTANCE_TERMINATED_ERROR_CODE = 'IdempotentInstanceTerminated'
+INSTANCE_NOT_FOUND_ERROR_CODE = 'InvalidInstanceID.NotFound'
+MAX_CLIENT_TOKEN_GENERATIONS = 5
+BATCH_TAG = 'aasemble_batch'
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+MAX_FILTER_VALUES = 200
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+
 
 class AWSDriver(CloudDriver):
     provider = Provider.EC2
     name = 'Amazon EC2'
+    max_node_batch_size = 100
+    max_security_group_rule_batch_size = 50
+    node_update_fields = ('security_groups',)
 
     def __init__(self, *args, **kwargs):
         self.region = kwargs.pop('region')
@@ -21,6 +40,7 @@ class AWSDriver(CloudDriver):
         self._sg_name_to_id = {}
         self._sg_id_to_name = {}
         self._volume_size_map = None
+        self._key_name = None
         super(AWSDriver, self).__init__(*args, **kwargs)
 
     @classmethod
@@ -38,20 +58,67 @@ class AWSDriver(CloudDriver):
         return ((self.access_key, self.secret_key),
                 {'region': self.region})
 
-    @property
-    def volume_size_map(self):
+    def is_throttling_error(self, exc):
+        if isinstance(exc, BaseHTTPError) and exc.message.startswith(THROTTLING_ERROR_CODES):
+            return True
+        return super(AWSDriver, self).is_throttling_error(exc)
+
+    def is_transient_error(self, exc):
+        if isinstance(exc, BaseHTTPError) and exc.message.startswith(TRANSIENT_ERROR_CODES):
+            return True
+        return super(AWSDriver, self).is_transient_error(exc)
+
+    def _boot_volume_id(self, ec2node):
+        return ec2node.extra['block_device_mapping'][0]['ebs']['volume_id']
+
+    def _fetch_volume_sizes(self, volume_ids):
+        volume_ids = sorted(set(volume_ids))
+        chunks = [volume_ids[i:i + MAX_FILTER_VALUES] for i in range(0, len(volume_ids), MAX_FILTER_VALUES)]
+
+        def list_volumes(chunk):
+            return self.connection.list_volumes(ex_filters={'volume-id': chunk})
+
+        sizes = {}
+        for volumes in self.map_concurrently(list_volumes, chunks, 'list_volumes'):
+            for volume in volumes:
+                sizes[volume.id] = volume.size
+
         if self._volume_size_map is None:
             self._volume_size_map = {}
-            for volume in self.connection.list_volumes():
-                self._volume_size_map[volume.id] = volume.size
-        return self._volume_size_map
+        self._volume_size_map.update(sizes)
+
+    def _boot_volume_ref(self, ec2node):
+        return self._boot_volume_id(ec2node)
+
+    def _fetch_provider_node(self, node):
+        # Asking for a long gone instance is an error, but one that has only
+        # just gone can come back as an empty listing instead.
+        try:
+            ec2nodes = self.connection.list_nodes(ex_node_ids=[node.private.id])
+        except BaseHTTPError as e:
+            if not e.message.startswith(INSTANCE_NOT_FOUND_ERROR_CODE):
+                raise
+            ec2nodes = []
+
+        if not ec2nodes:
+            raise exceptions.NodeNotFoundException('%s (%s)' % (node.name, node.private.id))
+        return ec2nodes[0]
+
+    def _prefetch_volumes(self, ec2nodes):
+        self._fetch_volume_sizes(self._boot_volume_id(ec2node) for ec2node in ec2nodes)
+
+    def _volume_size(self, volume_id):
+        if self._volume_size_map is None or volume_id not in self._volume_size_map:
+            self._fetch_volume_sizes([volume_id])
+        return self._volume_size_map[volume_id]
 
     def _refresh_sg_name_id_map(self):
-        self._sg_id_to_name = {}
-        self._sg_name_to_id_map = {}
+        sg_id_to_name = {}
+        sg_name_to_id = {}
         for sg in self.connection.ex_get_security_groups():
-            self._sg_id_to_name[sg.id] = sg.name
-            self._sg_name_to_id[sg.name] = sg.id
+            sg_id_to_name[sg.id] = sg.name
+            sg_name_to_id[sg.name] = sg.id
+        self._sg_id_to_name, self._sg_name_to_id = sg_id_to_name, sg_name_to_id
 
     def sg_id_to_name(self, id):
         try:
@@ -68,32 +135,130 @@ class AWSDriver(CloudDriver):
             return self._sg_name_to_id[name]
 
     def get_namespace(self, node):
-        if 'tags' not in node.private.extra:
+        return self._tags_namespace(node.private.extra)
+
+    def _tags_namespace(self, extra):
+        if 'tags' not in extra:
             return None
 
-        if 'aasemble_namespace' in node.private.extra['tags']:
-            return node.private.extra['tags']['aasemble_namespace']
+        if 'aasemble_namespace' in extra['tags']:
+            return extra['tags']['aasemble_namespace']
+
+    def _list_candidate_node_pages(self, names=None):
+        filters = {'instance-state-name': LIVE_INSTANCE_STATES}
+        if self.namespace is not None:
+            filters['tag:aasemble_namespace'] = self.namespace
+
+        if names is None:
+            filter_sets = [filters]
+        else:
+            names = sorted(names)
+            filter_sets = [dict(filters, **{'tag:Name': names[i:i + MAX_FILTER_VALUES]})
+                           for i in range(0, len(names), MAX_FILTER_VALUES)]
+
+        for filter_set in filter_sets:
+            for page in self._describe_instance_pages(filter_set):
+                yield page
+
+    def _describe_instance_pages(self, filters):
+        params = {'Action': 'DescribeInstances',
+                  'MaxResults': DESCRIBE_INSTANCES_PAGE_SIZE}
+        params.update(self.connection._build_filters(filters))
+
+        while True:
+            elem = self.connection.connection.request(self.connection.path, params=params).object
+
+            ec2nodes = []
+            for reservation in findall(element=elem, xpath='reservationSet/item', namespace=NAMESPACE):
+                ec2nodes += self.connection._to_nodes(reservation, 'instancesSet/item')
+
+            if ec2nodes:
+                addresses = self.connection.ex_describe_addresses(ec2nodes)
+                for ec2node in ec2nodes:
+                    ec2node.public_ips.extend(addresses[ec2node.id])
+
+            yield ec2nodes
 
-    def _is_node_relevant(self, node):
-        if node.state in ('terminated', 'shutting-down', 'unknown'):
+            next_token = findtext(element=elem, xpath='nextToken', namespace=NAMESPACE)
+            if not next_token:
+                break
+            params['NextToken'] = next_token
+
+    def _is_node_relevant(self, ec2node):
+        # Listings hand us libcloud's nodes, not our own.
+        if ec2node.state in ('terminated', 'shutting-down', 'unknown'):
             return False
-        return super(AWSDriver, self)._is_node_relevant(node)
+        return self.namespace is None or self._tags_namespace(ec2node.extra) == self.namespace
 
     def _aasemble_node_from_provider_node(self, ec2node):
-        node = cloud_models.Node(name=ec2node.name,
-                                 flavor=ec2node.size,
-                                 image=ec2node.image,
-                                 disk=self.volume_size_map[ec2node.extra['block_device_mapping'][0]['ebs']['volume_id']],
+        name = ec2node.name
+        if name is not None and ec2node.extra.get('tags', {}).get(BATCH_TAG) == name:
+            # Still named after its batch, so the launch was cut short before
+            # it was named. Keep it apart from the rest of the batch.
+            name = '%s-%s' % (name, ec2node.id)
+            LOG.warning('Node %s was launched in a batch but never named, detecting it as %s' % (ec2node.id, name))
+
+        node = cloud_models.Node(name=name,
+                                 flavor=ec2node.size or ec2node.extra.get('instance_type'),
+                                 image=ec2node.image or ec2node.extra.get('image_id'),
+                                 disk=self._volume_size(self._boot_volume_id(ec2node)),
                                  networks=[],
                                  private=ec2node)
         node.security_group_names = set((v['group_name'] for v in ec2node.extra['groups']))
         return node
 
-    def detect_firewalls(self):
+    def _list_security_groups(self, names=None):
+        if names is None:
+            return self.connection.ex_get_security_groups()
+
+        # Filtering (unlike asking for group names) doesn't fail on groups
+        # that don't exist yet.
+        names = sorted(names)
+        security_groups = []
+        for i in range(0, len(names), MAX_FILTER_VALUES):
+            security_groups += self.connection.ex_get_security_groups(filters={'group-name': names[i:i + MAX_FILTER_VALUES]})
+        return security_groups
+
+    def _detection_stages(self, node_names=None, security_group_names=None):
+        stages = [stage for stage in super(AWSDriver, self)._detection_stages(node_names, security_group_names)
+                  if stage[0] != 'firewalls']
+        stages.append(('security_groups', lambda results: self._list_security_groups(security_group_names), ()))
+        stages.append(('firewalls', lambda results: self._firewalls_from_security_groups(results['security_groups']), ('security_groups',)))
+        return stages
+
+    def _resolve_security_group_ids(self, ids):
+        ids = sorted(ids)
+        for i in range(0, len(ids), MAX_FILTER_VALUES):
+            for security_group in self.connection.ex_get_security_groups(filters={'group-id': ids[i:i + MAX_FILTER_VALUES]}):
+                self._sg_id_to_name[security_group.id] = security_group.name
+                self._sg_name_to_id[security_group.name] = security_group.id
+
+    def detect_firewalls(self, names=None):
+        return self._firewalls_from_security_groups(self._list_security_groups(names))
+
+    def live_security_group_names(self, names):
+        # No need to resolve the rules' source groups just to see these exist.
+        return set(security_group.name for security_group in self._list_security_groups(names))
+
+    def _firewalls_from_security_groups(self, security_groups):
         security_group_set = set()
         security_group_rule_set = set()
 
-        for security_group in self.connection.ex_get_security_groups():
+        for security_group in security_groups:
+            self._sg_id_to_name[security_group.id] = security_group.name
+            self._sg_name_to_id[security_group.name] = security_group.id
+
+        # Rules can refer to groups a filtered listing left out. Look up just
+        # those rather than every group in the account.
+        unknown_ids = set(pair['group_id']
+                          for security_group in security_groups
+                          for rule in security_group.ingress_rules
+                          for pair in rule.get('group_pairs') or []
+                          if pair['group_id'] not in self._sg_id_to_name)
+        if unknown_ids:
+            self._resolve_security_group_ids(unknown_ids)
+
+        for security_group in security_groups:
             sg = cloud_models.SecurityGroup(name=security_group.name)
             security_group_set.add(sg)
 
@@ -117,14 +282,12 @@ class AWSDriver(CloudDriver):
         return self.connection.get_image(self.apply_mappings('images', image))
 
     def _get_size_real(self, size_name):
-        return [s for s in self.connection.list_sizes() if s.id == size_name][0]
+        return self.get_catalog_size('id', size_name)
 
     def _get_size(self, flavor):
         return self._get_size_real(self.apply_mappings('flavors', flavor))
 
-    def create_node(self, node):
-        LOG.info('Launching node: %s' % (node.name))
-
+    def _launch_kwargs(self, node):
         image = self._get_image(node.image)
         size = self._get_size(node.flavor)
 
@@ -138,14 +301,71 @@ class AWSDriver(CloudDriver):
         self._add_script_info(node, kwargs)
         self._add_namespace_info(kwargs)
 
-        node.private = self.connection.create_node(**kwargs)
+        return kwargs
+
+    def create_node(self, node):
+        LOG.info('Launching node: %s' % (node.name))
+
+        kwargs = self._launch_kwargs(node)
+        node.private = self._run_instances([node], kwargs)
 
         LOG.info('Launced node: %s %r' % (node.name, kwargs))
 
+    def create_nodes(self, nodes):
+        if len(nodes) == 1:
+            return self.create_node(nodes[0])
+
+        LOG.info('Launching %d nodes: %s' % (len(nodes), ', '.join(node.name for node in nodes)))
+
+        # One RunInstances call for the whole batch. It can only give every
+        # instance the same Name, so launch them under the batch's name and
+        # name them afterwards. Instances still carrying it were never named.
+        kwargs = self._launch_kwargs(nodes[0])
+        batch_name = self._batch_name(nodes)
+        kwargs['name'] = batch_name
+        kwargs['ex_metadata'] = dict(kwargs.get('ex_metadata') or {}, **{BATCH_TAG: batch_name})
+        kwargs['ex_mincount'] = kwargs['ex_maxcount'] = len(nodes)
+        ec2nodes = self._run_instances(nodes, kwargs)
+
+        def name_instance(pair):
+            node, ec2node = pair
+            self.connection.ex_create_tags(ec2node, {'Name': node.name})
+            ec2node.name = node.name
+            ec2node.extra.setdefault('tags', {})['Name'] = node.name
+            node.private = ec2node
+
+        self.map_concurrently(name_instance, list(zip(nodes, ec2nodes)), 'create_tags')
+
+        LOG.info('Launched nodes: %s' % (', '.join('%s (%s)' % (node.name, node.private.id) for node in nodes)))
+
+    def _batch_name(self, nodes):
+        # The same for every launch of these nodes, as a retried RunInstances
+        # has to repeat its parameters along with the client token.
+        return 'aasemble-batch-%s' % (cache.cache_key(self.namespace, [node.name for node in nodes])[:12],)
+
+    def _run_instances(self, nodes, kwargs):
+        # A retried RunInstances with the same ClientToken hands back the
+        # instances the first one launched. EC2 refuses a token whose
+        # instances have since been terminated, so move on to the next one.
+        generation = 0
+        while True:
+            token = self.idempotency_key(nodes, generation)
+            if token is not None:
+                kwargs['ex_clienttoken'] = token
+            try:
+                return self.connection.create_node(**kwargs)
+            except BaseHTTPError as e:
+                retryable = token is not None and generation + 1 < MAX_CLIENT_TOKEN_GENERATIONS
+                if not (retryable and e.message.startswith(IDEMPOTENT_INSTANCE_TERMINATED_ERROR_CODE)):
+                    raise
+                generation += 1
+
     def _add_key_pair_info(self, kwargs):
         if self.ssh_key_file:
-            with open(self.expand_path(self.ssh_key_file), 'r') as fp:
-                kwargs['ex_keyname'] = self.connection.ex_find_or_import_keypair_by_key_material(fp.read().rstrip())['keyName']
+            if self._key_name is None:
+                with open(self.expand_path(self.ssh_key_file), 'r') as fp:
+                    self._key_name = self.connection.ex_find_or_import_keypair_by_key_material(fp.read().rstrip())['keyName']
+            kwargs['ex_keyname'] = self._key_name
 
     def _add_script_info(self, node, kwargs):
         if node.script is not None:
@@ -155,6 +375,13 @@ class AWSDriver(CloudDriver):
         if self.namespace is not None:
             kwargs['ex_metadata'] = {'aasemble_namespace': self.namespace}
 
+    def update_node(self, change):
+        LOG.info('Updating node: %s (%s)' % (change.name, ', '.join(change.fields)))
+
+        names = sorted(sg.name for sg in change.desired.security_groups)
+        attributes = dict(('GroupId.%d' % (i + 1,), self.sg_name_to_id(name)) for i, name in enumerate(names))
+        self.connection.ex_modify_instance_attribute(self.provider_node(change.current), attributes)
+
     def create_security_group(self, security_group):
         LOG.info('Creating security group: %s' % (security_group))
         try:
@@ -163,9 +390,22 @@ class AWSDriver(CloudDriver):
             if not e.message.startswith('InvalidGroup.Duplicate'):
                 raise
 
-    def create_security_group_rule(self, security_group_rule):
-        LOG.info('Creating firewall rule: %s' % (security_group_rule))
+    def delete_security_group(self, security_group):
+        LOG.info('Deleting security group: %s' % (security_group))
+        try:
+            group_id = self.sg_name_to_id(security_group.name)
+        except KeyError:
+            LOG.info('Security group %s is already gone' % (security_group))
+            return
+
+        try:
+            self.connection.ex_delete_security_group_by_id(group_id)
+        except BaseHTTPError as e:
+            if not e.message.startswith(GROUP_NOT_FOUND_ERROR_CODE):
+                raise
+            LOG.info('Security group %s is already gone' % (security_group))
 
+    def _ingress_kwargs(self, security_group_rule):
         kwargs = {'id': self.sg_name_to_id(security_group_rule.security_group.name),
                   'from_port': security_group_rule.from_port,
                   'to_port': security_group_rule.to_port,
@@ -175,8 +415,63 @@ class AWSDriver(CloudDriver):
             kwargs['group_pairs'] = [{'group_name': security_group_rule.source_group}]
         else:
             kwargs['cidr_ips'] = [security_group_rule.source_ip]
+        return kwargs
+
+    def delete_security_group_rule(self, security_group_rule):
+        LOG.info('Deleting firewall rule: %s' % (security_group_rule))
+        try:
+            self.connection.ex_revoke_security_group_ingress(**self._ingress_kwargs(security_group_rule))
+        except BaseHTTPError as e:
+            if not e.message.startswith(RULE_NOT_FOUND_ERROR_CODE):
+                raise
+            LOG.info('Firewall rule %s is already gone' % (security_group_rule))
+
+    def create_security_group_rule(self, security_group_rule):
+        LOG.info('Creating firewall rule: %s' % (security_group_rule))
+
+        try:
+            self.connection.ex_authorize_security_group_ingress(**self._ingress_kwargs(security_group_rule))
+        except BaseHTTPError as e:
+            if not e.message.startswith(DUPLICATE_RULE_ERROR_CODE):
+                raise
+            LOG.warning('Firewall rule already exists: %s' % (security_group_rule))
+
+    def _ip_permission_params(self, index, security_group_rule):
+        prefix = 'IpPermissions.%d.' % (index,)
+        params = {prefix + 'IpProtocol': security_group_rule.protocol,
+                  prefix + 'FromPort': security_group_rule.from_port,
+                  prefix + 'ToPort': security_group_rule.to_port}
+
+        if security_group_rule.source_group is not None:
+            params[prefix + 'Groups.1.GroupName'] = security_group_rule.source_group
+        else:
+            params[prefix + 'IpRanges.1.CidrIp'] = security_group_rule.source_ip
+
+        return params
+
+    def create_security_group_rules(self, security_group_rules):
+        if len(security_group_rules) == 1:
+            return self.create_security_group_rule(security_group_rules[0])
+
+        name = security_group_rules[0].security_group.name
+        LOG.info('Creating %d firewall rules for %s' % (len(security_group_rules), name))
+
+        params = {'Action': 'AuthorizeSecurityGroupIngress',
+                  'GroupId': self.sg_name_to_id(name)}
+        for index, security_group_rule in enumerate(security_group_rules, 1):
+            params.update(self._ip_permission_params(index, security_group_rule))
+
+        try:
+            self.connection.connection.request(self.connection.path, params=params)
+        except BaseHTTPError as e:
+            if not e.message.startswith(DUPLICATE_RULE_ERROR_CODE):
+                raise
 
-        self.connection.ex_authorize_security_group_ingress(**kwargs)
+            # EC2 rejects the whole request if any one rule exists already,
+            # so go through them individually to find out which.
+            LOG.info('Some firewall rules for %s already exist, adding them one at a time' % (name,))
+            for security_group_rule in security_group_rules:
+                self.create_security_group_rule(security_group_rule)
 
     def _block_device_mappings(self, node):
         return {'DeviceName': '/dev/sda1', 'Ebs.VolumeSize': node.disk}
@@ -1,79 +1,334 @@
+import collections
 import json
 import logging
 import os.path
 import re
 import shlex
+import socket
 import threading
+import time
 from multiprocessing.pool import ThreadPool
 
+from libcloud.common.exceptions import RateLimitReachedError
+from libcloud.compute.base import NodeImage, NodeLocation, NodeSize
 from libcloud.compute.providers import get_driver
 from libcloud.utils.publickey import get_pubkey_comment
 
+from requests.exceptions import ConnectionError, Timeout
+
 import aasemble.client
 import aasemble.deployment.cloud.models as cloud_models
+import aasemble.deployment.cloud.plan as cloud_plan
+from aasemble.deployment import cache, exceptions
+from aasemble.deployment.cloud.catalog import Catalog
+from aasemble.deployment.cloud.limiter import AdaptiveLimiter, operation_class
+from aasemble.deployment.cloud.retry import PERMANENT, RetryPolicy, THROTTLING, TRANSIENT
+from aasemble.deployment.cloud.scheduler import Scheduler
+from aasemble.deployment.profiling import wall_time
 
 LOG = logging.getLogger(__name__)
 THREADS = 10  # These are really, really lightweight
+# Operations that launch nodes, which only a client token makes safe to retry.
+LAUNCH_OPERATIONS = ('create_node', 'create_nodes')
+
+
+class _NoContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_CONTEXT = _NoContext()
 
 
 class CloudDriver(object):
-    def __init__(self, namespace=None, mappings=None, pool=None, cluster=None):
+    image_extra_keys = ()
+    max_node_batch_size = 1
+    max_security_group_rule_batch_size = 1
+    # Node fields detection reports in a form comparable to the stack, and
+    # the subset of them that can change without replacing the node. Drivers
+    # that list any of the latter implement update_node(change).
+    node_plan_fields = cloud_plan.NODE_FIELDS
+    node_update_fields = ()
+
+    def __init__(self, namespace=None, mappings=None, pool=None, cluster=None, catalog=None,
+                 engine='threads', executor=None, operation_limits=None, limiter=None, compact=False, retry=None,
+                 metrics=None, profiler=None):
         self.mappings = mappings or {}
-        self.pool = pool or ThreadPool(THREADS)
+        self._pool = pool
+        self.catalog = catalog or Catalog()
+        self.engine = engine
+        self._executor = executor
+        self.operation_limits = operation_limits or {}
+        self.limiter = limiter or AdaptiveLimiter(THREADS)
+        self.retry = retry or RetryPolicy()
+        self.metrics = metrics
+        self.profiler = profiler
+        self.compact = compact
         self.secgroups = {}
         self.namespace = namespace
+        self.stack_fingerprint = None
         self.cluster = cluster and aasemble.client.Cluster(cluster) or None
         self.locals = threading.local()
 
     @property
     def connection(self):
         if not hasattr(self.locals, '_connection'):
-            driver = get_driver(self.provider)
-            driver_args, driver_kwargs = self._get_driver_args_and_kwargs()
             LOG.debug('Connecting to {}'.format(self.name))
-            self.locals._connection = driver(*driver_args, **driver_kwargs)
+            connection = self._create_connection()
+            if self.metrics is not None:
+                self.metrics.instrument(connection, self.provider_name)
+            if self.profiler is not None:
+                self.profiler.instrument(connection)
+            self._retry_throttled_requests(connection)
+            self.locals._connection = connection
 
         return self.locals._connection
 
+    def _create_connection(self):
+        driver = get_driver(self.provider)
+        driver_args, driver_kwargs = self._get_driver_args_and_kwargs()
+        return driver(*driver_args, **driver_kwargs)
+
+    def _retry_throttled_requests(self, driver):
+        # Throttles are retried request by request rather than by re-running
+        # the operation, which could repeat a launch that already went
+        # through before a later call was throttled.
+        connection = driver.connection
+        request = connection.request
+
+        def retrying(*args, **kwargs):
+            operation = self.current_operation()
+            return self.limiter.request(self.provider_name, operation_class(operation),
+                                        lambda exc: self._is_throttled(exc, operation), request, *args, **kwargs)
+
+        connection.request = retrying
+        return driver
+
+    def current_operation(self):
+        return getattr(self.locals, 'operation', None)
+
     def _is_node_relevant(self, node):
         return self.namespace is None or self.get_namespace(node) == self.namespace
 
-    def detect_nodes(self):
+    def detect_nodes(self, names=None):
+        return set(self.iter_nodes(names))
+
+    def iter_nodes(self, names=None):
+        # Converts each page of the listing as it arrives, so only the
+        # current page of provider nodes is held at any one time.
+        for provider_nodes in self._get_relevant_node_pages(names):
+            self._prefetch_volumes(provider_nodes)
+            for node in self._convert_nodes(provider_nodes):
+                yield node
+
+    def _convert_nodes(self, provider_nodes):
         nodes = set()
 
-        for node in self._get_relevant_nodes():
+        for node in provider_nodes:
             aasemble_node = self._aasemble_node_from_provider_node(node)
+            if self.compact:
+                aasemble_node.private = self._node_record(node)
             nodes.add(aasemble_node)
             LOG.info('Detected node: %s' % aasemble_node.name)
 
         return nodes
 
-    def _get_relevant_nodes(self):
-        for node in self.connection.list_nodes():
-            if self._is_node_relevant(node):
+    def _prefetch_volumes(self, provider_nodes):
+        pass
+
+    def _node_record(self, provider_node):
+        # Nodes detected under a namespace all carry it, so there's no need
+        # to dig it out of the provider's metadata.
+        return cloud_models.NodeRecord(id=provider_node.id,
+                                       state=provider_node.state,
+                                       public_ips=list(provider_node.public_ips or []),
+                                       namespace=self.namespace,
+                                       boot_volume=self._boot_volume_ref(provider_node))
+
+    def _boot_volume_ref(self, provider_node):
+        return None
+
+    def provider_node(self, node):
+        if isinstance(node.private, cloud_models.NodeRecord):
+            LOG.debug('Fetching provider node for %s' % (node.name,))
+            return self._fetch_provider_node(node)
+        return node.private
+
+    def _fetch_provider_node(self, node):
+        return self._get_resource_by_attr(self.connection.list_nodes, 'id', node.private.id)
+
+    def map_concurrently(self, func, items, operation):
+        # Spreads the items over the pool, each call holding a limiter slot.
+        # items may be a generator, in which case they're handed out as they
+        # arrive. The caller may itself be a pool task holding a slot of the
+        # same class, so it works through what's left once it has all the
+        # items, and only ever waits for ones a helper has already started.
+        results = []
+        pending = collections.deque()
+        errors = []
+        outstanding = [0]
+        cond = threading.Condition()
+
+        def claim():
+            with cond:
+                if pending and not errors:
+                    outstanding[0] += 1
+                    return pending.popleft()
+
+        def finish(error):
+            with cond:
+                outstanding[0] -= 1
+                if error is not None:
+                    errors.append(error)
+                cond.notify_all()
+
+        def helper(_):
+            while pending and not errors:
+                claimed = []
+
+                # Claims an item only once it holds a slot, and keeps it if
+                # the retry policy runs this again.
+                def attempt(_):
+                    if not claimed:
+                        claimed.append(claim())
+                    if claimed[0] is not None:
+                        i, item = claimed[0]
+                        results[i] = func(item)
+
+                error = None
+                try:
+                    self.limited(attempt, operation)(None)
+                except BaseException as e:
+                    error = e
+                if not claimed or claimed[0] is None:
+                    return
+                finish(error)
+
+        try:
+            for item in items:
+                with cond:
+                    pending.append((len(results), item))
+                    results.append(None)
+                self.submit(helper, None)
+        except BaseException as e:
+            with cond:
+                errors.append(e)
+
+        while True:
+            claimed = claim()
+            if claimed is None:
+                break
+            i, item = claimed
+            error = None
+            try:
+                results[i] = self.retry.call(self._retry_classifier(operation, item), func, item, operation)
+            except BaseException as e:
+                error = e
+            finish(error)
+
+        with cond:
+            while outstanding[0]:
+                cond.wait()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def _list_candidate_node_pages(self, names=None):
+        yield self.connection.list_nodes()
+
+    def _get_relevant_node_pages(self, names=None):
+        for page in self._list_candidate_node_pages(names):
+            yield [node for node in page
+                   if (names is None or node.name in names) and self._is_node_relevant(node)]
+
+    def live_node_ids(self, names):
+        # A cheap liveness probe: list the named nodes without converting
+        # them or looking up their volumes and firewalls.
+        ids = set()
+        for page in self._get_relevant_node_pages(names):
+            ids.update(node.id for node in page)
+        return ids
+
+    def live_security_group_names(self, names):
+        # The same sort of probe for security groups.
+        security_groups, security_group_rules = self.detect_firewalls(names)
+        return set(security_group.name for security_group in security_groups)
+
+    def _get_relevant_nodes(self, names=None):
+        for page in self._get_relevant_node_pages(names):
+            for node in page:
                 yield node
 
-    def detect_resources(self):
+    def detect_resources(self, desired=None):
         collection = cloud_models.Collection()
-
-        LOG.info('Detecting nodes')
-        for node in self.detect_nodes():
+        security_group_names = None
+
+        if desired is None:
+            LOG.info('Detecting nodes, security groups and security group rules')
+            node_names = None
+        else:
+            node_names = set(node.name for node in desired.nodes)
+            security_group_names = set(security_group.name for security_group in desired.security_groups)
+            LOG.info('Detecting %d nodes and %d security groups' % (len(node_names), len(security_group_names)))
+
+        results = {}
+        scheduler = self.get_scheduler()
+        for name, func, requires in self._detection_stages(node_names, security_group_names):
+            scheduler.add(name, self.limited(self._detection_stage(name, func, results), 'detect_%s' % (name,)), None,
+                          requires=requires)
+        scheduler.run()
+
+        for node in self._convert_nodes(results['nodes']):
             collection.nodes.add(node)
 
-        LOG.info('Detecting security groups and security group rules')
-
-        security_groups, security_group_rules = self.detect_firewalls()
+        security_groups, security_group_rules = results['firewalls']
 
         for security_group in security_groups:
-            collection.security_groups.add(security_group)
+            if security_group_names is None or security_group.name in security_group_names:
+                collection.security_groups.add(security_group)
 
         for security_group_rule in security_group_rules:
-            collection.security_group_rules.add(security_group_rule)
+            if security_group_names is None or security_group_rule.security_group.name in security_group_names:
+                collection.security_group_rules.add(security_group_rule)
 
         collection.connect()
 
         return collection
 
+    def _detection_stages(self, node_names=None, security_group_names=None):
+        # Each stage is a (name, func, requires) tuple. func gets the results
+        # of the stages finished so far. detect_resources builds the
+        # collection from the 'nodes' and 'firewalls' results.
+        # Each page's volumes are looked up while the next page is listed.
+        def list_nodes(results):
+            nodes = []
+
+            def pages():
+                for page in self._get_relevant_node_pages() if node_names is None else self._get_relevant_node_pages(node_names):
+                    nodes.extend(page)
+                    yield page
+
+            self.map_concurrently(self._prefetch_volumes, pages(), 'list_volumes')
+            return nodes
+
+        def detect_firewalls(results):
+            return self.detect_firewalls() if security_group_names is None else self.detect_firewalls(security_group_names)
+
+        return [('nodes', list_nodes, ()),
+                ('firewalls', detect_firewalls, ())]
+
+    def _detection_stage(self, name, func, results):
+        def run(_):
+            LOG.info('Detecting %s' % (name,))
+            started_at = time.time()
+            results[name] = func(results)
+            LOG.info('Detected %s in %.2fs' % (name, time.time() - started_at))
+        return run
+
     def apply_mappings(self, obj_type, name):
         return self.mappings.get(obj_type, {}).get(name, name)
 
@@ -81,14 +336,279 @@ class CloudDriver(object):
         if self.cluster:
             self.cluster.update(json=self.cluster_json(collection))
 
-    def apply_resources(self, collection):
+    @property
+    def pool(self):
+        # Only made when first needed, since the asyncio engine runs its
+        # tasks on the executor instead.
+        if self._pool is None:
+            self._pool = ThreadPool(THREADS)
+        return self._pool
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(THREADS)
+        return self._executor
+
+    def submit(self, func, arg):
+        # Runs func(arg) on the worker threads of the chosen engine, so that
+        # --threads applies under asyncio too. Returns a function that waits
+        # for the result.
+        if self.engine == 'asyncio':
+            future = self.executor.submit(func, arg)
+            return lambda: future.result()
+        result = self.pool.apply_async(func, (arg,))
+        return lambda: result.get()
+
+    @property
+    def provider_name(self):
+        return getattr(self, 'name', None) or self.__class__.__name__
+
+    def is_throttling_error(self, exc):
+        return isinstance(exc, RateLimitReachedError) or 429 in (getattr(exc, 'code', None), getattr(exc, 'http_code', None))
+
+    def is_transient_error(self, exc):
+        codes = (getattr(exc, 'code', None), getattr(exc, 'http_code', None))
+        if any(isinstance(code, int) and 500 <= code < 600 for code in codes):
+            return True
+        return isinstance(exc, (ConnectionError, Timeout, socket.timeout))
+
+    def classify_error(self, exc):
+        if self.is_throttling_error(exc):
+            return THROTTLING
+        if self.is_transient_error(exc):
+            return TRANSIENT
+        return PERMANENT
+
+    def _is_throttled(self, exc, operation):
+        throttled = self.is_throttling_error(exc)
+        if throttled and self.metrics is not None:
+            self.metrics.throttled(self.provider_name, operation)
+        return throttled
+
+    def _retry_classifier(self, operation, arg):
+        # Throttled requests have been retried by the time they get here,
+        # and re-running the operation could repeat whatever got through.
+        # Nor can a launch be retried without a key that lets the provider
+        # tell it from a new one.
+        nodes = isinstance(arg, (list, tuple)) and arg or [arg]
+        unkeyed = operation in LAUNCH_OPERATIONS and self.idempotency_key(nodes) is None
+
+        def classify_error(exc):
+            kind = self.classify_error(exc)
+            if kind == THROTTLING or unkeyed:
+                return PERMANENT
+            return kind
+        return classify_error
+
+    def limited(self, func, operation=None):
+        operation = operation or func.__name__
+        op_class = operation_class(operation)
+        metrics = self.metrics
+        profiler = self.profiler
+
+        # The limiter bounds concurrency per operation class; the retry
+        # policy covers transient failures.
+        def call(arg):
+            attempts = [0]
+
+            def counted(arg, queued):
+                if profiler is not None:
+                    profiler.record('limiter', wall_time() - queued)
+                if attempts[0] and metrics is not None:
+                    metrics.retried(self.provider_name, operation)
+                attempts[0] += 1
+                return func(arg)
+
+            def attempt(arg):
+                return self.limiter.call(self.provider_name, op_class, counted, arg, wall_time())
+
+            previous = self.current_operation()
+            self.locals.operation = operation
+            try:
+                with metrics is not None and metrics.operation(operation) or NO_CONTEXT:
+                    with profiler is not None and profiler.task(operation) or NO_CONTEXT:
+                        return self.retry.call(self._retry_classifier(operation, arg), attempt, arg, operation)
+            finally:
+                self.locals.operation = previous
+
+        call.__name__ = operation
+        return call
+
+    def _log_limiter_state(self):
+        for name, state in sorted(self.limiter.state().items()):
+            LOG.info('Concurrency for %s: %d (%d calls, %d throttled)' % (name, state['limit'], state['successes'], state['throttles']))
+
+    def get_scheduler(self):
+        if self.engine == 'asyncio':
+            from aasemble.deployment.cloud.aio import AsyncioScheduler
+            return AsyncioScheduler(self.executor, self.operation_limits)
+        return Scheduler(self.pool)
+
+    def _security_group_key(self, name):
+        return ('security_group', name)
+
+    def _node_key(self, node):
+        return ('node', node.name)
+
+    def _security_group_rule_key(self, security_group_rule):
+        return ('security_group_rule', security_group_rule)
+
+    def _security_group_rule_requires(self, security_group_rule):
+        requires = [self._security_group_key(security_group_rule.security_group.name)]
+        if security_group_rule.source_group:
+            requires.append(self._security_group_key(security_group_rule.source_group))
+        return requires
+
+    def _node_batch_spec(self, node):
+        return (node.flavor, node.image, node.disk, node.script,
+                tuple(sorted(sg.name for sg in node.security_groups)))
+
+    def batch_nodes(self, nodes):
+        specs = []
+        batches = {}
+        for node in sorted(nodes, key=lambda node: node.name):
+            spec = self._node_batch_spec(node)
+            if spec not in batches:
+                specs.append(spec)
+                batches[spec] = []
+            batches[spec].append(node)
+
+        for spec in specs:
+            batch = batches[spec]
+            for i in range(0, len(batch), self.max_node_batch_size):
+                yield batch[i:i + self.max_node_batch_size]
+
+    def create_nodes(self, nodes):
+        for node in nodes:
+            self.create_node(node)
+
+    def batch_security_group_rules(self, security_group_rules):
+        names = []
+        batches = {}
+        for security_group_rule in security_group_rules:
+            name = security_group_rule.security_group.name
+            if name not in batches:
+                names.append(name)
+                batches[name] = []
+            batches[name].append(security_group_rule)
+
+        for name in names:
+            batch = batches[name]
+            for i in range(0, len(batch), self.max_security_group_rule_batch_size):
+                yield batch[i:i + self.max_security_group_rule_batch_size]
+
+    def create_security_group_rules(self, security_group_rules):
+        for security_group_rule in security_group_rules:
+            self.create_security_group_rule(security_group_rule)
+
+    def _desired_node_value(self, node, field):
+        if field == 'flavor':
+            return self.apply_mappings('flavors', node.flavor)
+        if field == 'image':
+            return self.apply_mappings('images', node.image)
+        return cloud_plan.node_value(node, field)
+
+    def plan(self, desired, current, prune=False):
+        return cloud_plan.diff(desired, current,
+                               fields=self.node_plan_fields,
+                               update_fields=self.node_update_fields,
+                               desired_value=self._desired_node_value,
+                               prune=prune)
+
+    def _schedule_creations(self, scheduler, collection, replaced=()):
+        for security_group in collection.security_groups:
+            scheduler.add(self._security_group_key(security_group.name),
+                          self.limited(self.create_security_group), security_group)
+
+        for batch in self.batch_nodes(collection.nodes):
+            requires = set(self._security_group_key(sg.name) for node in batch for sg in node.security_groups)
+            requires.update(self._delete_key(self._node_key(node)) for node in batch if node.name in replaced)
+            if len(batch) == 1:
+                scheduler.add(self._node_key(batch[0]), self.limited(self.create_node), batch[0], requires=requires)
+            else:
+                scheduler.add(('nodes', tuple(node.name for node in batch)), self.limited(self.create_nodes), batch,
+                              requires=requires)
+
+        for batch in self.batch_security_group_rules(collection.security_group_rules):
+            requires = set(key for security_group_rule in batch for key in self._security_group_rule_requires(security_group_rule))
+            if len(batch) == 1:
+                scheduler.add(self._security_group_rule_key(batch[0]),
+                              self.limited(self.create_security_group_rule), batch[0], requires=requires)
+            else:
+                scheduler.add(('security_group_rules', tuple(batch)),
+                              self.limited(self.create_security_group_rules), batch, requires=requires)
+
+    def _run_apply(self, scheduler):
+        try:
+            try:
+                result = scheduler.run()
+            except exceptions.ResourcesFailedException as e:
+                # Launches that did go out still need seeing through, and
+                # whatever goes wrong with them belongs in the same report.
+                try:
+                    self.wait_for_operations()
+                except Exception as wait_exc:
+                    raise exceptions.ResourcesFailedException(list(e.failures) + [(('wait_for_operations',), wait_exc)],
+                                                              e.skipped)
+                raise
+            self.wait_for_operations()
+            return result
+        finally:
+            self._log_limiter_state()
+
+    def idempotency_key(self, nodes, generation=0):
+        # The same for every launch of these nodes from this stack, so the
+        # provider can tell a retried or concurrent launch from a new one.
+        # Later generations are for when the provider remembers a launch
+        # whose instances have since been deleted.
+        if self.stack_fingerprint is None:
+            return None
+        parts = [self.namespace, [node.name for node in nodes], self.stack_fingerprint]
+        if generation:
+            parts.append(generation)
+        return cache.cache_key(*parts)
+
+    def apply_resources(self, collection, stack_fingerprint=None):
+        self.stack_fingerprint = stack_fingerprint
         self.update_cluster(collection)
-        self.pool.map(self.create_security_group, collection.security_groups)
-        self.pool.map(self.create_node, collection.nodes)
-        self.pool.map(self.create_security_group_rule, collection.security_group_rules)
+
+        scheduler = self.get_scheduler()
+        self._schedule_creations(scheduler, collection)
+        return self._run_apply(scheduler)
+
+    def apply_plan(self, plan, stack_fingerprint=None):
+        self.stack_fingerprint = stack_fingerprint
+        creations = plan.creations()
+        deletions = plan.deletions()
+        self.update_cluster(creations)
+
+        scheduler = self.get_scheduler()
+
+        # Nodes leaving a group must have left it before the group goes.
+        updated_by_security_group = {}
+        for change in plan.select(cloud_plan.UPDATE, 'node'):
+            key = self._update_key(change)
+            requires = set(self._security_group_key(sg.name) for sg in change.desired.security_groups)
+            scheduler.add(key, self.limited(self.update_node), change, requires=requires)
+            for security_group in change.current.security_groups:
+                updated_by_security_group.setdefault(security_group.name, []).append(key)
+
+        self._schedule_deletions(scheduler, deletions, self._delete_key, updated_by_security_group)
+        self._schedule_creations(scheduler, creations, replaced=set(node.name for node in deletions.nodes))
+        return self._run_apply(scheduler)
+
+    def wait_for_operations(self):
+        pass
 
     def delete_node(self, node):
-        self.connection.destroy_node(node.private)
+        try:
+            provider_node = self.provider_node(node)
+        except exceptions.NodeNotFoundException:
+            LOG.info('Node %s is already gone' % (node.name,))
+            return
+        self.connection.destroy_node(provider_node)
 
     def delete_security_group(self, security_group):
         pass
@@ -96,10 +616,42 @@ class CloudDriver(object):
     def delete_security_group_rule(self, security_group_rule):
         pass
 
+    def _delete_key(self, key):
+        return ('delete',) + key
+
+    def _update_key(self, change):
+        return ('update',) + self._node_key(change.desired)
+
+    def _schedule_deletions(self, scheduler, collection, key=lambda key: key, security_group_requires=None):
+        rules_by_security_group = {}
+
+        def node_keys(security_group_name):
+            return [key(self._node_key(node)) for node in collection.nodes.lookup('security_group', security_group_name)]
+
+        for node in collection.nodes:
+            scheduler.add(key(self._node_key(node)), self.limited(self.delete_node), node)
+
+        for security_group_rule in collection.security_group_rules:
+            rule_key = key(self._security_group_rule_key(security_group_rule))
+            scheduler.add(rule_key, self.limited(self.delete_security_group_rule), security_group_rule,
+                          requires=node_keys(security_group_rule.security_group.name))
+            for name in self._security_group_rule_requires(security_group_rule):
+                rules_by_security_group.setdefault(key(name), []).append(rule_key)
+
+        for security_group in collection.security_groups:
+            group_key = key(self._security_group_key(security_group.name))
+            requires = node_keys(security_group.name) + rules_by_security_group.get(group_key, [])
+            requires += (security_group_requires or {}).get(security_group.name, [])
+            scheduler.add(group_key, self.limited(self.delete_security_group), security_group, requires=requires)
+
     def clean_resources(self, collection):
-        self.pool.map(self.delete_node, collection.nodes)
-        self.pool.map(self.delete_security_group_rule, collection.security_group_rules)
-        self.pool.map(self.delete_security_group, collection.security_groups)
+        scheduler = self.get_scheduler()
+        self._schedule_deletions(scheduler, collection)
+
+        try:
+            return scheduler.run()
+        finally:
+            self._log_limiter_state()
 
     def expand_path(self, path):
         return os.path.expanduser(path)
@@ -107,6 +659,35 @@ class CloudDriver(object):
     def _get_resource_by_attr(self, f, attr, match):
         return [x for x in f() if getattr(x, attr) == match][0]
 
+    def _record(self, obj, attrs, extra_keys=()):
+        record = dict((attr, getattr(obj, attr)) for attr in attrs)
+        record['extra'] = dict((k, obj.extra[k]) for k in extra_keys if k in obj.extra)
+        return record
+
+    def _fetch_sizes(self):
+        return [self._record(size, ('id', 'name', 'ram', 'disk', 'bandwidth', 'price'))
+                for size in self.connection.list_sizes()]
+
+    def _fetch_images(self):
+        return [self._record(image, ('id', 'name'), self.image_extra_keys)
+                for image in self.connection.list_images()]
+
+    def _fetch_locations(self):
+        return [self._record(location, ('id', 'name', 'country'))
+                for location in self.connection.list_locations()]
+
+    def get_catalog_size(self, attr, value):
+        return NodeSize(driver=self.connection, **self.catalog.get('sizes', attr, value, self._fetch_sizes))
+
+    def get_catalog_location(self, attr, value):
+        return NodeLocation(driver=self.connection, **self.catalog.get('locations', attr, value, self._fetch_locations))
+
+    def get_catalog_images(self):
+        return [NodeImage(driver=self.connection, **record) for record in self.catalog.records('images', self._fetch_images)]
+
+    def get_catalog_image(self, attr, value):
+        return NodeImage(driver=self.connection, **self.catalog.get('images', attr, value, self._fetch_images))
+
     def find_key_pair_by_fingerprint(self, fingerprint):
         return self._get_resource_by_attr(self.connection.list_key_pairs, 'fingerprint', fingerprint)
 
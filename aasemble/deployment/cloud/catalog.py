@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+
+from aasemble.deployment import cache
+
+LOG = logging.getLogger(__name__)
+
+INDEXED_ATTRS = ('id', 'name')
+
+
+class Catalog(object):
+    def __init__(self, path=None, ttl=0):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.kind_locks = {}
+        self.catalogs = {}
+        self.indexes = {}
+        self.fetched = set()
+
+        if self.path and self.ttl:
+            self._load()
+
+    def _load(self):
+        data = cache.load(self.path) or {}
+        for kind, catalog in data.items():
+            if cache.is_fresh(catalog.get('fetched_at'), self.ttl):
+                LOG.debug('Using cached %s catalog from %s' % (kind, self.path))
+                self._store(kind, catalog['records'], catalog['fetched_at'])
+
+    def _save(self):
+        if self.path and self.ttl:
+            # Saves are serialized and each takes its copy once it has the
+            # file, so an older copy can never be the one left on disk.
+            with self.save_lock:
+                with self.lock:
+                    data = dict(self.catalogs)
+                cache.save(self.path, data)
+
+    def _kind_lock(self, kind):
+        with self.lock:
+            return self.kind_locks.setdefault(kind, threading.Lock())
+
+    def _store(self, kind, records, fetched_at):
+        indexes = dict((attr, {}) for attr in INDEXED_ATTRS)
+        for record in records:
+            for attr in INDEXED_ATTRS:
+                if record.get(attr) is not None:
+                    indexes[attr][str(record[attr])] = record
+
+        with self.lock:
+            self.catalogs[kind] = {'fetched_at': fetched_at, 'records': records}
+            self.indexes[kind] = indexes
+
+    def records(self, kind, fetch):
+        with self._kind_lock(kind):
+            self._ensure(kind, fetch)
+            return self.catalogs[kind]['records']
+
+    def get(self, kind, attr, value, fetch):
+        with self._kind_lock(kind):
+            record = self.indexes.get(kind, {}).get(attr, {}).get(str(value))
+
+            # A catalog loaded from disk may predate the resource we're after,
+            # so go to the provider once before giving up.
+            if record is None and kind not in self.fetched:
+                self._fetch(kind, fetch)
+                record = self.indexes[kind][attr].get(str(value))
+
+        if record is None:
+            raise KeyError('%s with %s %r not found' % (kind, attr, value))
+        return record
+
+    def _ensure(self, kind, fetch):
+        if kind not in self.catalogs:
+            self._fetch(kind, fetch)
+
+    def _fetch(self, kind, fetch):
+        LOG.debug('Fetching %s catalog' % (kind,))
+        self._store(kind, list(fetch()), time.time())
+        self.fetched.add(kind)
+        self._save()
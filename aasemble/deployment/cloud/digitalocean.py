@@ -1,7 +1,9 @@
+import json
 import logging
 
 from libcloud.compute.types import Provider
 from libcloud.utils.publickey import get_pubkey_openssh_fingerprint
+from libcloud.utils.py3 import parse_qs, urlparse
 
 import aasemble.deployment.cloud.models as cloud_models
 import aasemble.deployment.exceptions as exceptions
@@ -9,16 +11,25 @@ from aasemble.deployment.cloud.base import CloudDriver
 
 LOG = logging.getLogger(__name__)
 
+MULTI_CREATE_MAX_COUNT = 10
+DROPLETS_PAGE_SIZE = 200
+IDEMPOTENCY_TAG_PREFIX = 'aasemble-launch-'
+
 
 class DigitalOceanDriver(CloudDriver):
     provider = Provider.DIGITAL_OCEAN
     name = 'Digital Ocean'
+    image_extra_keys = ('distribution',)
+    # Droplets report image ids and get their disk from the size, and the
+    # firewall lives in the cluster data rather than on the droplet.
+    node_plan_fields = ('flavor',)
+    max_node_batch_size = MULTI_CREATE_MAX_COUNT
 
     def __init__(self, *args, **kwargs):
         self.location = kwargs.pop('location')
         self.api_key = kwargs.pop('api_key')
         self.ssh_key_file = kwargs.pop('ssh_key_file', None)
-        self._size_cache = {}
+        self._key_fingerprint = None
         super(DigitalOceanDriver, self).__init__(*args, **kwargs)
 
     @classmethod
@@ -37,15 +48,28 @@ class DigitalOceanDriver(CloudDriver):
     def get_namespace(self, node):  # pragma: nocover
         return None
 
+    def _list_candidate_node_pages(self, names=None):
+        params = {'per_page': DROPLETS_PAGE_SIZE}
+
+        while True:
+            response = self.connection.connection.request('/v2/droplets', params=params).object
+            yield [self.connection._to_node(droplet) for droplet in response['droplets']]
+
+            next_page = response.get('links', {}).get('pages', {}).get('next')
+            if not next_page:
+                break
+            params['page'] = parse_qs(urlparse.urlparse(next_page).query)['page'][0]
+
     def _is_node_relevant(self, node):
         if node.state in ('off',):
             return False
         return super(DigitalOceanDriver, self)._is_node_relevant(node)
 
     def get_size(self, size_name):
-        if size_name not in self._size_cache:
-            self._size_cache[size_name] = self._get_resource_by_attr(self.connection.list_sizes, 'name', size_name)
-        return self._size_cache[size_name]
+        return self.get_catalog_size('name', size_name)
+
+    def _fetch_provider_node(self, node):
+        return self.connection.ex_get_node_details(node.private.id)
 
     def _aasemble_node_from_provider_node(self, donode):
         node = cloud_models.Node(name=donode.name,
@@ -57,9 +81,18 @@ class DigitalOceanDriver(CloudDriver):
         node.security_group_names = set()
         return node
 
-    def detect_firewalls(self):
+    def _detection_stages(self, node_names=None, security_group_names=None):
+        # Converting droplets needs the size catalog, so have it ready by then.
+        return super(DigitalOceanDriver, self)._detection_stages(node_names, security_group_names) + \
+            [('sizes', lambda results: self.catalog.records('sizes', self._fetch_sizes), ())]
+
+    def detect_firewalls(self, names=None):
         return set(), set()
 
+    def live_security_group_names(self, names):
+        # Security groups here only live in the cluster's firewall config.
+        return set(names)
+
     def get_distribution_by_image(self, image):
         return image.extra['distribution']
 
@@ -71,7 +104,7 @@ class DigitalOceanDriver(CloudDriver):
                                                    name=self.get_name_by_image)
         matcher = matcher_factory(spec)
 
-        for image in self.connection.list_images():
+        for image in self.get_catalog_images():
             if matcher(image):
                 return image
 
@@ -89,11 +122,9 @@ class DigitalOceanDriver(CloudDriver):
         return self.get_size(self.apply_mappings('flavors', flavor))
 
     def _get_location(self, location_name):
-        return self._get_resource_by_attr(self.connection.list_locations, 'id', location_name)
-
-    def create_node(self, node):
-        LOG.info('Launching node: %s' % (node.name))
+        return self.get_catalog_location('id', location_name)
 
+    def _launch_kwargs(self, node):
         image = self._get_image(node.image)
         size = self._get_size(node.flavor)
         location = self._get_location(self.location)
@@ -106,16 +137,77 @@ class DigitalOceanDriver(CloudDriver):
         self._add_key_pair_info(kwargs)
         self._add_script_info(node, kwargs)
 
+        return kwargs
+
+    def _idempotency_tag(self, nodes):
+        key = self.idempotency_key(nodes)
+        return key and IDEMPOTENCY_TAG_PREFIX + key
+
+    def _launched_droplets(self, tag):
+        # Droplet names aren't unique, so every launch is tagged with its
+        # idempotency key and checked for before launching again.
+        if tag is None:
+            return {}
+        params = {'tag_name': tag, 'per_page': DROPLETS_PAGE_SIZE}
+        response = self.connection.connection.request('/v2/droplets', params=params).object
+        return dict((donode.name, donode) for donode in
+                    (self.connection._to_node(data) for data in response['droplets']))
+
+    def create_node(self, node):
+        LOG.info('Launching node: %s' % (node.name))
+
+        tag = self._idempotency_tag([node])
+        launched = self._launched_droplets(tag)
+        if node.name in launched:
+            node.private = launched[node.name]
+            LOG.info('Node already launched: %s' % (node.name,))
+            return
+
+        kwargs = self._launch_kwargs(node)
+        if tag is not None:
+            kwargs.setdefault('ex_create_attr', {})['tags'] = [tag]
         node.private = self.connection.create_node(**kwargs)
 
         LOG.info('Launched node: %s' % (node.name,))
 
+    def create_nodes(self, nodes):
+        if len(nodes) == 1:
+            return self.create_node(nodes[0])
+
+        LOG.info('Launching %d nodes: %s' % (len(nodes), ', '.join(node.name for node in nodes)))
+
+        tag = self._idempotency_tag(nodes)
+        donodes = self._launched_droplets(tag)
+        names = [node.name for node in nodes if node.name not in donodes]
+
+        if names:
+            kwargs = self._launch_kwargs(nodes[0])
+            attr = {'names': names,
+                    'size': kwargs['size'].name,
+                    'image': kwargs['image'].id,
+                    'region': kwargs['location'].id,
+                    'user_data': kwargs.get('ex_user_data')}
+            attr.update(kwargs.get('ex_create_attr', {}))
+            if tag is not None:
+                attr['tags'] = [tag]
+
+            res = self.connection.connection.request('/v2/droplets', data=json.dumps(attr), method='POST')
+            donodes.update((donode.name, donode) for donode in
+                           (self.connection._to_node(data) for data in res.object['droplets']))
+
+        for node in nodes:
+            node.private = donodes[node.name]
+
+        LOG.info('Launched nodes: %s' % (', '.join(node.name for node in nodes)))
+
     def _add_key_pair_info(self, kwargs):
         if self.ssh_key_file:
-            with open(self.expand_path(self.ssh_key_file), 'r') as fp:
-                if 'ex_create_attr' not in kwargs:
-                    kwargs['ex_create_attr'] = {}
-                kwargs['ex_create_attr']['ssh_keys'] = [self.find_or_import_keypair_by_key_material(fp.read().rstrip())['keyFingerprint']]
+            if self._key_fingerprint is None:
+                with open(self.expand_path(self.ssh_key_file), 'r') as fp:
+                    self._key_fingerprint = self.find_or_import_keypair_by_key_material(fp.read().rstrip())['keyFingerprint']
+            if 'ex_create_attr' not in kwargs:
+                kwargs['ex_create_attr'] = {}
+            kwargs['ex_create_attr']['ssh_keys'] = [self._key_fingerprint]
 
     def _add_script_info(self, node, kwargs):
         if node.script is not None:
@@ -157,12 +249,9 @@ class DigitalOceanDriver(CloudDriver):
                                                    'destination': url.destination}
                 backends.add(url.destination.split('/')[0])
 
-        for node in collection.nodes:
-            for sg in node.security_groups:
-                if sg.name not in fwconf['security_groups']:
-                    fwconf['security_groups'][sg.name] = {'nodes': [],
-                                                          'rules': []}
-                fwconf['security_groups'][sg.name]['nodes'].append(node.name)
+        for sg_name in collection.nodes.index_keys('security_group'):
+            fwconf['security_groups'][sg_name] = {'nodes': [node.name for node in collection.nodes.lookup('security_group', sg_name)],
+                                                  'rules': []}
 
         for sgr in collection.security_group_rules:
             rule = {}
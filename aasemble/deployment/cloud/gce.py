@@ -1,27 +1,130 @@
 import json
 import logging
+import re
+import threading
+import time
+import uuid
 
-from libcloud.common.google import ResourceExistsError
+from libcloud.common.google import GoogleBaseError, ResourceExistsError, ResourceNotFoundError
 from libcloud.compute.types import Provider
 
 import aasemble.deployment.cloud.models as cloud_models
+from aasemble.deployment import exceptions
 from aasemble.deployment.cloud.base import CloudDriver
 
 LOG = logging.getLogger(__name__)
 
+THROTTLING_ERROR_CODES = ('rateLimitExceeded', 'userRateLimitExceeded')
+TRANSIENT_ERROR_CODES = ('backendError', 'internalError', 'resourceNotReady')
+BULK_INSERT_MAX_COUNT = 1000
+TRACKED_OPERATION_TYPES = ('insert', 'bulkInsert')
+NAMESPACE_LABEL = 'aasemble_namespace'
+MAX_FILTER_NAMES = 50
+MAX_REQUEST_ID_GENERATIONS = 5
+DISK_TYPE = 'pd-ssd'
+DISK_LINK_RE = re.compile('zones/(?P<zone>[^/]+)/disks/(?P<name>[^/]+)$')
+
+
+class OperationTracker(object):
+    def __init__(self, driver, interval=2.0, timeout=900, sleep=time.sleep):
+        self.driver = driver
+        self.interval = interval
+        self.timeout = timeout
+        self.sleep = sleep
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, zone, operation, nodes):
+        for node in nodes:
+            node.server_status = 'PENDING'
+
+        with self.lock:
+            self.pending[(zone, operation['name'])] = nodes
+
+    def poll(self):
+        with self.lock:
+            zones = sorted(set(zone for zone, name in self.pending))
+
+        finished = []
+        failures = []
+
+        # One listing per zone covers every operation we're waiting for there.
+        for zone in zones:
+            for operation in self.driver.list_zone_operations(zone):
+                if operation.get('status') != 'DONE':
+                    continue
+
+                with self.lock:
+                    nodes = self.pending.pop((zone, operation['name']), None)
+
+                if nodes is None:
+                    continue
+
+                if 'error' in operation:
+                    message = '; '.join(error.get('message', error.get('code', '')) for error in operation['error'].get('errors', []))
+                    for node in nodes:
+                        node.server_status = 'FAILED'
+                        LOG.error('Failed to launch node %s: %s' % (node.name, message))
+                    failures.append('%s: %s' % (', '.join(node.name for node in nodes), message))
+                else:
+                    for node in nodes:
+                        node.server_status = 'DONE'
+                        LOG.info('Launched node: %s' % (node.name,))
+                    finished += nodes
+
+        return finished, failures
+
+    def wait(self):
+        deadline = time.time() + self.timeout
+        finished = []
+        failures = []
+
+        while self.pending:
+            done, failed = self.poll()
+            finished += done
+            failures += failed
+
+            if not self.pending:
+                break
+
+            if time.time() > deadline:
+                with self.lock:
+                    names = sorted(node.name for nodes in self.pending.values() for node in nodes)
+                    self.pending = {}
+                raise exceptions.ProvisionTimedOutException('Timed out waiting for: %s' % (', '.join(names),))
+
+            self.sleep(self.interval)
+
+        if failures:
+            raise exceptions.ProvisionFailedException('; '.join(failures))
+
+        return finished
+
 
 class GCEDriver(CloudDriver):
     provider = Provider.GCE
     name = 'Google Compute Engine'
+    image_extra_keys = ('selfLink',)
+    # Detected images are plain names, the stack's may be families.
+    node_plan_fields = ('flavor', 'disk', 'script', 'security_groups')
+    node_update_fields = ('security_groups',)
 
     def __init__(self, *args, **kwargs):
         self.gce_key_file = kwargs.pop('gce_key_file')
         self.location = kwargs.pop('location')
         self.username = kwargs.pop('username', 'ubuntu')
         self.ssh_key_file = kwargs.pop('ssh_key_file', None)
+        self.bulk_insert = kwargs.pop('bulk_insert', False)
+        self.track_operations = kwargs.pop('track_operations', False)
+        self.operation_tracker = self.track_operations and OperationTracker(self) or None
         self._volume_size_map = None
+        self._volume_image_map = {}
+        self._unlabelled_instances = {}
         super(GCEDriver, self).__init__(*args, **kwargs)
 
+        if self.bulk_insert:
+            self.max_node_batch_size = BULK_INSERT_MAX_COUNT
+
     @classmethod
     def get_kwargs_from_cloud_config(cls, cfgparser):
         kwargs = {'gce_key_file': cfgparser.get('connection', 'key_file'),
@@ -33,6 +136,12 @@ class GCEDriver(CloudDriver):
         if cfgparser.has_option('connection', 'sshkey'):
             kwargs['ssh_key_file'] = cfgparser.get('connection', 'sshkey')
 
+        if cfgparser.has_option('connection', 'bulk_insert'):
+            kwargs['bulk_insert'] = cfgparser.getboolean('connection', 'bulk_insert')
+
+        if cfgparser.has_option('connection', 'track_operations'):
+            kwargs['track_operations'] = cfgparser.getboolean('connection', 'track_operations')
+
         return kwargs
 
     def _get_driver_args_and_kwargs(self):
@@ -42,42 +151,199 @@ class GCEDriver(CloudDriver):
                 {'project': key_data['project_id'],
                  'datacenter': self.location})
 
-    @property
-    def volume_size_map(self):
+    def is_throttling_error(self, exc):
+        if isinstance(exc, GoogleBaseError) and exc.code in THROTTLING_ERROR_CODES:
+            return True
+        return super(GCEDriver, self).is_throttling_error(exc)
+
+    def is_transient_error(self, exc):
+        if isinstance(exc, GoogleBaseError) and exc.code in TRANSIENT_ERROR_CODES:
+            return True
+        return super(GCEDriver, self).is_transient_error(exc)
+
+    def _boot_disk_link(self, instance):
+        return instance['disks'][0]['source']
+
+    def _fetch_disks(self, links):
+        names_by_zone = {}
+        for link in set(links):
+            match = DISK_LINK_RE.search(link)
+            if match:
+                names_by_zone.setdefault(match.group('zone'), []).append(match.group('name'))
+
+        queries = []
+        for zone, names in sorted(names_by_zone.items()):
+            names = sorted(names)
+            for i in range(0, len(names), MAX_FILTER_NAMES):
+                queries.append((zone, self._name_filter(names[i:i + MAX_FILTER_NAMES])))
+
+        def fetch(query):
+            zone, name_filter = query
+            return [(zone, disk) for disk in self._paginate('/zones/%s/disks' % (zone,), {'filter': name_filter})]
+
         if self._volume_size_map is None:
             self._volume_size_map = {}
-            for volume in self.connection.list_volumes():
-                self._volume_size_map[volume.extra['selfLink']] = volume.size
-        return self._volume_size_map
+
+        for disks in self.map_concurrently(fetch, queries, 'list_disks'):
+            for zone, disk in disks:
+                self._volume_size_map[disk['selfLink']] = int(disk['sizeGb'])
+                self._volume_image_map[disk['selfLink']] = disk.get('sourceImage')
+
+    def _boot_volume_ref(self, gcenode):
+        return self._boot_disk_link(gcenode.extra)
+
+    def _fetch_provider_node(self, node):
+        return self.connection.ex_get_node(node.name, self.location)
+
+    def _volume_size(self, link):
+        if self._volume_size_map is None or link not in self._volume_size_map:
+            self._fetch_disks([link])
+        return self._volume_size_map[link]
 
     def get_namespace(self, node):
-        if 'metadata' not in node.private.extra:
-            return None
+        return self._metadata_namespace(node.private.extra.get('metadata'))
 
-        if 'items' not in node.private.extra['metadata']:
+    def _metadata_namespace(self, metadata):
+        if not metadata or 'items' not in metadata:
             return None
 
-        for x in node.private.extra['metadata']['items']:
+        for x in metadata['items']:
             if x['key'] == 'aasemble_namespace':
                 return x['value']
 
+    def _is_node_relevant(self, gcenode):
+        # Listings hand us libcloud's nodes, not our own.
+        return self.namespace is None or self._metadata_namespace(gcenode.extra.get('metadata')) == self.namespace
+
+    @property
+    def namespace_label(self):
+        if self.namespace is not None:
+            return re.sub('[^a-z0-9_-]', '-', self.namespace.lower())[:63]
+
+    def _name_filter(self, names):
+        return '(%s)' % (' OR '.join('(name = "%s")' % (name,) for name in names),)
+
+    def _instance_filters(self, names=None, labelled=True):
+        expressions = []
+        if self.namespace is not None:
+            if labelled:
+                expressions.append('(labels.%s = "%s")' % (NAMESPACE_LABEL, self.namespace_label))
+            else:
+                expressions.append('(NOT labels.%s:*)' % (NAMESPACE_LABEL,))
+
+        if names is None:
+            return [' AND '.join(expressions)]
+
+        names = sorted(names)
+        return [' AND '.join(expressions + [self._name_filter(names[i:i + MAX_FILTER_NAMES])])
+                for i in range(0, len(names), MAX_FILTER_NAMES)]
+
+    def _instance_pages(self, names=None, labelled=True):
+        for instance_filter in self._instance_filters(names, labelled):
+            params = instance_filter and {'filter': instance_filter} or {}
+            for instances in self._paginate_pages('/zones/%s/instances' % (self.location,), params):
+                yield instances
+
+    def _candidate_instance_pages(self, names=None):
+        seen = set()
+        for instances in self._instance_pages(names):
+            seen.update(instance['name'] for instance in instances)
+            yield instances
+
+        if self.namespace is None:
+            return
+
+        # Instances launched before we labelled them, or whose labelling
+        # failed, carry the namespace only in their metadata, which the API
+        # can't filter on. So list the unlabelled ones as well, and check
+        # their metadata instead.
+        if names is not None:
+            names = set(names) - seen
+            if not names:
+                return
+
+        for instances in self._instance_pages(names, labelled=False):
+            legacy = [instance for instance in instances if self._is_legacy_instance(instance)]
+            for instance in legacy:
+                self._unlabelled_instances[instance['name']] = instance
+            if legacy:
+                yield legacy
+
+    def _is_legacy_instance(self, instance):
+        if NAMESPACE_LABEL in (instance.get('labels') or {}):
+            return False
+        return self._metadata_namespace(instance.get('metadata')) == self.namespace
+
+    def _label_instances(self):
+        # Detection only reads, so the unlabelled instances it came across
+        # get their label when applying, and the labelled listing finds them
+        # from then on.
+        while self._unlabelled_instances:
+            name, instance = self._unlabelled_instances.popitem()
+            LOG.info('Labelling node %s with its namespace' % (name,))
+            labels = dict(instance.get('labels') or {})
+            labels[NAMESPACE_LABEL] = self.namespace_label
+            try:
+                self.connection.connection.request('/zones/%s/instances/%s/setLabels' % (self.location, name),
+                                                   method='POST',
+                                                   data={'labels': labels,
+                                                         'labelFingerprint': instance.get('labelFingerprint')})
+            except Exception as e:
+                LOG.warning('Failed to label node %s: %s' % (name, e))
+
+    def _run_apply(self, scheduler):
+        self._label_instances()
+        return super(GCEDriver, self)._run_apply(scheduler)
+
+    def _list_candidate_node_pages(self, names=None):
+        for instances in self._candidate_instance_pages(names):
+            yield self._provider_nodes(instances)
+
+    def _provider_nodes(self, instances):
+        self._fetch_disks(self._boot_disk_link(instance) for instance in instances if instance.get('disks'))
+        return [self._provider_node(instance) for instance in instances]
+
+    def _provider_node(self, instance):
+        # libcloud looks up the boot disk of each instance it converts, and
+        # one missing from its cache means listing every disk. Hide the boot
+        # flag from it and fill in the image from the disks fetched above.
+        disks = instance.get('disks', [])
+        gcenode = self.connection._to_node(dict(instance, disks=[dict(disk, boot=False) for disk in disks]),
+                                           use_disk_cache=True)
+        gcenode.extra['disks'] = disks
+
+        if gcenode.image is None and disks:
+            source_image = self._volume_image_map.get(self._boot_disk_link(instance))
+            if source_image:
+                gcenode.image = gcenode.extra['image'] = source_image.rsplit('/', 1)[-1]
+        return gcenode
+
+    def live_node_ids(self, names):
+        # The raw listing has everything needed, so skip the disk lookups.
+        ids = set()
+        for instances in self._candidate_instance_pages(names):
+            ids.update(instance['id'] for instance in instances if instance['name'] in names)
+        return ids
+
     def _aasemble_node_from_provider_node(self, gcenode):
         node = cloud_models.Node(name=gcenode.name,
                                  flavor=gcenode.size,
                                  image=gcenode.image,
-                                 disk=self.volume_size_map[gcenode.extra['disks'][0]['source']],
+                                 disk=self._volume_size(self._boot_disk_link(gcenode.extra)),
                                  networks=[],
                                  private=gcenode)
         node.security_group_names = set(gcenode.extra['tags'])
         return node
 
-    def detect_firewalls(self):
+    def detect_firewalls(self, names=None):
         security_group_set = set()
         security_group_rule_set = set()
 
-        firewalls = self.connection.ex_list_firewalls()
+        firewalls = self._list_firewalls(names)
 
         security_group_names = self._get_all_security_group_names(firewalls)
+        if names is not None:
+            security_group_names &= set(names)
 
         security_groups = {}
         for security_group_name in security_group_names:
@@ -88,6 +354,8 @@ class GCEDriver(CloudDriver):
 
         for firewall in firewalls:
             for tag in (firewall.target_tags or ['global']):
+                if tag not in security_groups:
+                    continue
                 for allowed in firewall.allowed:
                     from_port, to_port = self._parse_port_spec(allowed)
                     protocol = allowed['IPProtocol']
@@ -110,6 +378,19 @@ class GCEDriver(CloudDriver):
 
         return security_group_set, security_group_rule_set
 
+    def _list_firewalls(self, names=None):
+        # Rules without target tags belong to "global", which no tag filter
+        # can pick out, so that one needs the whole listing.
+        if names is None or 'global' in names:
+            return self.connection.ex_list_firewalls()
+
+        names = sorted(names)
+        firewalls = []
+        for i in range(0, len(names), MAX_FILTER_NAMES):
+            params = {'filter': '(%s)' % (' OR '.join('(targetTags = "%s")' % (name,) for name in names[i:i + MAX_FILTER_NAMES]),)}
+            firewalls.extend(self.connection._to_firewall(firewall) for firewall in self._paginate('/global/firewalls', params))
+        return firewalls
+
     def _get_all_security_group_names(self, firewalls):
         security_group_names = set()
         for firewall in firewalls:
@@ -131,15 +412,7 @@ class GCEDriver(CloudDriver):
         else:
             return 0, 65535
 
-    def create_node(self, node):
-        LOG.info('Launching node: %s' % (node.name))
-
-        kwargs = {'name': node.name,
-                  'size': self.apply_mappings('flavors', node.flavor),
-                  'image': None,
-                  'ex_disks_gce_struct': self._disk_struct(node),
-                  'ex_tags': [sg.name for sg in node.security_groups]}
-
+    def _metadata(self, node):
         ssh_keys = self._ssh_metadata()
 
         if node.script is not None or self.namespace is not None or ssh_keys is not None:
@@ -157,12 +430,137 @@ class GCEDriver(CloudDriver):
                 md_items.append({'key': 'ssh-keys',
                                  'value': ssh_keys})
 
-            kwargs['ex_metadata'] = {'items': md_items}
+            return {'items': md_items}
+
+    def create_node(self, node):
+        LOG.info('Launching node: %s' % (node.name))
+
+        path = '/zones/%s/instances' % (self.location,)
+        body = self._instance_properties(node, self._disk_struct(node))
+        body['name'] = node.name
+        body['machineType'] = 'zones/%s/machineTypes/%s' % (self.location, body['machineType'])
 
-        node.private = self.connection.create_node(**kwargs)
+        if self.operation_tracker is not None:
+            self._submit_tracked(path, body, [node])
+            return
+
+        self._insert(path, body, [node])
 
         LOG.info('Launced node: %s' % (node.name))
 
+    def _instance_properties(self, node, disks):
+        properties = {'machineType': self.apply_mappings('flavors', node.flavor),
+                      'disks': disks,
+                      'networkInterfaces': [{'network': 'global/networks/default',
+                                             'accessConfigs': [{'name': 'External NAT',
+                                                                'type': 'ONE_TO_ONE_NAT'}]}],
+                      'serviceAccounts': [{'email': 'default',
+                                           'scopes': [self.connection.AUTH_URL + 'devstorage.read_only']}],
+                      'tags': {'items': [sg.name for sg in node.security_groups]}}
+
+        metadata = self._metadata(node)
+        if metadata is not None:
+            properties['metadata'] = metadata
+
+        if self.namespace is not None:
+            properties['labels'] = {NAMESPACE_LABEL: self.namespace_label}
+
+        return properties
+
+    def create_nodes(self, nodes):
+        if len(nodes) == 1:
+            return self.create_node(nodes[0])
+
+        LOG.info('Launching %d nodes: %s' % (len(nodes), ', '.join(node.name for node in nodes)))
+
+        # All nodes in a batch share a spec, so one bulk insert with the
+        # first node's properties and a name per instance covers them all.
+        body = {'count': len(nodes),
+                'minCount': len(nodes),
+                'instanceProperties': self._instance_properties(nodes[0], self._bulk_disk_struct(nodes[0])),
+                'perInstanceProperties': dict((node.name, {}) for node in nodes)}
+
+        if self.operation_tracker is not None:
+            self._submit_tracked('/zones/%s/instances/bulkInsert' % (self.location,), body, nodes)
+            return
+
+        self._insert('/zones/%s/instances/bulkInsert' % (self.location,), body, nodes)
+
+        LOG.info('Launched nodes: %s' % (', '.join(node.name for node in nodes)))
+
+    def _attach_provider_nodes(self, nodes):
+        # Look up just these instances rather than listing the whole zone.
+        names = sorted(node.name for node in nodes)
+        instances = []
+        for i in range(0, len(names), MAX_FILTER_NAMES):
+            params = {'filter': self._name_filter(names[i:i + MAX_FILTER_NAMES])}
+            instances.extend(self._paginate('/zones/%s/instances' % (self.location,), params))
+
+        gcenodes = dict((gcenode.name, gcenode) for gcenode in self._provider_nodes(instances))
+        for node in nodes:
+            node.private = gcenodes[node.name]
+
+    def _request_params(self, nodes, generation=0):
+        # GCE answers a repeated requestId with the operation the first
+        # request started instead of starting another.
+        key = self.idempotency_key(nodes, generation)
+        if key is None:
+            return None
+        return {'requestId': str(uuid.UUID(key[:32]))}
+
+    def _insert(self, path, body, nodes):
+        generation = 0
+        while True:
+            params = self._request_params(nodes, generation)
+            self.connection.connection.async_request(path, method='POST', data=body, params=params)
+            try:
+                if len(nodes) == 1:
+                    nodes[0].private = self.connection.ex_get_node(nodes[0].name, self.location)
+                else:
+                    self._attach_provider_nodes(nodes)
+                return
+            except (KeyError, ResourceNotFoundError):
+                # The requestId was remembered from a launch whose instances
+                # have since been deleted, so nothing was launched this time.
+                if params is None or generation + 1 >= MAX_REQUEST_ID_GENERATIONS:
+                    raise
+                generation += 1
+
+    def _submit_tracked(self, path, body, nodes):
+        operation = self.connection.connection.request(path, method='POST', data=body,
+                                                       params=self._request_params(nodes)).object
+        self.operation_tracker.add(self.location, operation, nodes)
+
+    def _paginate_pages(self, path, params):
+        params = dict(params, maxResults=500)
+
+        while True:
+            response = self.connection.connection.request(path, method='GET', params=params).object
+            yield response.get('items', [])
+
+            if not response.get('nextPageToken'):
+                break
+            params['pageToken'] = response['nextPageToken']
+
+    def _paginate(self, path, params):
+        for items in self._paginate_pages(path, params):
+            for item in items:
+                yield item
+
+    def list_zone_operations(self, zone):
+        params = {'filter': ' OR '.join('(operationType = "%s")' % (t,) for t in TRACKED_OPERATION_TYPES)}
+        return self._paginate('/zones/%s/operations' % (zone,), params)
+
+    def wait_for_operations(self):
+        if self.operation_tracker is not None:
+            nodes = self.operation_tracker.wait()
+            if nodes:
+                self._attach_provider_nodes(nodes)
+
+    def update_node(self, change):
+        LOG.info('Updating node: %s (%s)' % (change.name, ', '.join(change.fields)))
+        self.connection.ex_set_node_tags(self.provider_node(change.current), sorted(sg.name for sg in change.desired.security_groups))
+
     def create_security_group(self, security_group):
         pass
 
@@ -192,14 +590,19 @@ class GCEDriver(CloudDriver):
         except ResourceExistsError:
             pass
 
-    def _disk_struct(self, node):
+    def _disk_struct(self, node, disk_type=None):
         return [{'boot': True,
                  'autoDelete': True,
                  'initializeParams': {
                      'sourceImage': self._resolve_image_name(self.apply_mappings('images', node.image)),
-                     'diskType': self._get_disk_type('pd-ssd'),
+                     'diskType': disk_type or self._get_disk_type(DISK_TYPE),
                      'diskSizeGb': node.disk}}]
 
+    def _bulk_disk_struct(self, node):
+        # bulkInsert's instanceProperties take the disk type's name, not the
+        # zonal URL a single insert takes.
+        return self._disk_struct(node, DISK_TYPE)
+
     def _format_ports(self, security_group_rule):
         if security_group_rule.from_port == security_group_rule.to_port:
             return str(security_group_rule.from_port)
@@ -213,14 +616,20 @@ class GCEDriver(CloudDriver):
             return [security_group_rule.source_ip]
 
     def _resolve_image_name(self, name):
-        for image in self.connection.list_images():
-            if image.name == name:
-                return image.extra['selfLink']
+        try:
+            return self.get_catalog_image('name', name).extra['selfLink']
+        except KeyError:
+            return None
+
+    def _fetch_disk_types(self):
+        return [self._record(disktype, ('id', 'name'), ('selfLink',))
+                for disktype in self.connection.ex_list_disktypes(self.location)]
 
     def _get_disk_type(self, name):
-        for disktype in self.connection.ex_list_disktypes(self.location):
-            if disktype.name == name:
-                return disktype.extra['selfLink']
+        try:
+            return self.catalog.get('disktypes', 'name', name, self._fetch_disk_types)['extra']['selfLink']
+        except KeyError:
+            return None
 
     def _format_ssh_metadata(self, username, ssh_key_data):
         return '%s:%s' % (username, ssh_key_data)
@@ -0,0 +1,128 @@
+import logging
+import random
+import threading
+import time
+
+from aasemble.deployment.cloud.retry import backoff_delay
+
+LOG = logging.getLogger(__name__)
+
+OPERATION_CLASSES = (('create', 'create'),
+                     ('delete', 'delete'),
+                     ('destroy', 'delete'),
+                     ('update', 'create'),
+                     ('detect', 'list'),
+                     ('list', 'list'))
+
+
+def operation_class(operation):
+    for prefix, op_class in OPERATION_CLASSES:
+        if (operation or '').startswith(prefix):
+            return op_class
+    return 'other'
+
+
+class AdaptiveLimit(object):
+    def __init__(self, name, initial, minimum=1, maximum=None, decrease=0.5):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.decrease = decrease
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False, failed=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled or not failed:
+                self._adjust(throttled)
+            self.cond.notify_all()
+
+    def throttled(self):
+        # A throttled request inside a call that still holds its slot.
+        with self.cond:
+            self._adjust(True)
+
+    def _adjust(self, throttled):
+        # Additive increase, multiplicative decrease: one extra slot per
+        # window of successful calls, halve the window when throttled.
+        if throttled:
+            self.throttles += 1
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            LOG.warning('Throttled on %s, lowering concurrency to %d' % (self.name, int(self.limit)))
+        else:
+            self.successes += 1
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def as_dict(self):
+        return {'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'successes': self.successes,
+                'throttles': self.throttles}
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, maximum, initial=None, backoff=1.0, max_backoff=30.0, max_throttle_retries=8, sleep=time.sleep,
+                 random=random.random):
+        self.maximum = maximum
+        self.initial = min(initial or max(1, maximum // 2), maximum)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_throttle_retries = max_throttle_retries
+        self.sleep = sleep
+        self.random = random
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def limit_for(self, provider, op_class):
+        key = (provider, op_class)
+        with self.lock:
+            if key not in self.limits:
+                self.limits[key] = AdaptiveLimit('%s/%s' % key, self.initial, maximum=self.maximum)
+            return self.limits[key]
+
+    def call(self, provider, op_class, func, *args):
+        # Holds one of the operation class's slots while func runs. Nothing
+        # is retried here: func may already have done part of its work, so
+        # throttled requests are retried one by one instead (see request).
+        limit = self.limit_for(provider, op_class)
+        limit.acquire()
+        try:
+            result = func(*args)
+        except Exception:
+            limit.release(failed=True)
+            raise
+
+        limit.release()
+        return result
+
+    def request(self, provider, op_class, is_throttling_error, func, *args, **kwargs):
+        # A throttled request was turned away before the provider did
+        # anything, so sending it again is always safe.
+        limit = self.limit_for(provider, op_class)
+        attempt = 0
+
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_throttling_error(e):
+                    raise
+                limit.throttled()
+                if attempt >= self.max_throttle_retries:
+                    raise
+                self.sleep(backoff_delay(attempt, self.backoff, self.max_backoff, self.random))
+                attempt += 1
+
+    def state(self):
+        with self.lock:
+            return dict(('%s/%s' % key, limit.as_dict()) for key, limit in self.limits.items())
@@ -0,0 +1,231 @@
+import json
+import threading
+import time
+
+import six
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Path segments naming a collection; the segment after one is the name or
+# id of a member, which would otherwise make every call name unique.
+ID_COLLECTIONS = frozenset(['actions', 'disks', 'droplets', 'firewalls', 'images', 'instances', 'machineTypes',
+                            'networks', 'operations', 'regions', 'sizes', 'tags', 'zones'])
+
+UNATTRIBUTED = 'other'
+
+
+def call_name(action, params=None, method='GET'):
+    # EC2 style query APIs name the call in the parameters, REST APIs in
+    # the method and path.
+    if params and 'Action' in params:
+        return params['Action']
+
+    segments = [segment for segment in (action or '').split('?')[0].split('/') if segment]
+    for i in range(1, len(segments)):
+        # The last segment of a POST is a custom method (bulkInsert,
+        # setTags), not a member.
+        if segments[i - 1] in ID_COLLECTIONS and not (method == 'POST' and i == len(segments) - 1 and not segments[i].isdigit()):
+            segments[i] = '{}'
+    return '%s /%s' % (method, '/'.join(segments))
+
+
+def payload_size(data):
+    if data is None:
+        return 0
+    if not isinstance(data, (six.binary_type, six.text_type)):
+        data = json.dumps(data)
+    return len(data)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations at or below it), Prometheus style.
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation.
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+    def as_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': [['+Inf' if bound == float('inf') else bound, total] for bound, total in self.cumulative()]}
+
+
+class OperationMetrics(object):
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.calls = {}
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+
+    def as_dict(self):
+        return {'calls': dict(self.calls),
+                'errors': self.errors,
+                'retries': self.retries,
+                'throttles': self.throttles,
+                'latency': self.latency.as_dict(),
+                'request_bytes': self.request_bytes.as_dict(),
+                'response_bytes': self.response_bytes.as_dict()}
+
+
+class Metrics(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.locals = threading.local()
+
+    def _operation(self, provider, operation):
+        key = (provider, operation or UNATTRIBUTED)
+        if key not in self.operations:
+            self.operations[key] = OperationMetrics()
+        return self.operations[key]
+
+    def current_operation(self):
+        return getattr(self.locals, 'operation', None)
+
+    def operation(self, operation):
+        # Attributes the API calls this thread makes until the returned
+        # context exits to the given operation.
+        return _OperationContext(self.locals, operation)
+
+    def observe(self, provider, call, latency, request_bytes=0, response_bytes=0, error=False):
+        with self.lock:
+            metrics = self._operation(provider, self.current_operation())
+            metrics.calls[call] = metrics.calls.get(call, 0) + 1
+            metrics.latency.observe(latency)
+            metrics.request_bytes.observe(request_bytes)
+            metrics.response_bytes.observe(response_bytes)
+            if error:
+                metrics.errors += 1
+
+    def retried(self, provider, operation):
+        with self.lock:
+            self._operation(provider, operation).retries += 1
+
+    def throttled(self, provider, operation):
+        with self.lock:
+            self._operation(provider, operation).throttles += 1
+
+    def instrument(self, driver, provider):
+        # Every libcloud call, and the raw requests the drivers make
+        # themselves, goes through the connection's request method.
+        connection = driver.connection
+        request = connection.request
+
+        def instrumented(action, *args, **kwargs):
+            params = kwargs.get('params', args[0] if len(args) > 0 else None)
+            data = kwargs.get('data', args[1] if len(args) > 1 else None)
+            method = kwargs.get('method', args[3] if len(args) > 3 else 'GET')
+
+            start = self.clock()
+            response = None
+            try:
+                response = request(action, *args, **kwargs)
+                return response
+            finally:
+                body = getattr(response, 'body', None)
+                self.observe(provider, call_name(action, params, method), self.clock() - start,
+                             payload_size(data), payload_size(body) if isinstance(body, (six.binary_type, six.text_type)) else 0,
+                             error=response is None)
+
+        connection.request = instrumented
+        return driver
+
+    def as_dict(self):
+        with self.lock:
+            return {'operations': [dict(metrics.as_dict(), provider=provider, operation=operation)
+                                   for (provider, operation), metrics in sorted(self.operations.items())]}
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def as_prometheus(self):
+        lines = []
+
+        def labels(**kwargs):
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in sorted(kwargs.items()))
+
+        def histogram(name, help, attr):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s histogram' % (name,))
+            for (provider, operation), metrics in sorted(self.operations.items()):
+                hist = getattr(metrics, attr)
+                for bound, total in hist.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d' % (name, labels(provider=provider, operation=operation, le=le), total))
+                lines.append('%s_sum%s %r' % (name, labels(provider=provider, operation=operation), hist.sum))
+                lines.append('%s_count%s %d' % (name, labels(provider=provider, operation=operation), hist.count))
+
+        def counter(name, help, attr):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % (name,))
+            for (provider, operation), metrics in sorted(self.operations.items()):
+                lines.append('%s%s %d' % (name, labels(provider=provider, operation=operation), getattr(metrics, attr)))
+
+        with self.lock:
+            histogram('aasemble_api_call_duration_seconds', 'Latency of provider API calls.', 'latency')
+            histogram('aasemble_api_request_bytes', 'Size of provider API request bodies.', 'request_bytes')
+            histogram('aasemble_api_response_bytes', 'Size of provider API response bodies.', 'response_bytes')
+
+            lines.append('# HELP aasemble_api_calls_total Provider API calls by call name.')
+            lines.append('# TYPE aasemble_api_calls_total counter')
+            for (provider, operation), metrics in sorted(self.operations.items()):
+                for call, count in sorted(metrics.calls.items()):
+                    lines.append('aasemble_api_calls_total%s %d' % (labels(provider=provider, operation=operation, call=call), count))
+
+            counter('aasemble_api_errors_total', 'Provider API calls that failed.', 'errors')
+            counter('aasemble_api_retries_total', 'Operations attempted again after a failure.', 'retries')
+            counter('aasemble_api_throttles_total', 'Operations the provider throttled.', 'throttles')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        with open(path, 'w') as fp:
+            fp.write(self.as_prometheus() if format == 'prometheus' else self.as_json())
+
+
+class _OperationContext(object):
+    def __init__(self, locals, operation):
+        self.locals = locals
+        self.operation = operation
+
+    def __enter__(self):
+        self.previous = getattr(self.locals, 'operation', None)
+        self.locals.operation = self.operation
+
+    def __exit__(self, *exc_info):
+        self.locals.operation = self.previous
@@ -1,4 +1,45 @@
+try:
+    from sys import intern
+except ImportError:  # pragma: no cover
+    pass  # Python 2 has it as a builtin
+
+from aasemble.deployment.cloud.retry import DEFAULT_ATTEMPTS
+
+
+class Index(object):
+    # Secondary index over a NamedSet: keys(item) returns the keys an item
+    # is filed under, entries maps each key to the items filed under it.
+    def __init__(self, keys):
+        self.keys = keys
+        self.entries = {}
+        self.item_keys = {}
+
+    def add(self, item):
+        keys = tuple(self.keys(item))
+        self.item_keys[item.name] = keys
+        for key in keys:
+            self.entries.setdefault(key, {})[item.name] = item
+
+    def remove(self, item):
+        for key in self.item_keys.pop(item.name, ()):
+            items = self.entries[key]
+            del items[item.name]
+            if not items:
+                del self.entries[key]
+
+    def lookup(self, key):
+        return list(self.entries.get(key, {}).values())
+
+    def clear(self):
+        self.entries.clear()
+        self.item_keys.clear()
+
+
 class NamedSet(dict):
+    def __init__(self, *args, **kwargs):
+        super(NamedSet, self).__init__(*args, **kwargs)
+        self.indexes = {}
+
     def add(self, item):
         self[item.name] = item
 
@@ -13,16 +54,96 @@ class NamedSet(dict):
 
         raise TypeError('Must pass either item or name')
 
+    def add_index(self, name, keys):
+        index = Index(keys)
+        for item in self.values():
+            index.add(item)
+        self.indexes[name] = index
+
+    def lookup(self, index, key):
+        return self.indexes[index].lookup(key)
+
+    def index_keys(self, index):
+        return list(self.indexes[index].entries)
+
+    def reindex(self, item):
+        # Items are filed under their keys when added; call this after
+        # changing an indexed attribute in place.
+        for index in self.indexes.values():
+            index.remove(item)
+            index.add(item)
+
+    def __setitem__(self, name, item):
+        if dict.__contains__(self, name):
+            for index in self.indexes.values():
+                index.remove(self[name])
+        super(NamedSet, self).__setitem__(name, item)
+        for index in self.indexes.values():
+            index.add(item)
+
+    def __delitem__(self, name):
+        item = self[name]
+        super(NamedSet, self).__delitem__(name)
+        for index in self.indexes.values():
+            index.remove(item)
+
+    # The rest of dict's mutators go through the two above, so the indexes
+    # stay in step whichever way items come and go.
+    def update(self, *args, **kwargs):
+        for name, item in dict(*args, **kwargs).items():
+            self[name] = item
+
+    def setdefault(self, name, item=None):
+        if not dict.__contains__(self, name):
+            self[name] = item
+        return self[name]
+
+    def pop(self, name, *default):
+        if not dict.__contains__(self, name):
+            if default:
+                return default[0]
+            raise KeyError(name)
+        item = self[name]
+        del self[name]
+        return item
+
+    def popitem(self):
+        name, item = super(NamedSet, self).popitem()
+        for index in self.indexes.values():
+            index.remove(item)
+        return name, item
+
+    def clear(self):
+        super(NamedSet, self).clear()
+        for index in self.indexes.values():
+            index.clear()
+
+    def _empty_copy(self):
+        copy = self.__class__()
+        for name, index in self.indexes.items():
+            copy.add_index(name, index.keys)
+        return copy
+
+    def copy(self):
+        copy = self._empty_copy()
+        copy.update(self)
+        return copy
+
     def __sub__(self, other):
-        diff_keys = set(self.keys()) - set(other.keys())
-        difference = self.__class__()
-        for key in diff_keys:
-            difference[key] = self[key]
+        difference = self._empty_copy()
+        for key in self.keys():
+            if not dict.__contains__(other, key):
+                difference[key] = self[key]
         return difference
 
     def __eq__(self, other):
-        if type(other) == NamedSet:
-            return set(self.values()) == set(other.values())
+        if isinstance(other, NamedSet):
+            if len(self) != len(other):
+                return False
+            for key, item in self.items():
+                if other.get(key) != item:
+                    return False
+            return True
         return set(self.values()) == other
 
     def __ne__(self, other):
@@ -32,12 +153,24 @@ class NamedSet(dict):
         return iter(self.values())
 
     def __contains__(self, item):
-        return item in self.values()
+        try:
+            return self[item.name] == item
+        except (AttributeError, KeyError):
+            return False
+
+
+NODE_INDEXES = (('security_group', lambda node: [sg.name for sg in getattr(node, 'security_groups', ())]),
+                ('image', lambda node: [getattr(node, 'image', None)]),
+                ('flavor', lambda node: [getattr(node, 'flavor', None)]))
 
 
 class Collection(object):
     def __init__(self, nodes=None, security_groups=None, security_group_rules=None, urls=None, containers=None, tasks=None):
         self.nodes = nodes or NamedSet()
+        if isinstance(self.nodes, NamedSet):
+            for name, keys in NODE_INDEXES:
+                if name not in self.nodes.indexes:
+                    self.nodes.add_index(name, keys)
         self.security_groups = security_groups or NamedSet()
         self.security_group_rules = security_group_rules or set()
         self.urls = urls or []
@@ -64,9 +197,16 @@ class Collection(object):
 
     def connect(self):
         for node in self.nodes:
-            for security_group_name in node.security_group_names:
-                if security_group_name in self.security_groups.keys():
-                    node.security_groups.add(self.security_groups[security_group_name])
+            self.connect_node(node)
+
+    def connect_node(self, node):
+        for security_group_name in node.security_group_names:
+            security_group = self.security_groups.get(security_group_name)
+            if security_group is not None:
+                node.security_groups.add(security_group)
+        node._invalidate_hash()
+        if self.nodes.get(node.name) is node:
+            self.nodes.reindex(node)
 
     def as_dict(self):
         return {'nodes': [node.as_dict() for node in self.nodes],
@@ -76,21 +216,45 @@ class Collection(object):
 
 
 class CloudModel(object):
+    # The identity hash is computed on first use and cached from then on.
+    # Anything changing an id attribute after that must call
+    # _invalidate_hash(), and must not do so while the model is in a set.
+    __slots__ = ('_hash',)
+
+    id_attrs = ()
+
+    def _identity(self):
+        return tuple(getattr(self, attr, False) for attr in self.id_attrs)
+
+    def _invalidate_hash(self):
+        self._hash = None
+        return self
+
     def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, CloudModel):
+            return hash(self) == hash(other) and self._identity() == other._identity()
         return all([getattr(self, attr, False) == getattr(other, attr, False) for attr in self.id_attrs])
 
+    def __ne__(self, other):
+        return not (self == other)
+
     def __hash__(self):
-        retval = 0
-        for attr in self.id_attrs:
-            retval ^= hash(getattr(self, attr))
-        return retval
+        if getattr(self, '_hash', None) is None:
+            self._hash = hash(self._identity())
+        return self._hash
 
 
 class Node(CloudModel):
-    def __init__(self, name, flavor, image, networks, disk, security_groups=None, runner=None, keypair=None, script=None, attempts_left=1, private=None):
+    __slots__ = ('name', 'flavor', 'image', 'networks', 'disk', 'security_groups', 'security_group_names',
+                 'runner', 'keypair', 'script', 'attempts_left', 'private',
+                 'server_id', 'fips', 'ports', 'server_status')
+
+    def __init__(self, name, flavor, image, networks, disk, security_groups=None, runner=None, keypair=None, script=None, attempts_left=DEFAULT_ATTEMPTS, private=None):
         self.name = name
-        self.flavor = flavor
-        self.image = image
+        self.flavor = intern_string(flavor)
+        self.image = intern_string(image)
         self.networks = networks
         self.disk = disk
         self.security_groups = security_groups or set()
@@ -110,11 +274,8 @@ class Node(CloudModel):
     def __repr__(self):
         return "<Node name='%s'>" % (self.name,)  # pragma: no cover
 
-    def __eq__(self, other):
-        return super(Node, self).__eq__(other) and (stringify(self.security_groups) == stringify(other.security_groups))
-
-    def __hash__(self):
-        return super(Node, self).__hash__() ^ hash(stringify(self.security_groups))
+    def _identity(self):
+        return super(Node, self)._identity() + (stringify(self.security_groups),)
 
     def as_dict(self):
         return {'name': self.name,
@@ -126,15 +287,31 @@ class Node(CloudModel):
                 'public_ips': getattr(getattr(self, 'private', None), 'public_ips', [])}
 
 
+class NodeRecord(object):
+    __slots__ = ('id', 'state', 'public_ips', 'namespace', 'boot_volume')
+
+    def __init__(self, id, state=None, public_ips=None, namespace=None, boot_volume=None):
+        self.id = id
+        self.state = state
+        self.public_ips = public_ips or []
+        self.namespace = namespace
+        self.boot_volume = boot_volume
+
+    def __repr__(self):  # pragma: no cover
+        return "<NodeRecord id='%s'>" % (self.id,)
+
+
 class Network(object):
     pass
 
 
 class URLConf(CloudModel):
-    pass
+    __slots__ = ()
 
 
 class URLConfStatic(URLConf):
+    __slots__ = ('hostname', 'path', 'local_path')
+
     def __init__(self, hostname, path, local_path):
         self.hostname = hostname
         self.path = path
@@ -151,6 +328,8 @@ class URLConfStatic(URLConf):
 
 
 class URLConfBackend(URLConf):
+    __slots__ = ('hostname', 'path', 'destination')
+
     def __init__(self, hostname, path, destination):
         self.hostname = hostname
         self.path = path
@@ -168,8 +347,11 @@ class URLConfBackend(URLConf):
 
 
 class SecurityGroup(CloudModel):
+    __slots__ = ('name', 'private')
+
     def __init__(self, name):
         self.name = name
+        self.private = None
 
     def __repr__(self):  # pragma: no cover
         return "<SecurityGroup name='%s'>" % (self.name,)
@@ -181,13 +363,15 @@ class SecurityGroup(CloudModel):
 
 
 class SecurityGroupRule(CloudModel):
+    __slots__ = ('security_group', 'source_ip', 'source_group', 'from_port', 'to_port', 'protocol', 'private')
+
     def __init__(self, security_group, from_port, to_port, protocol, source_ip=None, source_group=None, private=None):
         self.security_group = security_group
-        self.source_ip = source_ip
-        self.source_group = source_group
+        self.source_ip = intern_string(source_ip)
+        self.source_group = intern_string(source_group)
         self.from_port = from_port
         self.to_port = to_port
-        self.protocol = protocol
+        self.protocol = intern_string(protocol)
         self.private = private
 
     def __repr__(self):  # pragma: no cover
@@ -226,6 +410,13 @@ class SecurityGroupRule(CloudModel):
         return d
 
 
+def intern_string(value):
+    # Flavors, images and the like repeat across thousands of objects.
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
 def stringify(security_groups):
     l = list([sg.name for sg in security_groups])
     l.sort()
@@ -0,0 +1,166 @@
+import aasemble.deployment.cloud.models as cloud_models
+
+CREATE = 'create'
+UPDATE = 'update'
+REPLACE = 'replace'
+DELETE = 'delete'
+
+NODE_FIELDS = ('flavor', 'image', 'disk', 'script', 'security_groups')
+
+
+class Change(object):
+    __slots__ = ('action', 'kind', 'name', 'desired', 'current', 'fields')
+
+    def __init__(self, action, kind, name, desired=None, current=None, fields=()):
+        self.action = action
+        self.kind = kind
+        self.name = name
+        self.desired = desired
+        self.current = current
+        self.fields = tuple(fields)
+
+    def __repr__(self):  # pragma: no cover
+        return "<Change %s %s '%s' %r>" % (self.action, self.kind, self.name, self.fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, Change):
+            return False
+        return (self.action, self.kind, self.name, self.fields) == (other.action, other.kind, other.name, other.fields)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash((self.action, self.kind, self.name, self.fields))
+
+    def as_dict(self):
+        d = {'action': self.action,
+             'kind': self.kind,
+             'name': self.name}
+        if self.fields:
+            d['fields'] = list(self.fields)
+        return d
+
+
+class Plan(object):
+    def __init__(self, desired, changes=None):
+        self.desired = desired
+        self.changes = changes or []
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def select(self, action=None, kind=None):
+        return [change for change in self.changes
+                if (action is None or change.action == action) and (kind is None or change.kind == kind)]
+
+    def without_replacements(self):
+        # Nodes that aren't replaced stay in their current groups, so those
+        # groups and the rules naming them have to stay too.
+        kept = set(security_group.name for change in self.select(REPLACE, 'node')
+                   for security_group in change.current.security_groups)
+
+        def skipped(change):
+            if change.action == REPLACE:
+                return True
+            if change.action != DELETE:
+                return False
+            if change.kind == 'security_group':
+                return change.name in kept
+            if change.kind == 'security_group_rule':
+                return change.current.security_group.name in kept or change.current.source_group in kept
+            return False
+
+        return Plan(self.desired, [change for change in self.changes if not skipped(change)])
+
+    def creations(self):
+        # Everything that needs creating, replacements included, in the
+        # shape apply_resources takes.
+        collection = cloud_models.Collection()
+        for change in self.changes:
+            if change.action not in (CREATE, REPLACE):
+                continue
+            if change.kind == 'node':
+                collection.nodes.add(change.desired)
+            elif change.kind == 'security_group':
+                collection.security_groups.add(change.desired)
+            else:
+                collection.security_group_rules.add(change.desired)
+        collection.urls = self.desired.urls
+        collection.containers = self.desired.containers
+        collection.tasks = self.desired.tasks
+        collection.original_collection = self.desired
+        return collection
+
+    def deletions(self):
+        # Everything that needs deleting, including the nodes being replaced.
+        collection = cloud_models.Collection()
+        for change in self.changes:
+            if change.action not in (DELETE, REPLACE):
+                continue
+            if change.kind == 'node':
+                collection.nodes.add(change.current)
+            elif change.kind == 'security_group':
+                collection.security_groups.add(change.current)
+            else:
+                collection.security_group_rules.add(change.current)
+        return collection
+
+    def as_dict(self):
+        return {'changes': [change.as_dict() for change in self.changes]}
+
+
+def node_value(node, field):
+    if field == 'security_groups':
+        return frozenset(sg.name for sg in node.security_groups)
+    return getattr(node, field)
+
+
+# One pass over each side. Nodes differing only in update_fields are updated
+# in place, any other difference means replacing them. Fields the provider
+# didn't report (None on the current node) aren't compared. Resources that
+# exist but aren't desired are only deleted when pruning.
+def diff(desired, current, fields=NODE_FIELDS, update_fields=(), desired_value=node_value, prune=False):
+    changes = []
+
+    for node in desired.nodes:
+        existing = current.nodes.get(node.name)
+        if existing is None:
+            changes.append(Change(CREATE, 'node', node.name, desired=node))
+            continue
+
+        changed = []
+        for field in fields:
+            value = node_value(existing, field)
+            if value is not None and desired_value(node, field) != value:
+                changed.append(field)
+
+        if changed:
+            action = UPDATE if set(changed) <= set(update_fields) else REPLACE
+            changes.append(Change(action, 'node', node.name, desired=node, current=existing, fields=changed))
+
+    for security_group in desired.security_groups:
+        if current.security_groups.get(security_group.name) is None:
+            changes.append(Change(CREATE, 'security_group', security_group.name, desired=security_group))
+
+    for security_group_rule in desired.security_group_rules:
+        if security_group_rule not in current.security_group_rules:
+            changes.append(Change(CREATE, 'security_group_rule', repr(security_group_rule), desired=security_group_rule))
+
+    if prune:
+        for node in current.nodes:
+            if desired.nodes.get(node.name) is None:
+                changes.append(Change(DELETE, 'node', node.name, current=node))
+
+        for security_group in current.security_groups:
+            if desired.security_groups.get(security_group.name) is None:
+                changes.append(Change(DELETE, 'security_group', security_group.name, current=security_group))
+
+        for security_group_rule in current.security_group_rules:
+            if security_group_rule not in desired.security_group_rules:
+                changes.append(Change(DELETE, 'security_group_rule', repr(security_group_rule), current=security_group_rule))
+
+    return Plan(desired, changes)
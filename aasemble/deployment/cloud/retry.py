@@ -0,0 +1,59 @@
+import logging
+import random
+import time
+
+LOG = logging.getLogger(__name__)
+
+THROTTLING = 'throttling'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+DEFAULT_ATTEMPTS = 3
+
+
+def backoff_delay(attempt, backoff, max_backoff, random=random.random):
+    # Full jitter, so callers failing together don't retry together.
+    return random() * min(max_backoff, backoff * 2 ** attempt)
+
+
+def budgeted_resources(arg):
+    # The resources whose attempts_left a call spends: the node itself, every
+    # node in a batch, or the desired node of a plan change.
+    items = arg if isinstance(arg, (list, tuple)) else [arg]
+    items = [getattr(item, 'desired', None) or item for item in items]
+    return [item for item in items if getattr(item, 'attempts_left', None) is not None]
+
+
+class RetryPolicy(object):
+    def __init__(self, attempts=DEFAULT_ATTEMPTS, backoff=1.0, max_backoff=30.0, sleep=time.sleep, random=random.random):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.random = random
+
+    def call(self, classify, func, arg, operation=None):
+        resources = budgeted_resources(arg)
+        attempt = 0
+
+        while True:
+            try:
+                return func(arg)
+            except Exception as e:
+                kind = classify(e)
+                attempt += 1
+
+                if resources:
+                    for resource in resources:
+                        resource.attempts_left -= 1
+                    attempts_left = min(resource.attempts_left for resource in resources)
+                else:
+                    attempts_left = self.attempts - attempt
+
+                if kind == PERMANENT or attempts_left <= 0:
+                    raise
+
+                delay = backoff_delay(attempt - 1, self.backoff, self.max_backoff, self.random)
+                LOG.warning('%s failed (%s), retrying in %.1fs, %d attempts left: %s' %
+                            (operation or getattr(func, '__name__', 'call'), kind, delay, attempts_left, e))
+                self.sleep(delay)
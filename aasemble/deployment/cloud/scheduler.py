@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+from aasemble.deployment import exceptions
+
+LOG = logging.getLogger(__name__)
+
+
+class Task(object):
+    def __init__(self, key, func, arg, requires=None, operation=None):
+        self.key = key
+        self.func = func
+        self.arg = arg
+        self.operation = operation or getattr(func, '__name__', None)
+        self.requires = set(requires or [])
+        self.pending = set()
+        self.dependents = []
+        self.state = 'pending'
+        self.result = None
+        self.exception = None
+        self.created_at = None
+        self.ready_at = None
+        self.finished_at = None
+
+    def __repr__(self):  # pragma: no cover
+        return "<Task key=%r state='%s'>" % (self.key, self.state)
+
+    @property
+    def wait_time(self):
+        if self.ready_at is None:
+            return None
+        return self.ready_at - self.created_at
+
+    @property
+    def run_time(self):
+        if self.ready_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.ready_at
+
+
+class Scheduler(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.tasks = {}
+        self.order = []
+        self.cond = threading.Condition()
+        self.remaining = 0
+
+    def add(self, key, func, arg, requires=None, operation=None):
+        if key in self.tasks:
+            raise exceptions.DuplicateResourceException(key)
+        task = Task(key, func, arg, requires, operation)
+        self.tasks[key] = task
+        self.order.append(task)
+        return task
+
+    def _link(self):
+        # Requirements that were never added (e.g. security groups that
+        # already exist and were diffed away) are considered satisfied.
+        for task in self.order:
+            task.pending = set(k for k in task.requires if k in self.tasks and k != task.key)
+            for key in task.pending:
+                self.tasks[key].dependents.append(task)
+
+        self._check_for_cycles()
+
+    def _check_for_cycles(self):
+        pending = dict((task.key, len(task.pending)) for task in self.order)
+        queue = [task for task in self.order if not task.pending]
+        visited = 0
+
+        while queue:
+            task = queue.pop()
+            visited += 1
+            for dependent in task.dependents:
+                pending[dependent.key] -= 1
+                if not pending[dependent.key]:
+                    queue.append(dependent)
+
+        if visited != len(self.order):
+            raise exceptions.DependencyCycleException([task.key for task in self.order if pending[task.key]])
+
+    def _prepare(self):
+        self._link()
+
+        now = time.time()
+        for task in self.order:
+            task.created_at = now
+
+    def run(self):
+        self._prepare()
+
+        with self.cond:
+            self.remaining = len(self.order)
+            for task in self.order:
+                if not task.pending:
+                    self._submit(task)
+
+            while self.remaining:
+                self.cond.wait()
+
+        return self._complete()
+
+    def _complete(self):
+        self._report()
+
+        # Everything that could run has run, so report all the failures at
+        # once rather than just the first.
+        failed = [task for task in self.order if task.state == 'failed']
+        for task in failed:
+            # KeyboardInterrupt, SystemExit and the like still stop us.
+            if not isinstance(task.exception, Exception):
+                raise task.exception
+        if failed:
+            raise exceptions.ResourcesFailedException([(task.key, task.exception) for task in failed],
+                                                      [task.key for task in self.order if task.state == 'skipped'])
+
+        return self.order
+
+    def _submit(self, task):
+        task.state = 'running'
+        task.ready_at = time.time()
+        LOG.debug('Starting %r after waiting %.2fs for dependencies' % (task.key, task.wait_time))
+        self.pool.apply_async(self._run_task, (task,))
+
+    def _run_task(self, task):
+        # Whatever happens the task has to finish, or run() waits forever.
+        try:
+            task.result = task.func(task.arg)
+        except BaseException as e:
+            task.exception = e
+        finally:
+            with self.cond:
+                self._finish(task)
+
+    def _mark_finished(self, task):
+        task.finished_at = time.time()
+
+        if task.exception is None:
+            task.state = 'done'
+        elif task.state != 'skipped':
+            task.state = 'failed'
+            LOG.error('%r failed: %s' % (task.key, task.exception))
+
+    def _finish(self, task):
+        self.remaining -= 1
+        self._mark_finished(task)
+
+        for dependent in task.dependents:
+            dependent.pending.discard(task.key)
+            if task.state != 'done':
+                if dependent.state == 'pending':
+                    self._skip(dependent, task)
+            elif not dependent.pending and dependent.state == 'pending':
+                self._submit(dependent)
+
+        self.cond.notify_all()
+
+    def _skip(self, task, cause):
+        task.state = 'skipped'
+        task.exception = exceptions.DependencyFailedException(task.key, cause.key)
+        self._finish(task)
+
+    def _report(self):
+        for task in self.order:
+            if task.wait_time is not None:
+                LOG.info('%r waited %.2fs for dependencies and ran for %.2fs' % (task.key, task.wait_time, task.run_time))
@@ -48,3 +48,28 @@ class ProvisionTimedOutException(AasembleDeploymentException):
 
 class ImageNotFoundException(AasembleDeploymentException):
     pass
+
+
+class NodeNotFoundException(AasembleDeploymentException):
+    pass
+
+
+class DependencyCycleException(AasembleDeploymentException):
+    pass
+
+
+class DependencyFailedException(AasembleDeploymentException):
+    pass
+
+
+class ResourcesFailedException(AasembleDeploymentException):
+    def __init__(self, failures, skipped=()):
+        self.failures = failures
+        self.skipped = skipped
+        super(ResourcesFailedException, self).__init__(self.report())
+
+    def report(self):
+        lines = ['%d operations failed, %d skipped as a result:' % (len(self.failures), len(self.skipped))]
+        for key, exc in self.failures:
+            lines.append('  %r: %s' % (key, exc))
+        return '\n'.join(lines)
@@ -68,6 +68,8 @@ def build_nodes(data, substitutions=None):
                                      disk=node_info['disk'],
                                      networks=node_info.get('networks', []),
                                      script=interpolate(node_info.get('script', None), substitutions))
+            if 'attempts' in node_info:
+                node.attempts_left = node_info['attempts']
             node.security_group_names = node_info.get('security_groups', [])
             collection.add(node)
     return collection
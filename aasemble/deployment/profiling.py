@@ -0,0 +1,203 @@
+import cProfile
+import json
+import logging
+import os
+import os.path
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+LOG = logging.getLogger(__name__)
+
+TOP_ALLOCATIONS = 50
+
+# CPU time of the calling thread, where the platform can tell.
+thread_time = getattr(time, 'thread_time', None)
+wall_time = getattr(time, 'perf_counter', time.time)
+process_time = getattr(time, 'process_time', None) or time.clock
+
+
+# What a task's wall time is split into besides CPU: provider requests,
+# queueing for a limiter slot, and sleeping between retries.
+WAITS = ('wait', 'limiter', 'backoff')
+
+
+class TaskTimes(object):
+    __slots__ = ('count', 'wall', 'cpu') + WAITS
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        for kind in WAITS:
+            setattr(self, kind, 0.0)
+
+    def as_dict(self):
+        d = {'count': self.count,
+             'wall': self.wall}
+        if thread_time is not None:
+            d['cpu'] = self.cpu
+        for kind in WAITS:
+            d[kind] = getattr(self, kind)
+        return d
+
+
+class Profiler(object):
+    # Profiles a whole CLI run: cProfile for the main thread and, separately,
+    # for every thread started while it runs (the pool workers), tracemalloc
+    # for allocations, and wall against CPU time for each operation the
+    # workers run, split into time in provider requests, in the limiter and
+    # in backoff, which is what tells waiting on the provider apart from
+    # work and queueing done here.
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.main = cProfile.Profile()
+        self.workers = []
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.locals = threading.local()
+        self.started = None
+        self.wall = None
+        self.cpu = None
+        self.main_cpu = None
+        self.snapshot = None
+        self.peak_memory = None
+
+    def start(self):
+        self.started = (wall_time(), process_time(), thread_time and thread_time())
+        if tracemalloc is not None:
+            tracemalloc.start()
+        threading.setprofile(self._profile_thread)
+        self.main.enable()
+
+    def stop(self):
+        self.main.disable()
+        threading.setprofile(None)
+
+        wall, cpu, main_cpu = self.started
+        self.wall = wall_time() - wall
+        self.cpu = process_time() - cpu
+        self.main_cpu = thread_time and thread_time() - main_cpu
+
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def _profile_thread(self, frame, event, arg):
+        # Runs as the first profile event of each new thread, and hands the
+        # thread over to a profiler of its own.
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Pythons whose cProfile is process wide allow just the one.
+            return
+        with self.lock:
+            self.workers.append(profiler)
+
+    def task(self, operation):
+        return _TaskContext(self, operation)
+
+    def record(self, kind, seconds):
+        # Counts time waited against the task this thread is running, if any.
+        task = getattr(self.locals, 'task', None)
+        if task is not None:
+            task.waits[kind] += seconds
+
+    def backoff(self, seconds):
+        # Sleep for the retry policy and limiter, so backoff is told apart
+        # from waiting on the provider.
+        start = wall_time()
+        try:
+            time.sleep(seconds)
+        finally:
+            self.record('backoff', wall_time() - start)
+
+    def instrument(self, driver):
+        # Times the connection's requests themselves, as Metrics.instrument
+        # does, which is the time spent waiting on the provider.
+        connection = driver.connection
+        request = connection.request
+
+        def instrumented(*args, **kwargs):
+            start = wall_time()
+            try:
+                return request(*args, **kwargs)
+            finally:
+                self.record('wait', wall_time() - start)
+
+        connection.request = instrumented
+        return driver
+
+    def _record_task(self, operation, wall, cpu, waits):
+        with self.lock:
+            times = self.tasks.get(operation)
+            if times is None:
+                times = self.tasks[operation] = TaskTimes()
+            times.count += 1
+            times.wall += wall
+            times.cpu += cpu
+            for kind in WAITS:
+                setattr(times, kind, getattr(times, kind) + waits[kind])
+
+    def summary(self):
+        with self.lock:
+            tasks = dict((operation, times.as_dict()) for operation, times in self.tasks.items())
+        return {'wall': self.wall,
+                'cpu': self.cpu,
+                'main_thread_cpu': self.main_cpu,
+                'worker_threads': len(self.workers),
+                'peak_memory': self.peak_memory,
+                'tasks': tasks}
+
+    def write(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.main.dump_stats(os.path.join(self.directory, 'main.prof'))
+
+        with self.lock:
+            workers = list(self.workers)
+        if workers:
+            stats = pstats.Stats(workers[0])
+            for profiler in workers[1:]:
+                stats.add(profiler)
+            stats.dump_stats(os.path.join(self.directory, 'workers.prof'))
+
+        if self.snapshot is not None:
+            self.snapshot.dump(os.path.join(self.directory, 'allocations.tracemalloc'))
+            with open(os.path.join(self.directory, 'allocations.txt'), 'w') as fp:
+                fp.write('Peak traced memory: %d bytes\n\n' % (self.peak_memory,))
+                for stat in self.snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    fp.write('%s\n' % (stat,))
+
+        with open(os.path.join(self.directory, 'summary.json'), 'w') as fp:
+            json.dump(self.summary(), fp, indent=2, sort_keys=True)
+
+        LOG.info('Profile written to %s' % (self.directory,))
+
+
+class _TaskContext(object):
+    def __init__(self, profiler, operation):
+        self.profiler = profiler
+        self.operation = operation
+
+    def __enter__(self):
+        self.waits = dict((kind, 0.0) for kind in WAITS)
+        self.previous = getattr(self.profiler.locals, 'task', None)
+        self.profiler.locals.task = self
+        self.wall = wall_time()
+        self.cpu = thread_time and thread_time()
+
+    def __exit__(self, *exc_info):
+        self.profiler.locals.task = self.previous
+        self.profiler._record_task(self.operation, wall_time() - self.wall,
+                                   thread_time and thread_time() - self.cpu or 0.0, self.waits)
@@ -0,0 +1,154 @@
+import json
+import logging
+import time
+
+import aasemble.deployment.cloud.models as cloud_models
+from aasemble.deployment import cache
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+APPLY_RECORD_VERSION = 2
+
+
+def dump(collection):
+    nodes = []
+    for node in collection.nodes:
+        nodes.append({'name': node.name,
+                      'flavor': node.flavor,
+                      'image': node.image,
+                      'disk': node.disk,
+                      'script': node.script,
+                      'security_groups': sorted(sg.name for sg in node.security_groups),
+                      'id': getattr(node.private, 'id', None),
+                      'public_ips': list(getattr(node.private, 'public_ips', None) or [])})
+
+    rules = []
+    for sgr in collection.security_group_rules:
+        rules.append({'security_group': sgr.security_group.name,
+                      'source_ip': sgr.source_ip,
+                      'source_group': sgr.source_group,
+                      'from_port': sgr.from_port,
+                      'to_port': sgr.to_port,
+                      'protocol': sgr.protocol})
+
+    return {'version': SNAPSHOT_VERSION,
+            'nodes': nodes,
+            'security_groups': sorted(sg.name for sg in collection.security_groups),
+            'security_group_rules': rules}
+
+
+def fingerprint(collection, *parts):
+    # Same fields as the snapshot, minus the provider's, in a stable order.
+    data = dump(collection)
+    for node in data['nodes']:
+        del node['id'], node['public_ips']
+    data['nodes'].sort(key=lambda node: node['name'])
+    data['security_group_rules'].sort(key=lambda rule: json.dumps(rule, sort_keys=True))
+    data['urls'] = [[url.__class__.__name__] + list(url._identity()) for url in collection.urls]
+    data['containers'] = collection.containers
+    data['tasks'] = collection.tasks
+    return cache.cache_key(data, *parts)
+
+
+def restore(data):
+    collection = cloud_models.Collection()
+
+    for name in data['security_groups']:
+        collection.security_groups.add(cloud_models.SecurityGroup(name=name))
+
+    for info in data['nodes']:
+        node = cloud_models.Node(name=info['name'],
+                                 flavor=info['flavor'],
+                                 image=info['image'],
+                                 disk=info['disk'],
+                                 script=info['script'],
+                                 networks=[],
+                                 private=cloud_models.NodeRecord(id=info['id'], public_ips=info['public_ips']))
+        node.security_group_names = set(info['security_groups'])
+        collection.nodes.add(node)
+
+    for info in data['security_group_rules']:
+        info = dict(info)
+        name = info.pop('security_group')
+        if collection.security_groups.get(name) is None:
+            collection.security_groups.add(cloud_models.SecurityGroup(name=name))
+        collection.security_group_rules.add(cloud_models.SecurityGroupRule(security_group=collection.security_groups[name], **info))
+
+    collection.connect()
+    return collection
+
+
+def merge(current, applied):
+    collection = cloud_models.Collection()
+
+    for source in (current, applied):
+        for node in source.nodes:
+            collection.nodes.add(node)
+        for security_group in source.security_groups:
+            collection.security_groups.add(security_group)
+        collection.security_group_rules |= set(source.security_group_rules)
+
+    return collection
+
+
+class Snapshot(object):
+    def __init__(self, path, ttl=0):
+        self.path = path
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return bool(self.path and self.ttl)
+
+    def load(self):
+        if not self.enabled:
+            return None
+
+        data = cache.load(self.path)
+        if data is None or data.get('version') != SNAPSHOT_VERSION:
+            return None
+
+        if not cache.is_fresh(data.get('created_at'), self.ttl):
+            LOG.info('Inventory snapshot has expired')
+            return None
+
+        LOG.info('Using inventory snapshot from %s' % (self.path,))
+        return restore(data)
+
+    def save(self, collection):
+        if not self.enabled:
+            return
+
+        data = dump(collection)
+        data['created_at'] = time.time()
+        cache.save(self.path, data)
+
+    def invalidate(self):
+        if self.path:
+            cache.remove(self.path)
+
+
+class ApplyRecord(object):
+    # What the last successful apply left behind: the fingerprint it was
+    # applied with, the provider ids of the stack's nodes and the names of
+    # its security groups.
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, fingerprint):
+        data = cache.load(self.path)
+        if data is None or data.get('version') != APPLY_RECORD_VERSION or data.get('fingerprint') != fingerprint:
+            return None
+        return data
+
+    def save(self, fingerprint, plan, nodes, security_groups=()):
+        cache.save(self.path, {'version': APPLY_RECORD_VERSION,
+                               'fingerprint': fingerprint,
+                               'created_at': time.time(),
+                               'plan': plan.as_dict(),
+                               'nodes': nodes,
+                               'security_groups': sorted(security_groups)})
+
+    def invalidate(self):
+        cache.remove(self.path)
@@ -0,0 +1,119 @@
+import threading
+import time
+import unittest
+
+from aasemble.deployment import exceptions
+from aasemble.deployment.cloud import base, models
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from aasemble.deployment.cloud import aio
+except (ImportError, SyntaxError):  # Python 2
+    aio = None
+
+
+@unittest.skipIf(aio is None, 'The asyncio engine needs Python 3')
+class AsyncioSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        super(AsyncioSchedulerTests, self).setUp()
+        self.executor = ThreadPoolExecutor(4)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(AsyncioSchedulerTests, self).tearDown()
+
+    def record(self, arg):
+        with self.lock:
+            self.events.append(arg)
+        return arg.upper()
+
+    def fail(self, arg):
+        raise ValueError(arg)
+
+    def test_respects_requirements(self):
+        scheduler = aio.AsyncioScheduler(self.executor)
+        scheduler.add('c', self.record, 'c', requires=['a', 'b'])
+        scheduler.add('b', self.record, 'b', requires=['a'])
+        scheduler.add('a', self.record, 'a')
+
+        tasks = scheduler.run()
+
+        self.assertEqual(self.events, ['a', 'b', 'c'])
+        self.assertEqual([t.result for t in tasks], ['C', 'B', 'A'])
+        self.assertGreaterEqual(scheduler.tasks['c'].ready_at, scheduler.tasks['b'].finished_at)
+
+    def test_failure_skips_dependents_and_raises(self):
+        scheduler = aio.AsyncioScheduler(self.executor)
+        scheduler.add('b', self.record, 'b', requires=['a'])
+        scheduler.add('a', self.fail, 'a')
+        scheduler.add('c', self.record, 'c')
+
+        with self.assertRaises(exceptions.ResourcesFailedException) as cm:
+            scheduler.run()
+
+        self.assertEqual([key for key, exc in cm.exception.failures], ['a'])
+        self.assertEqual(self.events, ['c'])
+        self.assertEqual(scheduler.tasks['b'].state, 'skipped')
+        self.assertIsInstance(scheduler.tasks['b'].exception, exceptions.DependencyFailedException)
+
+    def test_interrupt_finishes_task_and_propagates(self):
+        def interrupt(arg):
+            raise KeyboardInterrupt()
+
+        scheduler = aio.AsyncioScheduler(self.executor)
+        scheduler.add('a', interrupt, 'a')
+        scheduler.add('b', self.record, 'b', requires=['a'])
+
+        self.assertRaises(KeyboardInterrupt, scheduler.run)
+        self.assertEqual(scheduler.tasks['a'].state, 'failed')
+        self.assertEqual(scheduler.tasks['b'].state, 'skipped')
+        self.assertEqual(self.events, [])
+
+    def test_operation_limits(self):
+        self.running = 0
+        self.max_running = 0
+
+        def slow(arg):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(0.01)
+            with self.lock:
+                self.running -= 1
+
+        scheduler = aio.AsyncioScheduler(self.executor, {'slow': 1})
+        for i in range(5):
+            scheduler.add(i, slow, i)
+        scheduler.run()
+
+        self.assertEqual(self.max_running, 1)
+
+
+@unittest.skipIf(aio is None, 'The asyncio engine needs Python 3')
+class AsyncioEngineTests(unittest.TestCase):
+    def test_driver_uses_asyncio_scheduler(self):
+        driver = base.CloudDriver(engine='asyncio', executor=ThreadPoolExecutor(2))
+        self.assertIsInstance(driver.get_scheduler(), aio.AsyncioScheduler)
+
+    def test_detect_resources(self):
+        node = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10)
+        node.security_group_names = set(['webapp'])
+        sg = models.SecurityGroup(name='webapp')
+
+        class TestDriver(base.CloudDriver):
+            def _get_relevant_node_pages(self):
+                return [[node]]
+
+            def _aasemble_node_from_provider_node(self, provider_node):
+                return provider_node
+
+            def detect_firewalls(self):
+                return (set([sg]), set())
+
+        collection = TestDriver(engine='asyncio', executor=ThreadPoolExecutor(2)).detect_resources()
+
+        self.assertIn(node, collection.nodes)
+        self.assertIn(sg, collection.nodes['node1'].security_groups)
@@ -1,7 +1,9 @@
 import os.path
 import unittest
+import xml.etree.ElementTree as ET
 
 import libcloud.common.exceptions
+from libcloud.compute.base import Node, NodeSize
 
 import mock
 
@@ -9,6 +11,8 @@ from six.moves import configparser
 
 import aasemble.deployment.cloud.aws as aws
 import aasemble.deployment.cloud.models as cloud_models
+import aasemble.deployment.cloud.plan as plan
+from aasemble.deployment import exceptions
 
 
 test_access_key = 'lewirhtqlrhflwdjfhalsf'
@@ -19,6 +23,9 @@ class FakeThreadPool(object):
     def map(self, func, iterable):
         return list(map(func, iterable))
 
+    def apply_async(self, func, args):
+        func(*args)
+
 
 class AWSDriverTests(unittest.TestCase):
     def setUp(self):
@@ -57,17 +64,84 @@ class AWSDriverTests(unittest.TestCase):
                          ((test_access_key, test_secret_key),
                           {'region': 'us-east-1'}))
 
+    def test_is_throttling_error(self):
+        self.assertTrue(self.cloud_driver.is_throttling_error(libcloud.common.exceptions.BaseHTTPError(503, 'RequestLimitExceeded: Request limit exceeded.')))
+        self.assertTrue(self.cloud_driver.is_throttling_error(libcloud.common.exceptions.RateLimitReachedError()))
+        self.assertFalse(self.cloud_driver.is_throttling_error(libcloud.common.exceptions.BaseHTTPError(400, 'InvalidGroup.Duplicate: already exists')))
+        self.assertFalse(self.cloud_driver.is_throttling_error(ValueError()))
+
+    def test_is_transient_error(self):
+        self.assertTrue(self.cloud_driver.is_transient_error(libcloud.common.exceptions.BaseHTTPError(500, 'InternalError: An internal error has occurred')))
+        self.assertTrue(self.cloud_driver.is_transient_error(libcloud.common.exceptions.BaseHTTPError(400, 'Unavailable: The server is overloaded')))
+        self.assertFalse(self.cloud_driver.is_transient_error(libcloud.common.exceptions.BaseHTTPError(400, 'InvalidAMIID.NotFound: no such image')))
+
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
-    def test_volume_size_map(self, connection):
+    def test_fetch_volume_sizes(self, connection):
         class AWSVolume(object):
             def __init__(self, id, size):
                 self.id = id
                 self.size = size
 
-        connection.list_volumes.return_value = [AWSVolume('vol-126375124', 100), AWSVolume('vol-1ad63253', 200)]
+        connection.list_volumes.side_effect = [[AWSVolume('vol-126375124', 100), AWSVolume('vol-1ad63253', 200)],
+                                               [AWSVolume('vol-2cc53a21', 300)]]
+
+        with mock.patch.object(aws, 'MAX_FILTER_VALUES', 2):
+            self.cloud_driver._fetch_volume_sizes(['vol-1ad63253', 'vol-2cc53a21', 'vol-126375124', 'vol-1ad63253'])
+
+        self.assertEqual(self.cloud_driver._volume_size_map, {'vol-126375124': 100,
+                                                              'vol-1ad63253': 200,
+                                                              'vol-2cc53a21': 300})
+        self.assertEqual(sorted(kwargs['ex_filters']['volume-id'] for args, kwargs in connection.list_volumes.call_args_list),
+                         [['vol-126375124', 'vol-1ad63253'], ['vol-2cc53a21']])
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_volume_size_looks_up_missing_volumes(self, connection):
+        class AWSVolume(object):
+            def __init__(self, id, size):
+                self.id = id
+                self.size = size
+
+        self.cloud_driver._volume_size_map = {'vol-126375124': 100}
+        connection.list_volumes.return_value = [AWSVolume('vol-1ad63253', 200)]
+
+        self.assertEqual(self.cloud_driver._volume_size('vol-126375124'), 100)
+        self.assertFalse(connection.list_volumes.called)
+
+        self.assertEqual(self.cloud_driver._volume_size('vol-1ad63253'), 200)
+        connection.list_volumes.assert_called_once_with(ex_filters={'volume-id': ['vol-1ad63253']})
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_fetch_provider_node(self, connection):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27,
+                                 private=cloud_models.NodeRecord(id='i-1234567'))
+        connection.list_nodes.return_value = [mock.sentinel.ec2node]
+
+        self.assertEqual(self.cloud_driver.provider_node(node), mock.sentinel.ec2node)
+        connection.list_nodes.assert_called_once_with(ex_node_ids=['i-1234567'])
 
-        self.assertEqual(self.cloud_driver.volume_size_map, {'vol-126375124': 100,
-                                                             'vol-1ad63253': 200})
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_fetch_provider_node_gone(self, connection):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27,
+                                 private=cloud_models.NodeRecord(id='i-1234567'))
+
+        connection.list_nodes.return_value = []
+        self.assertRaises(exceptions.NodeNotFoundException, self.cloud_driver.provider_node, node)
+
+        connection.list_nodes.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidInstanceID.NotFound: The instance ID does not exist')
+        self.assertRaises(exceptions.NodeNotFoundException, self.cloud_driver.provider_node, node)
+
+        connection.list_nodes.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'UnauthorizedOperation: No')
+        self.assertRaises(libcloud.common.exceptions.BaseHTTPError, self.cloud_driver.provider_node, node)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_delete_node_already_gone(self, connection):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27,
+                                 private=cloud_models.NodeRecord(id='i-1234567'))
+        connection.list_nodes.return_value = []
+
+        self.cloud_driver.delete_node(node)
+
+        self.assertFalse(connection.destroy_node.called)
 
     def _sg_list(self):
         class AWSSecurityGroup(object):
@@ -154,6 +228,17 @@ class AWSDriverTests(unittest.TestCase):
     def test_is_node_relevant_when_running(self):
         self._test_is_node_relevant('running', True)
 
+    def test_is_node_relevant_in_namespace(self):
+        self.cloud_driver.namespace = 'testns'
+
+        def ec2node(tags):
+            return Node(id='i-1', name='web1', state='running', public_ips=[], private_ips=[],
+                        driver=mock.Mock(), extra={'tags': tags})
+
+        self.assertTrue(self.cloud_driver._is_node_relevant(ec2node({'Name': 'web1', 'aasemble_namespace': 'testns'})))
+        self.assertFalse(self.cloud_driver._is_node_relevant(ec2node({'Name': 'web1', 'aasemble_namespace': 'other'})))
+        self.assertFalse(self.cloud_driver._is_node_relevant(ec2node({'Name': 'web1'})))
+
     def test_aasemble_node_from_provider_node(self):
         class AWSNode(object):
             def __init__(self, name, size, image, vol_id):
@@ -173,6 +258,49 @@ class AWSDriverTests(unittest.TestCase):
         self.assertEqual(node.security_group_names, set(['sg1', 'sg2']))
         self.assertEqual(node.private, awsnode)
 
+    def test_aasemble_node_from_provider_node_falls_back_to_extra(self):
+        class AWSNode(object):
+            name = 'testnode1'
+            size = None
+            image = None
+            extra = {'block_device_mapping': [{'ebs': {'volume_id': 'vol-1234567'}}],
+                     'groups': [],
+                     'instance_type': 'm4.large',
+                     'image_id': 'ami-987654abc'}
+
+        self.cloud_driver._volume_size_map = {'vol-1234567': 100}
+        node = self.cloud_driver._aasemble_node_from_provider_node(AWSNode())
+        self.assertEqual(node.flavor, 'm4.large')
+        self.assertEqual(node.image, 'ami-987654abc')
+
+    def test_aasemble_node_from_unnamed_batch_instance(self):
+        def ec2node(id, name):
+            return Node(id=id, name=name, state='running', public_ips=[], private_ips=[], driver=mock.Mock(),
+                        extra={'tags': {'Name': name, 'aasemble_batch': 'aasemble-batch-1'},
+                               'block_device_mapping': [{'ebs': {'volume_id': 'vol-1234567'}}],
+                               'groups': []})
+
+        self.cloud_driver._volume_size_map = {'vol-1234567': 100}
+
+        self.assertEqual(self.cloud_driver._aasemble_node_from_provider_node(ec2node('i-1', 'aasemble-batch-1')).name,
+                         'aasemble-batch-1-i-1')
+        self.assertEqual(self.cloud_driver._aasemble_node_from_provider_node(ec2node('i-2', 'web2')).name, 'web2')
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_update_node_sets_security_groups(self, connection):
+        self.cloud_driver._sg_name_to_id = {'web': 'sg-1', 'ssh': 'sg-2'}
+        current = cloud_models.Node(name='webapp', image='ami-1', flavor='m4.large', disk=10, networks=[],
+                                    private=mock.sentinel.ec2node)
+        desired = cloud_models.Node(name='webapp', image='ami-1', flavor='m4.large', disk=10, networks=[],
+                                    security_groups=set([cloud_models.SecurityGroup(name='web'),
+                                                         cloud_models.SecurityGroup(name='ssh')]))
+
+        self.cloud_driver.update_node(plan.Change(plan.UPDATE, 'node', 'webapp', desired=desired, current=current,
+                                                  fields=('security_groups',)))
+
+        connection.ex_modify_instance_attribute.assert_called_with(mock.sentinel.ec2node,
+                                                                   {'GroupId.1': 'sg-2', 'GroupId.2': 'sg-1'})
+
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
     def test_detect_firewalls(self, connection):
         class AWSSecurityGroup(object):
@@ -213,6 +341,43 @@ class AWSDriverTests(unittest.TestCase):
         self.assertEqual(self.cloud_driver.detect_firewalls(),
                          (expected_sgs, expected_sgrs))
 
+    def test_detection_stages(self):
+        stages = dict((name, requires) for name, func, requires in self.cloud_driver._detection_stages())
+        self.assertEqual(stages, {'nodes': (),
+                                  'security_groups': (),
+                                  'firewalls': ('security_groups',)})
+
+    def test_detection_stages_targeted(self):
+        stages = dict((name, requires) for name, func, requires in self.cloud_driver._detection_stages(set(['web1']), set(['www'])))
+        self.assertNotIn('security_group_ids', stages)
+        self.assertEqual(stages['firewalls'], ('security_groups',))
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_detect_resources_targeted_fetches_group_ids(self, connection):
+        class AWSSecurityGroup(object):
+            def __init__(self, id, name, ingress_rules):
+                self.id = id
+                self.name = name
+                self.ingress_rules = ingress_rules
+
+        www = AWSSecurityGroup(id='sg-1234567', name='www',
+                               ingress_rules=[{'from_port': '22', 'to_port': '22', 'protocol': 'tcp',
+                                               'group_pairs': [{'group_id': 'sg-7654321'}]}])
+        bastion = AWSSecurityGroup(id='sg-7654321', name='bastion', ingress_rules=[])
+
+        connection.list_nodes.return_value = []
+        connection.ex_get_security_groups.side_effect = lambda filters: 'group-id' in filters and [bastion] or [www]
+
+        desired = cloud_models.Collection()
+        desired.security_groups.add(cloud_models.SecurityGroup(name='www'))
+        cloud_driver = aws.AWSDriver(access_key=test_access_key, secret_key=test_secret_key, region='us-east-1')
+        collection = cloud_driver.detect_resources(desired=desired)
+
+        self.assertEqual([sgr.source_group for sgr in collection.security_group_rules], ['bastion'])
+        self.assertEqual(connection.ex_get_security_groups.call_args_list,
+                         [mock.call(filters={'group-name': ['www']}),
+                          mock.call(filters={'group-id': ['sg-7654321']})])
+
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.apply_mappings')
     def test_get_image(self, apply_mappings, connection):
@@ -230,9 +395,8 @@ class AWSDriverTests(unittest.TestCase):
 
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
     def test_get_size_real(self, connection):
-        class Size(object):
-            def __init__(self, id):
-                self.id = id
+        def Size(id):
+            return NodeSize(id=id, name=id, ram=1024, disk=10, bandwidth=None, price=0.1, driver=connection)
 
         size1 = Size('m4.large')
         size2 = Size('m4.xlarge')
@@ -240,7 +404,10 @@ class AWSDriverTests(unittest.TestCase):
 
         connection.list_sizes.return_value = [size1, size2, size3]
 
-        self.assertEqual(self.cloud_driver._get_size_real('m4.xlarge'), size2)
+        self.assertEqual(self.cloud_driver._get_size_real('m4.xlarge').id, size2.id)
+        self.assertEqual(self.cloud_driver._get_size_real('m4.large').id, size1.id)
+        self.assertEqual(len(connection.list_sizes.call_args_list), 1,
+                         'Did not cache size catalog')
 
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
     @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._get_size')
@@ -283,6 +450,154 @@ class AWSDriverTests(unittest.TestCase):
                                                   added_script_info=True,
                                                   added_namespace_info=True)
 
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._launch_kwargs')
+    def test_create_nodes(self, _launch_kwargs, connection):
+        nodes = [cloud_models.Node(name='web%d' % i, image='ami-1234567', flavor='t2.small', networks=[], disk=27)
+                 for i in range(1, 4)]
+        ec2nodes = [mock.MagicMock(id='i-%d' % i, extra={}) for i in range(1, 4)]
+
+        _launch_kwargs.return_value = {'name': 'web1'}
+        connection.create_node.return_value = ec2nodes
+
+        self.cloud_driver.create_nodes(nodes)
+
+        batch_name = self.cloud_driver._batch_name(nodes)
+        self.assertTrue(batch_name.startswith('aasemble-batch-'))
+        _launch_kwargs.assert_called_once_with(nodes[0])
+        connection.create_node.assert_called_once_with(name=batch_name, ex_metadata={'aasemble_batch': batch_name},
+                                                       ex_mincount=3, ex_maxcount=3)
+        self.assertEqual(connection.ex_create_tags.call_args_list,
+                         [mock.call(ec2nodes[0], {'Name': 'web1'}),
+                          mock.call(ec2nodes[1], {'Name': 'web2'}),
+                          mock.call(ec2nodes[2], {'Name': 'web3'})])
+        self.assertEqual([node.private for node in nodes], ec2nodes)
+        self.assertEqual(ec2nodes[2].name, 'web3')
+        self.assertEqual(ec2nodes[2].extra['tags'], {'Name': 'web3'})
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.create_node')
+    def test_create_nodes_single(self, create_node):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27)
+        self.cloud_driver.create_nodes([node])
+        create_node.assert_called_once_with(node)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._launch_kwargs')
+    def test_create_node_client_token(self, _launch_kwargs, connection):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27)
+        _launch_kwargs.side_effect = lambda node: {'name': node.name}
+        self.cloud_driver.stack_fingerprint = 'stack1'
+
+        self.cloud_driver.create_node(node)
+        self.cloud_driver.create_node(node)
+
+        first, second = connection.create_node.call_args_list
+        self.assertEqual(first, second)
+        self.assertEqual(first[1]['ex_clienttoken'], self.cloud_driver.idempotency_key([node]))
+
+        self.cloud_driver.stack_fingerprint = 'stack2'
+        self.cloud_driver.create_node(node)
+        self.assertNotEqual(connection.create_node.call_args[1]['ex_clienttoken'], first[1]['ex_clienttoken'])
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._launch_kwargs')
+    def test_create_node_client_token_of_terminated_instance(self, _launch_kwargs, connection):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27)
+        _launch_kwargs.return_value = {'name': 'web1'}
+        self.cloud_driver.stack_fingerprint = 'stack1'
+        terminated = libcloud.common.exceptions.BaseHTTPError(400, 'IdempotentInstanceTerminated: The client token was used by a terminated instance')
+        connection.create_node.side_effect = [terminated, 'ec2node']
+
+        self.cloud_driver.create_node(node)
+
+        self.assertEqual(node.private, 'ec2node')
+        self.assertEqual([kwargs['ex_clienttoken'] for args, kwargs in connection.create_node.call_args_list],
+                         [self.cloud_driver.idempotency_key([node]), self.cloud_driver.idempotency_key([node], 1)])
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_create_node_other_errors_are_raised(self, connection):
+        node = cloud_models.Node(name='web1', image='ami-1234567', flavor='t2.small', networks=[], disk=27)
+        self.cloud_driver.stack_fingerprint = 'stack1'
+        connection.create_node.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidAMIID.NotFound: no such image')
+
+        self.assertRaises(libcloud.common.exceptions.BaseHTTPError, self.cloud_driver._run_instances, [node], {})
+        self.assertEqual(len(connection.create_node.call_args_list), 1)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._describe_instance_pages')
+    def test_list_candidate_node_pages(self, _describe_instance_pages):
+        _describe_instance_pages.return_value = [['a'], ['b']]
+        self.assertEqual(list(self.cloud_driver._list_candidate_node_pages()), [['a'], ['b']])
+        _describe_instance_pages.assert_called_once_with({'instance-state-name': ['pending', 'running', 'stopping', 'stopped']})
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._describe_instance_pages')
+    def test_list_candidate_node_pages_with_namespace(self, _describe_instance_pages):
+        self.cloud_driver.namespace = 'testns'
+        list(self.cloud_driver._list_candidate_node_pages())
+        _describe_instance_pages.assert_called_once_with({'instance-state-name': ['pending', 'running', 'stopping', 'stopped'],
+                                                          'tag:aasemble_namespace': 'testns'})
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver._describe_instance_pages')
+    def test_list_candidate_node_pages_by_name(self, _describe_instance_pages):
+        _describe_instance_pages.side_effect = [[['a']], [['b']]]
+
+        with mock.patch.object(aws, 'MAX_FILTER_VALUES', 2):
+            self.assertEqual(list(self.cloud_driver._list_candidate_node_pages(set(['web1', 'web2', 'web3']))), [['a'], ['b']])
+
+        self.assertEqual(_describe_instance_pages.call_args_list,
+                         [mock.call({'instance-state-name': aws.LIVE_INSTANCE_STATES, 'tag:Name': ['web1', 'web2']}),
+                          mock.call({'instance-state-name': aws.LIVE_INSTANCE_STATES, 'tag:Name': ['web3']})])
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_describe_instance_pages(self, connection):
+        def response(reservations, next_token=None):
+            body = '<DescribeInstancesResponse xmlns="%s"><reservationSet>' % (aws.NAMESPACE,)
+            body += ''.join('<item><instancesSet><item><instanceId>%s</instanceId></item></instancesSet></item>' % (id,)
+                            for id in reservations)
+            body += '</reservationSet>'
+            if next_token:
+                body += '<nextToken>%s</nextToken>' % (next_token,)
+            return mock.MagicMock(object=ET.fromstring(body + '</DescribeInstancesResponse>'))
+
+        class EC2Node(object):
+            def __init__(self, id):
+                self.id = id
+                self.public_ips = []
+
+        requests = []
+        responses = [response(['i-1', 'i-2'], next_token='page2'), response(['i-3'])]
+
+        def request(path, params):
+            requests.append(dict(params))
+            return responses.pop(0)
+
+        connection.connection.request.side_effect = request
+        connection._build_filters.return_value = {'Filter.1.Name': 'instance-state-name'}
+        connection._to_nodes.side_effect = lambda elem, xpath: [EC2Node(item.text) for item in elem.iter('{%s}instanceId' % (aws.NAMESPACE,))]
+        connection.ex_describe_addresses.side_effect = lambda ec2nodes: dict((ec2node.id, ['10.0.0.%s' % (ec2node.id[2:],)]) for ec2node in ec2nodes)
+
+        pages = list(self.cloud_driver._describe_instance_pages({'instance-state-name': ['running']}))
+
+        self.assertEqual([[ec2node.id for ec2node in page] for page in pages], [['i-1', 'i-2'], ['i-3']])
+        self.assertEqual(pages[1][0].public_ips, ['10.0.0.3'])
+        self.assertEqual(requests, [{'Action': 'DescribeInstances', 'MaxResults': 1000, 'Filter.1.Name': 'instance-state-name'},
+                                    {'Action': 'DescribeInstances', 'MaxResults': 1000, 'Filter.1.Name': 'instance-state-name',
+                                     'NextToken': 'page2'}])
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_live_security_group_names(self, connection):
+        connection.ex_get_security_groups.return_value = self._sg_list()[1:]
+
+        self.assertEqual(self.cloud_driver.live_security_group_names(set(['www', 'gone'])), set(['www']))
+        connection.ex_get_security_groups.assert_called_once_with(filters={'group-name': ['gone', 'www']})
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    def test_detect_firewalls_by_name(self, connection):
+        connection.ex_get_security_groups.return_value = []
+
+        self.cloud_driver.detect_firewalls(set(['www', 'default']))
+
+        connection.ex_get_security_groups.assert_called_once_with(filters={'group-name': ['default', 'www']})
+
     def test_add_key_pair_info_no_keypair(self):
         kwargs = {}
         self.cloud_driver._add_key_pair_info(kwargs)
@@ -303,6 +618,10 @@ class AWSDriverTests(unittest.TestCase):
         connection.ex_find_or_import_keypair_by_key_material.assert_called_with('this is not a real key')
         self.assertEqual(kwargs, {'ex_keyname': 'thekeyname'})
 
+        self.cloud_driver._add_key_pair_info({})
+        self.assertEqual(len(connection.ex_find_or_import_keypair_by_key_material.call_args_list), 1,
+                         'Did not remember key pair')
+
     def test_add_script_info_no_script(self):
         node = cloud_models.Node(name='webapp',
                                  image='trusty',
@@ -388,6 +707,109 @@ class AWSDriverTests(unittest.TestCase):
                                                                           protocol='tcp',
                                                                           group_pairs=[{'group_name': 'www'}])
 
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_add_security_group_rule_duplicate_does_not_raise(self, sg_name_to_id, connection):
+        sg = cloud_models.SecurityGroup(name='sg')
+        sgr = cloud_models.SecurityGroupRule(security_group=sg, from_port=22, to_port=22, source_ip='0.0.0.0/0', protocol='tcp')
+        connection.ex_authorize_security_group_ingress.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidPermission.Duplicate: exists')
+        self.cloud_driver.create_security_group_rule(sgr)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_delete_security_group(self, sg_name_to_id, connection):
+        sg = cloud_models.SecurityGroup(name='sg1')
+        self.cloud_driver.delete_security_group(sg)
+        sg_name_to_id.assert_called_with('sg1')
+        connection.ex_delete_security_group_by_id.assert_called_with(sg_name_to_id.return_value)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_delete_security_group_already_gone(self, sg_name_to_id, connection):
+        sg = cloud_models.SecurityGroup(name='sg1')
+        connection.ex_delete_security_group_by_id.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidGroup.NotFound: gone')
+        self.cloud_driver.delete_security_group(sg)
+
+        sg_name_to_id.side_effect = KeyError('sg1')
+        connection.ex_delete_security_group_by_id.reset_mock()
+        self.cloud_driver.delete_security_group(sg)
+        self.assertFalse(connection.ex_delete_security_group_by_id.called)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_delete_security_group_other_error_raises(self, sg_name_to_id, connection):
+        sg = cloud_models.SecurityGroup(name='sg1')
+        connection.ex_delete_security_group_by_id.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'DependencyViolation: in use')
+        self.assertRaises(libcloud.common.exceptions.BaseHTTPError, self.cloud_driver.delete_security_group, sg)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_delete_security_group_rule(self, sg_name_to_id, connection):
+        sg = cloud_models.SecurityGroup(name='sg')
+        sgr = cloud_models.SecurityGroupRule(security_group=sg, from_port=123, to_port=234, source_group='www', protocol='tcp')
+        self.cloud_driver.delete_security_group_rule(sgr)
+        connection.ex_revoke_security_group_ingress.assert_called_with(id=sg_name_to_id.return_value,
+                                                                       from_port=123,
+                                                                       to_port=234,
+                                                                       protocol='tcp',
+                                                                       group_pairs=[{'group_name': 'www'}])
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_delete_security_group_rule_already_gone(self, sg_name_to_id, connection):
+        sg = cloud_models.SecurityGroup(name='sg')
+        sgr = cloud_models.SecurityGroupRule(security_group=sg, from_port=22, to_port=22, source_ip='0.0.0.0/0', protocol='tcp')
+        connection.ex_revoke_security_group_ingress.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidPermission.NotFound: gone')
+        self.cloud_driver.delete_security_group_rule(sgr)
+
+        connection.ex_revoke_security_group_ingress.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'UnauthorizedOperation: no')
+        self.assertRaises(libcloud.common.exceptions.BaseHTTPError, self.cloud_driver.delete_security_group_rule, sgr)
+
+    def _rules(self):
+        sg = cloud_models.SecurityGroup(name='sg')
+        return [cloud_models.SecurityGroupRule(security_group=sg, from_port=22, to_port=22, source_ip='0.0.0.0/0', protocol='tcp'),
+                cloud_models.SecurityGroupRule(security_group=sg, from_port=80, to_port=81, source_group='www', protocol='tcp')]
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_add_security_group_rules(self, sg_name_to_id, connection):
+        sg_name_to_id.return_value = 'sg-1234'
+
+        self.cloud_driver.create_security_group_rules(self._rules())
+
+        sg_name_to_id.assert_called_once_with('sg')
+        connection.connection.request.assert_called_once_with(connection.path,
+                                                              params={'Action': 'AuthorizeSecurityGroupIngress',
+                                                                      'GroupId': 'sg-1234',
+                                                                      'IpPermissions.1.IpProtocol': 'tcp',
+                                                                      'IpPermissions.1.FromPort': 22,
+                                                                      'IpPermissions.1.ToPort': 22,
+                                                                      'IpPermissions.1.IpRanges.1.CidrIp': '0.0.0.0/0',
+                                                                      'IpPermissions.2.IpProtocol': 'tcp',
+                                                                      'IpPermissions.2.FromPort': 80,
+                                                                      'IpPermissions.2.ToPort': 81,
+                                                                      'IpPermissions.2.Groups.1.GroupName': 'www'})
+        self.assertFalse(connection.ex_authorize_security_group_ingress.called)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_add_security_group_rules_duplicate_falls_back_to_single_rules(self, sg_name_to_id, connection):
+        duplicate = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidPermission.Duplicate: exists')
+        connection.connection.request.side_effect = duplicate
+        connection.ex_authorize_security_group_ingress.side_effect = [duplicate, True]
+
+        self.cloud_driver.create_security_group_rules(self._rules())
+
+        self.assertEqual(len(connection.ex_authorize_security_group_ingress.call_args_list), 2)
+
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.aws.AWSDriver.sg_name_to_id')
+    def test_add_security_group_rules_other_error_raises(self, sg_name_to_id, connection):
+        connection.connection.request.side_effect = libcloud.common.exceptions.BaseHTTPError(400, 'InvalidGroup.NotFound: nope')
+
+        self.assertRaises(libcloud.common.exceptions.BaseHTTPError, self.cloud_driver.create_security_group_rules, self._rules())
+        self.assertFalse(connection.ex_authorize_security_group_ingress.called)
+
     def test_block_device_mappings(self):
         node = cloud_models.Node(name='webapp',
                                  image='trusty',
@@ -1,12 +1,18 @@
 import json
+import socket
+import threading
 import unittest
+from multiprocessing.pool import ThreadPool
+
+from libcloud.common.exceptions import RateLimitReachedError
 
 import mock
 
 from testfixtures import log_capture
 
 import aasemble.client
-from aasemble.deployment.cloud import base, models
+from aasemble.deployment import exceptions
+from aasemble.deployment.cloud import base, limiter, metrics, models, plan, retry
 
 
 class CloudDriverTests(unittest.TestCase):
@@ -68,8 +74,11 @@ class CloudDriverTests(unittest.TestCase):
                                            protocol='tcp')
 
         class TestDriver(base.CloudDriver):
-            def detect_nodes(self):
-                return set([node1, node2])
+            def _get_relevant_node_pages(self):
+                return [[node1], [node2]]
+
+            def _aasemble_node_from_provider_node(self, node):
+                return node
 
             def detect_firewalls(self):
                 return (set([sg_webapp, sg_ssh]), set([sgr_https, sgr_ssh]))
@@ -91,6 +100,72 @@ class CloudDriverTests(unittest.TestCase):
         self.assertIn(sgr_https, collection.security_group_rules)
         self.assertIn(sgr_ssh, collection.security_group_rules)
 
+    def test_detect_resources_targeted(self):
+        desired = models.Collection()
+        desired.nodes.add(models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+        desired.security_groups.add(models.SecurityGroup(name='webapp'))
+
+        sg_webapp = models.SecurityGroup(name='webapp')
+        sg_other = models.SecurityGroup(name='other')
+        sgr_webapp = models.SecurityGroupRule(security_group=sg_webapp, source_ip='0.0.0.0/0',
+                                              from_port=443, to_port=443, protocol='tcp')
+        sgr_other = models.SecurityGroupRule(security_group=sg_other, source_ip='0.0.0.0/0',
+                                             from_port=22, to_port=22, protocol='tcp')
+
+        class Node(object):
+            def __init__(self, name):
+                self.name = name
+
+        class TestDriver(base.CloudDriver):
+            def _list_candidate_node_pages(selff, names=None):
+                self.assertEqual(names, set(['node1']))
+                yield [Node('node1'), Node('node2')]
+
+            def _aasemble_node_from_provider_node(selff, node):
+                aasemble_node = models.Node(name=node.name, flavor='small', image='trusty', networks=[], disk=10)
+                aasemble_node.security_group_names = set()
+                return aasemble_node
+
+            def detect_firewalls(selff, names=None):
+                self.assertEqual(names, set(['webapp']))
+                return (set([sg_webapp, sg_other]), set([sgr_webapp, sgr_other]))
+
+        collection = TestDriver().detect_resources(desired=desired)
+
+        self.assertEqual(list(collection.nodes.keys()), ['node1'])
+        self.assertEqual(list(collection.security_groups.keys()), ['webapp'])
+        self.assertEqual(collection.security_group_rules, set([sgr_webapp]))
+
+    def test_detect_resources_runs_stages(self):
+        calls = []
+
+        class TestDriver(base.CloudDriver):
+            def _get_relevant_node_pages(selff):
+                calls.append('nodes')
+                return [[mock.sentinel.node]]
+
+            def _prefetch_volumes(selff, provider_nodes):
+                self.assertEqual(provider_nodes, [mock.sentinel.node])
+                calls.append('volumes')
+
+            def _aasemble_node_from_provider_node(selff, node):
+                self.assertEqual(calls[-1:], ['other'])
+                aasemble_node = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10)
+                aasemble_node.security_group_names = set()
+                return aasemble_node
+
+            def detect_firewalls(selff):
+                return (set(), set())
+
+            def _detection_stages(selff, node_names=None, security_group_names=None):
+                return super(TestDriver, selff)._detection_stages(node_names, security_group_names) + \
+                    [('other', lambda results: calls.append('other'), ('nodes',))]
+
+        collection = TestDriver().detect_resources()
+
+        self.assertEqual(calls, ['nodes', 'volumes', 'other'])
+        self.assertEqual(list(collection.nodes.keys()), ['node1'])
+
     def test_is_node_relevant(self):
         class Node(object):
             def __init__(self, name, namespace=None):
@@ -114,8 +189,8 @@ class CloudDriverTests(unittest.TestCase):
 
     def test_detect_nodes_converts_to_aasemble_nodes_from_provider_nodes(self):
         class TestDriver(base.CloudDriver):
-            def _get_relevant_nodes(self):
-                return [mock.sentinel.node1, mock.sentinel.node2]
+            def _get_relevant_node_pages(self, names=None):
+                return [[mock.sentinel.node1], [mock.sentinel.node2]]
 
             def _aasemble_node_from_provider_node(self, node):
                 node.converted = True
@@ -129,6 +204,113 @@ class CloudDriverTests(unittest.TestCase):
         self.assertTrue(mock.sentinel.node1.converted)
         self.assertTrue(mock.sentinel.node2.converted)
 
+    def test_live_node_ids(self):
+        class Node(object):
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+
+        class TestDriver(base.CloudDriver):
+            def _list_candidate_node_pages(selff, names=None):
+                yield [Node('1', 'node1'), Node('2', 'other')]
+                yield [Node('3', 'node2')]
+
+            def _aasemble_node_from_provider_node(selff, node):
+                raise AssertionError('should not convert nodes')
+
+        self.assertEqual(TestDriver().live_node_ids(set(['node1', 'node2'])), set(['1', '3']))
+
+    def test_live_security_group_names(self):
+        class TestDriver(base.CloudDriver):
+            def detect_firewalls(selff, names=None):
+                self.assertEqual(names, set(['web', 'db']))
+                return set([models.SecurityGroup(name='web')]), set()
+
+        self.assertEqual(TestDriver().live_security_group_names(set(['web', 'db'])), set(['web']))
+
+    def test_iter_nodes_converts_page_by_page(self):
+        calls = []
+
+        class Node(object):
+            def __init__(self, name):
+                self.name = name
+
+        class TestDriver(base.CloudDriver):
+            def _list_candidate_node_pages(selff, names=None):
+                calls.append('page1')
+                yield [Node('node1'), Node('other')]
+                calls.append('page2')
+                yield [Node('node2')]
+
+            def _is_node_relevant(selff, node):
+                return node.name != 'other'
+
+            def _prefetch_volumes(selff, provider_nodes):
+                calls.append([node.name for node in provider_nodes])
+
+            def _aasemble_node_from_provider_node(selff, node):
+                return models.Node(name=node.name, flavor='small', image='trusty', networks=[], disk=10)
+
+        nodes = TestDriver().iter_nodes()
+
+        self.assertEqual(next(nodes).name, 'node1')
+        self.assertEqual(calls, ['page1', ['node1']])
+        self.assertEqual([node.name for node in nodes], ['node2'])
+        self.assertEqual(calls, ['page1', ['node1'], 'page2', ['node2']])
+
+    def test_compact_detection_keeps_node_record(self):
+        class ProviderNode(object):
+            def __init__(self, name):
+                self.id = 'id-%s' % (name,)
+                self.name = name
+                self.state = 'running'
+                self.public_ips = ['10.0.0.1']
+                self.extra = {'lots': 'of metadata'}
+
+        class TestDriver(base.CloudDriver):
+            def _list_candidate_node_pages(self, names=None):
+                yield [ProviderNode('node1')]
+
+            def _is_node_relevant(self, node):
+                return True
+
+            def _boot_volume_ref(self, provider_node):
+                return 'vol-%s' % (provider_node.name,)
+
+            def _aasemble_node_from_provider_node(self, provider_node):
+                return models.Node(name=provider_node.name, flavor='small', image='trusty', networks=[], disk=10,
+                                   private=provider_node)
+
+        node = list(TestDriver(namespace='testns', compact=True).detect_nodes())[0]
+
+        self.assertIsInstance(node.private, models.NodeRecord)
+        self.assertEqual((node.private.id, node.private.state, node.private.public_ips, node.private.namespace, node.private.boot_volume),
+                         ('id-node1', 'running', ['10.0.0.1'], 'testns', 'vol-node1'))
+        self.assertEqual(node.as_dict()['public_ips'], ['10.0.0.1'])
+
+    @mock.patch('aasemble.deployment.cloud.base.CloudDriver.connection')
+    def test_delete_node_fetches_compact_node(self, connection):
+        class ProviderNode(object):
+            def __init__(self, id):
+                self.id = id
+
+        node = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10,
+                           private=models.NodeRecord(id='id-2'))
+        connection.list_nodes.return_value = [ProviderNode('id-1'), ProviderNode('id-2')]
+
+        self.driver.delete_node(node)
+
+        connection.destroy_node.assert_called_once_with(connection.list_nodes.return_value[1])
+
+    @mock.patch('aasemble.deployment.cloud.base.CloudDriver.connection')
+    def test_delete_node_uses_provider_node(self, connection):
+        node = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10, private=mock.sentinel.private)
+
+        self.driver.delete_node(node)
+
+        connection.destroy_node.assert_called_once_with(mock.sentinel.private)
+        connection.list_nodes.assert_not_called()
+
     def test_update_cluster(self):
         self.collection = models.Collection()
 
@@ -147,11 +329,15 @@ class CloudDriverTests(unittest.TestCase):
         self.created_security_groups = []
         self.created_security_group_rules = []
         self.updated_cluster = False
+        self.waited = False
 
         class TestDriver(base.CloudDriver):
             def update_cluster(selff, collection):
                 self.updated_cluster = True
 
+            def wait_for_operations(selff):
+                self.waited = True
+
             def create_node(selff, node):
                 self.created_nodes += [node]
 
@@ -161,24 +347,548 @@ class CloudDriverTests(unittest.TestCase):
             def create_security_group_rule(selff, security_group_rule):
                 self.created_security_group_rules += [security_group_rule]
 
-        class Collection(object):
-            nodes = set([mock.sentinel.node1, mock.sentinel.node2])
-            security_groups = set([mock.sentinel.sg1, mock.sentinel.sg2])
-            security_group_rules = set([mock.sentinel.sgr1, mock.sentinel.sgr2])
-
-        collection = Collection()
+        collection = self._example_collection()
 
         cloud_driver = TestDriver()
 
         cloud_driver.apply_resources(collection)
 
-        self.assertIn(mock.sentinel.node1, self.created_nodes)
-        self.assertIn(mock.sentinel.node2, self.created_nodes)
-        self.assertIn(mock.sentinel.sg1, self.created_security_groups)
-        self.assertIn(mock.sentinel.sg2, self.created_security_groups)
-        self.assertIn(mock.sentinel.sgr1, self.created_security_group_rules)
-        self.assertIn(mock.sentinel.sgr2, self.created_security_group_rules)
+        self.assertIn(collection.nodes['node1'], self.created_nodes)
+        self.assertIn(collection.nodes['node2'], self.created_nodes)
+        self.assertIn(collection.security_groups['webapp'], self.created_security_groups)
+        self.assertIn(collection.security_groups['ssh'], self.created_security_groups)
+        self.assertEqual(collection.security_group_rules, set(self.created_security_group_rules))
         self.assertTrue(self.updated_cluster)
+        self.assertTrue(self.waited)
+
+    def test_apply_resources_waits_for_operations_after_failures(self):
+        self.waited = False
+
+        class TestDriver(base.CloudDriver):
+            name = 'TestDriver'
+
+            def update_cluster(selff, collection):
+                pass
+
+            def wait_for_operations(selff):
+                self.waited = True
+                raise exceptions.ProvisionFailedException('node2: quota exceeded')
+
+            def create_node(selff, node):
+                if node.name == 'node1':
+                    raise ValueError('boom')
+
+            def create_security_group(selff, security_group):
+                pass
+
+            def create_security_group_rule(selff, security_group_rule):
+                pass
+
+        cloud_driver = TestDriver()
+        cloud_driver.retry = retry.RetryPolicy(attempts=1)
+
+        with self.assertRaises(exceptions.ResourcesFailedException) as cm:
+            cloud_driver.apply_resources(self._example_collection())
+
+        self.assertTrue(self.waited)
+        self.assertEqual([key for key, exc in cm.exception.failures], [('node', 'node1'), ('wait_for_operations',)])
+        self.assertIsInstance(cm.exception.failures[1][1], exceptions.ProvisionFailedException)
+
+    def _example_collection(self):
+        collection = models.Collection()
+        sg_webapp = models.SecurityGroup(name='webapp')
+        sg_ssh = models.SecurityGroup(name='ssh')
+        collection.security_groups.add(sg_webapp)
+        collection.security_groups.add(sg_ssh)
+        collection.nodes.add(models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10,
+                                         security_groups=set([sg_webapp, sg_ssh])))
+        collection.nodes.add(models.Node(name='node2', flavor='small', image='trusty', networks=[], disk=10,
+                                         security_groups=set([sg_webapp])))
+        collection.security_group_rules.add(models.SecurityGroupRule(security_group=sg_webapp, source_ip='0.0.0.0/0',
+                                                                     from_port=443, to_port=443, protocol='tcp'))
+        collection.security_group_rules.add(models.SecurityGroupRule(security_group=sg_ssh, source_group='webapp',
+                                                                     from_port=22, to_port=22, protocol='tcp'))
+        return collection
+
+    def test_apply_resources_respects_dependencies(self):
+        self.events = []
+        lock = threading.Lock()
+
+        class TestDriver(base.CloudDriver):
+            def update_cluster(selff, collection):
+                pass
+
+            def create_security_group(selff, security_group):
+                with lock:
+                    self.events.append(('sg', security_group.name))
+
+            def create_node(selff, node):
+                with lock:
+                    self.events.append(('node', node.name))
+
+            def create_security_group_rule(selff, security_group_rule):
+                with lock:
+                    self.events.append(('rule', security_group_rule.security_group.name))
+
+        TestDriver().apply_resources(self._example_collection())
+
+        self.assertLess(self.events.index(('sg', 'webapp')), self.events.index(('node', 'node1')))
+        self.assertLess(self.events.index(('sg', 'ssh')), self.events.index(('node', 'node1')))
+        self.assertLess(self.events.index(('sg', 'webapp')), self.events.index(('node', 'node2')))
+        self.assertLess(self.events.index(('sg', 'webapp')), self.events.index(('rule', 'webapp')))
+        self.assertLess(self.events.index(('sg', 'webapp')), self.events.index(('rule', 'ssh')))
+        self.assertLess(self.events.index(('sg', 'ssh')), self.events.index(('rule', 'ssh')))
+
+    def test_apply_resources_batches_similar_nodes(self):
+        self.batches = []
+        self.single = []
+
+        class TestDriver(base.CloudDriver):
+            max_node_batch_size = 2
+
+            def update_cluster(selff, collection):
+                pass
+
+            def create_security_group(selff, security_group):
+                pass
+
+            def create_security_group_rule(selff, security_group_rule):
+                pass
+
+            def create_node(selff, node):
+                self.single.append(node.name)
+
+            def create_nodes(selff, nodes):
+                self.batches.append([node.name for node in nodes])
+
+        collection = models.Collection()
+        for name in ('web1', 'web2', 'web3'):
+            collection.nodes.add(models.Node(name=name, flavor='small', image='trusty', networks=[], disk=10))
+        collection.nodes.add(models.Node(name='db1', flavor='large', image='trusty', networks=[], disk=10))
+
+        TestDriver().apply_resources(collection)
+
+        self.assertEqual(self.batches, [['web1', 'web2']])
+        self.assertEqual(sorted(self.single), ['db1', 'web3'])
+
+    def test_apply_resources_batches_rules_per_security_group(self):
+        self.batches = []
+
+        class TestDriver(base.CloudDriver):
+            max_security_group_rule_batch_size = 10
+
+            def update_cluster(selff, collection):
+                pass
+
+            def create_security_group(selff, security_group):
+                pass
+
+            def create_node(selff, node):
+                pass
+
+            def create_security_group_rule(selff, security_group_rule):
+                self.batches.append([security_group_rule])
+
+            def create_security_group_rules(selff, security_group_rules):
+                self.batches.append(security_group_rules)
+
+        collection = self._example_collection()
+        sg_webapp = collection.security_groups['webapp']
+        collection.security_group_rules.add(models.SecurityGroupRule(security_group=sg_webapp, source_ip='0.0.0.0/0',
+                                                                     from_port=80, to_port=80, protocol='tcp'))
+
+        TestDriver().apply_resources(collection)
+
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [1, 2])
+        for batch in self.batches:
+            self.assertEqual(len(set(rule.security_group.name for rule in batch)), 1)
+
+    def test_create_nodes_defaults_to_one_at_a_time(self):
+        self.created_nodes = []
+
+        class TestDriver(base.CloudDriver):
+            def create_node(selff, node):
+                self.created_nodes.append(node)
+
+        nodes = [mock.sentinel.node1, mock.sentinel.node2]
+        TestDriver().create_nodes(nodes)
+
+        self.assertEqual(self.created_nodes, nodes)
+
+    def test_clean_resources_respects_dependencies(self):
+        self.events = []
+        lock = threading.Lock()
+
+        class TestDriver(base.CloudDriver):
+            def delete_security_group(selff, security_group):
+                with lock:
+                    self.events.append(('sg', security_group.name))
+
+            def delete_node(selff, node):
+                with lock:
+                    self.events.append(('node', node.name))
+
+            def delete_security_group_rule(selff, security_group_rule):
+                with lock:
+                    self.events.append(('rule', security_group_rule.security_group.name))
+
+        TestDriver().clean_resources(self._example_collection())
+
+        self.assertEqual(len(self.events), 6)
+        self.assertLess(self.events.index(('node', 'node1')), self.events.index(('rule', 'ssh')))
+        self.assertLess(self.events.index(('node', 'node2')), self.events.index(('rule', 'webapp')))
+        self.assertLess(self.events.index(('rule', 'ssh')), self.events.index(('sg', 'ssh')))
+        self.assertLess(self.events.index(('rule', 'ssh')), self.events.index(('sg', 'webapp')))
+        self.assertLess(self.events.index(('rule', 'webapp')), self.events.index(('sg', 'webapp')))
+        self.assertLess(self.events.index(('node', 'node1')), self.events.index(('sg', 'ssh')))
+
+    def test_plan_applies_mappings(self):
+        desired = models.Collection()
+        desired.nodes.add(models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+        current = models.Collection()
+        current.nodes.add(models.Node(name='node1', flavor='m4.large', image='ami-123', networks=[], disk=10))
+
+        driver = base.CloudDriver(mappings={'flavors': {'small': 'm4.large'}, 'images': {'trusty': 'ami-123'}})
+
+        self.assertEqual(list(driver.plan(desired, current)), [])
+
+    def test_apply_plan(self):
+        self.events = []
+        lock = threading.Lock()
+
+        class TestDriver(base.CloudDriver):
+            node_update_fields = ('security_groups',)
+
+            def update_cluster(selff, collection):
+                self.cluster_collection = collection
+
+            def _event(selff, *event):
+                with lock:
+                    self.events.append(event)
+
+            def create_node(selff, node):
+                selff._event('create_node', node.name, node.flavor)
+
+            def create_security_group(selff, security_group):
+                selff._event('create_sg', security_group.name)
+
+            def create_security_group_rule(selff, security_group_rule):
+                selff._event('create_rule', security_group_rule.security_group.name)
+
+            def update_node(selff, change):
+                selff._event('update_node', change.name)
+
+            def delete_node(selff, node):
+                selff._event('delete_node', node.name, node.flavor)
+
+            def delete_security_group(selff, security_group):
+                selff._event('delete_sg', security_group.name)
+
+            def delete_security_group_rule(selff, security_group_rule):
+                selff._event('delete_rule', security_group_rule.security_group.name)
+
+        sg_old = models.SecurityGroup(name='old')
+        sg_webapp = models.SecurityGroup(name='webapp')
+        current = models.Collection()
+        current.security_groups.add(sg_old)
+        current.nodes.add(models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+        current.nodes.add(models.Node(name='node2', flavor='small', image='trusty', networks=[], disk=10,
+                                      security_groups=set([sg_old])))
+        current.nodes.add(models.Node(name='node3', flavor='small', image='trusty', networks=[], disk=10))
+        current.security_group_rules.add(models.SecurityGroupRule(security_group=sg_old, source_ip='0.0.0.0/0',
+                                                                  from_port=22, to_port=22, protocol='tcp'))
+
+        desired = models.Collection()
+        desired.security_groups.add(sg_webapp)
+        desired.nodes.add(models.Node(name='node1', flavor='large', image='trusty', networks=[], disk=10))
+        desired.nodes.add(models.Node(name='node2', flavor='small', image='trusty', networks=[], disk=10,
+                                      security_groups=set([sg_webapp])))
+
+        driver = TestDriver()
+        driver.apply_plan(driver.plan(desired, current, prune=True))
+
+        self.assertEqual(sorted(self.events), [('create_node', 'node1', 'large'),
+                                               ('create_sg', 'webapp'),
+                                               ('delete_node', 'node1', 'small'),
+                                               ('delete_node', 'node3', 'small'),
+                                               ('delete_rule', 'old'),
+                                               ('delete_sg', 'old'),
+                                               ('update_node', 'node2')])
+        self.assertLess(self.events.index(('delete_node', 'node1', 'small')), self.events.index(('create_node', 'node1', 'large')))
+        self.assertLess(self.events.index(('create_sg', 'webapp')), self.events.index(('update_node', 'node2')))
+        self.assertLess(self.events.index(('update_node', 'node2')), self.events.index(('delete_sg', 'old')))
+        self.assertLess(self.events.index(('delete_rule', 'old')), self.events.index(('delete_sg', 'old')))
+        self.assertEqual(list(self.cluster_collection.nodes.keys()), ['node1'])
+        self.assertIs(self.cluster_collection.original_collection, desired)
+
+    def test_idempotency_key(self):
+        node1 = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10)
+        node2 = models.Node(name='node2', flavor='small', image='trusty', networks=[], disk=10)
+        driver = base.CloudDriver(namespace='ns1')
+
+        self.assertIsNone(driver.idempotency_key([node1]))
+
+        driver.apply_plan(plan.Plan(models.Collection()), 'stack1')
+        key = driver.idempotency_key([node1])
+        same = base.CloudDriver(namespace='ns1')
+        same.stack_fingerprint = 'stack1'
+        self.assertEqual(key, same.idempotency_key([node1]))
+        self.assertNotEqual(key, driver.idempotency_key([node2]))
+        self.assertNotEqual(key, driver.idempotency_key([node1, node2]))
+        self.assertNotEqual(key, driver.idempotency_key([node1], 1))
+
+        other = base.CloudDriver(namespace='ns2')
+        other.stack_fingerprint = 'stack1'
+        self.assertNotEqual(key, other.idempotency_key([node1]))
+        other = base.CloudDriver(namespace='ns1')
+        other.stack_fingerprint = 'stack2'
+        self.assertNotEqual(key, other.idempotency_key([node1]))
+
+    def _throttling_connection(self, responses):
+        # A provider driver whose requests answer with the given responses
+        # in turn, raising the exceptions among them.
+        requests = []
+
+        def request(action, *args, **kwargs):
+            requests.append(action)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        driver = mock.Mock()
+        driver.connection.request = request
+        return driver, requests
+
+    def test_apply_resources_retries_throttled_requests(self):
+        provider, requests = self._throttling_connection(['launched', RateLimitReachedError(), 'tagged'])
+
+        class TestDriver(base.CloudDriver):
+            name = 'TestDriver'
+
+            def _create_connection(selff):
+                return provider
+
+            def update_cluster(selff, collection):
+                pass
+
+            def create_node(selff, node):
+                selff.connection.connection.request('/launch')
+                selff.connection.connection.request('/tag')
+
+        collection = models.Collection()
+        collection.nodes.add(models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+
+        cloud_driver = TestDriver(limiter=limiter.AdaptiveLimiter(4, sleep=lambda t: None))
+        cloud_driver.apply_resources(collection)
+
+        # Only the throttled request is sent again, never the launch.
+        self.assertEqual(requests, ['/launch', '/tag', '/tag'])
+        self.assertEqual(cloud_driver.limiter.state()['TestDriver/create']['throttles'], 1)
+
+    def test_limited_does_not_rerun_throttled_operations(self):
+        attempts = []
+
+        def create_node(node):
+            attempts.append(node)
+            raise RateLimitReachedError()
+
+        cloud_driver = base.CloudDriver(limiter=limiter.AdaptiveLimiter(4, sleep=lambda t: None),
+                                        retry=retry.RetryPolicy(sleep=lambda t: None))
+        node = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10)
+
+        self.assertRaises(RateLimitReachedError, cloud_driver.limited(create_node), node)
+        self.assertEqual(attempts, [node])
+
+    def test_limited_records_metrics(self):
+        recorder = metrics.Metrics()
+        provider, requests = self._throttling_connection([RateLimitReachedError(), socket.timeout(), 'ok'])
+        attempts = []
+
+        class TestDriver(base.CloudDriver):
+            name = 'TestDriver'
+
+            def _create_connection(selff):
+                return provider
+
+        cloud_driver = TestDriver(limiter=limiter.AdaptiveLimiter(4, sleep=lambda t: None),
+                                  retry=retry.RetryPolicy(sleep=lambda t: None), metrics=recorder)
+        cloud_driver.stack_fingerprint = 'stack1'
+
+        def create_node(node):
+            attempts.append(recorder.current_operation())
+            cloud_driver.connection.connection.request('/launch')
+
+        node = models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10)
+        cloud_driver.limited(create_node)(node)
+
+        self.assertEqual(attempts, ['create_node'] * 2)
+        self.assertEqual(len(requests), 3)
+        self.assertIsNone(recorder.current_operation())
+        self.assertIsNone(cloud_driver.current_operation())
+        operation = recorder.as_dict()['operations'][0]
+        self.assertEqual((operation['provider'], operation['operation']), ('TestDriver', 'create_node'))
+        self.assertEqual((operation['retries'], operation['throttles']), (1, 1))
+
+    def test_limited_records_task_times(self):
+        profiler = mock.MagicMock()
+        cloud_driver = base.CloudDriver(profiler=profiler)
+
+        self.assertEqual(cloud_driver.limited(lambda arg: arg * 2, 'detect_nodes')(21), 42)
+
+        profiler.task.assert_called_once_with('detect_nodes')
+        self.assertTrue(profiler.task.return_value.__exit__.called)
+        self.assertEqual(profiler.record.call_args[0][0], 'limiter')
+
+    @mock.patch('aasemble.deployment.cloud.base.get_driver')
+    def test_connection_profiles_requests(self, get_driver):
+        class TestDriver(base.CloudDriver):
+            provider = mock.sentinel.provider
+            name = 'Test Cloud'
+
+            def _get_driver_args_and_kwargs(self):
+                return ((), {})
+
+        profiler = mock.MagicMock()
+        cloud_driver = TestDriver(profiler=profiler)
+
+        connection = cloud_driver.connection
+
+        profiler.instrument.assert_called_once_with(connection)
+
+    def test_map_concurrently(self):
+        pool = ThreadPool(2)
+        self.addCleanup(pool.terminate)
+        cloud_driver = base.CloudDriver(pool=pool)
+
+        self.assertEqual(cloud_driver.map_concurrently(lambda x: x * 2, range(5), 'list_things'), [0, 2, 4, 6, 8])
+
+    def test_map_concurrently_on_asyncio_executor(self):
+        executor = mock.MagicMock()
+        executor.submit.side_effect = lambda func, arg: func(arg)
+        cloud_driver = base.CloudDriver(engine='asyncio', executor=executor)
+
+        self.assertEqual(cloud_driver.map_concurrently(lambda x: x * 2, range(3), 'list_things'), [0, 2, 4])
+
+        self.assertEqual(executor.submit.call_count, 3)
+        self.assertIsNone(cloud_driver._pool)
+
+    def test_map_concurrently_holds_limiter_slots(self):
+        pool = mock.MagicMock()
+        pool.apply_async.side_effect = lambda func, args: func(*args)
+        cloud_driver = base.CloudDriver(pool=pool)
+        cloud_driver.name = 'TestDriver'
+
+        self.assertEqual(cloud_driver.map_concurrently(lambda x: x * 2, range(5), 'list_things'), [0, 2, 4, 6, 8])
+
+        self.assertEqual(pool.apply_async.call_count, 5)
+        self.assertEqual(cloud_driver.limiter.state()['TestDriver/list']['successes'], 5)
+
+    def test_map_concurrently_takes_items_as_they_arrive(self):
+        pool = ThreadPool(2)
+        self.addCleanup(pool.terminate)
+        cloud_driver = base.CloudDriver(pool=pool)
+        done = threading.Event()
+
+        def items():
+            yield 1
+            # Only comes once the helper has done the first item.
+            self.assertTrue(done.wait(5))
+            yield 2
+
+        def func(x):
+            done.set()
+            return x * 2
+
+        self.assertEqual(cloud_driver.map_concurrently(func, items(), 'list_things'), [2, 4])
+
+    def test_map_concurrently_raises_failures(self):
+        pool = ThreadPool(2)
+        self.addCleanup(pool.terminate)
+        cloud_driver = base.CloudDriver(pool=pool, retry=retry.RetryPolicy(attempts=1))
+
+        def func(x):
+            if x == 3:
+                raise ValueError('boom')
+            return x
+
+        self.assertRaises(ValueError, cloud_driver.map_concurrently, func, range(5), 'list_things')
+
+    def test_map_concurrently_classifies_errors_like_limited(self):
+        # No helpers get to run, so every item is done on the calling thread.
+        cloud_driver = base.CloudDriver(pool=mock.MagicMock(), retry=retry.RetryPolicy(sleep=lambda t: None))
+        attempts = []
+
+        def func(x):
+            attempts.append(x)
+            raise RateLimitReachedError()
+
+        self.assertRaises(RateLimitReachedError, cloud_driver.map_concurrently, func, [1], 'list_things')
+        self.assertEqual(attempts, [1])
+
+    def test_map_concurrently_inside_limited_call(self):
+        # The caller holds the only slot and the pool's only thread, so the
+        # items can only get done on the calling thread.
+        pool = ThreadPool(1)
+        self.addCleanup(pool.terminate)
+        cloud_driver = base.CloudDriver(pool=pool, limiter=limiter.AdaptiveLimiter(1))
+
+        def detect(_):
+            return cloud_driver.map_concurrently(lambda x: x + 1, range(3), 'list_things')
+
+        result = pool.apply_async(cloud_driver.limited(detect, 'detect_things'), (None,))
+
+        self.assertEqual(result.get(5), [1, 2, 3])
+
+    def test_classify_error(self):
+        class HTTPError(Exception):
+            def __init__(self, code):
+                self.code = code
+
+        driver = base.CloudDriver()
+        self.assertEqual(driver.classify_error(RateLimitReachedError()), retry.THROTTLING)
+        self.assertEqual(driver.classify_error(HTTPError(503)), retry.TRANSIENT)
+        self.assertEqual(driver.classify_error(socket.timeout()), retry.TRANSIENT)
+        self.assertEqual(driver.classify_error(HTTPError(400)), retry.PERMANENT)
+        self.assertEqual(driver.classify_error(ValueError()), retry.PERMANENT)
+
+    def test_apply_resources_retries_transient_errors_and_reports_the_rest(self):
+        self.attempts = {}
+
+        class ServerError(Exception):
+            http_code = 500
+
+        class TestDriver(base.CloudDriver):
+            def update_cluster(selff, collection):
+                pass
+
+            def create_node(selff, node):
+                self.attempts[node.name] = self.attempts.get(node.name, 0) + 1
+                if node.name == 'node1' and self.attempts[node.name] == 1:
+                    raise ServerError()
+                if node.name == 'node2':
+                    raise ServerError()
+
+        collection = models.Collection()
+        collection.nodes.add(models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+        collection.nodes.add(models.Node(name='node2', flavor='large', image='trusty', networks=[], disk=10, attempts_left=2))
+        collection.nodes.add(models.Node(name='node3', flavor='medium', image='trusty', networks=[], disk=10))
+
+        cloud_driver = TestDriver(retry=retry.RetryPolicy(sleep=lambda t: None))
+        with self.assertRaises(exceptions.ResourcesFailedException) as cm:
+            cloud_driver.apply_resources(collection, 'stack1')
+
+        self.assertEqual(self.attempts, {'node1': 2, 'node2': 2, 'node3': 1})
+        self.assertEqual([key for key, exc in cm.exception.failures], [('node', 'node2')])
+
+        # Without a stack fingerprint there's no client token, so a retry
+        # could launch a second node.
+        self.attempts = {}
+        with self.assertRaises(exceptions.ResourcesFailedException) as cm:
+            cloud_driver.apply_resources(collection)
+
+        self.assertEqual(self.attempts, {'node1': 1, 'node2': 1, 'node3': 1})
+        self.assertEqual(sorted(key for key, exc in cm.exception.failures), [('node', 'node1'), ('node', 'node2')])
 
     def test_get_resource_by_attr(self):
         class TestClass(object):
@@ -0,0 +1,92 @@
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from aasemble.deployment import cache
+from aasemble.deployment.cloud import catalog
+
+
+class CatalogTests(unittest.TestCase):
+    def setUp(self):
+        super(CatalogTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'catalog.json')
+        self.fetch = mock.MagicMock()
+        self.fetch.return_value = [{'id': 'img-1', 'name': 'trusty'},
+                                   {'id': 'img-2', 'name': 'xenial'}]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(CatalogTests, self).tearDown()
+
+    def test_get_by_name_and_id(self):
+        c = catalog.Catalog()
+        self.assertEqual(c.get('images', 'name', 'trusty', self.fetch)['id'], 'img-1')
+        self.assertEqual(c.get('images', 'id', 'img-2', self.fetch)['name'], 'xenial')
+        self.assertEqual(len(self.fetch.call_args_list), 1)
+
+    def test_get_missing(self):
+        c = catalog.Catalog()
+        self.assertRaises(KeyError, c.get, 'images', 'name', 'precise', self.fetch)
+        self.assertRaises(KeyError, c.get, 'images', 'name', 'precise', self.fetch)
+        self.assertEqual(len(self.fetch.call_args_list), 1)
+
+    def test_records(self):
+        c = catalog.Catalog()
+        self.assertEqual(c.records('images', self.fetch), self.fetch.return_value)
+        c.records('images', self.fetch)
+        self.assertEqual(len(self.fetch.call_args_list), 1)
+
+    def test_not_persisted_without_ttl(self):
+        c = catalog.Catalog(path=self.path)
+        c.get('images', 'name', 'trusty', self.fetch)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_persisted_with_ttl(self):
+        catalog.Catalog(path=self.path, ttl=60).get('images', 'name', 'trusty', self.fetch)
+
+        fetch = mock.MagicMock()
+        c = catalog.Catalog(path=self.path, ttl=60)
+        self.assertEqual(c.get('images', 'name', 'xenial', fetch)['id'], 'img-2')
+        fetch.assert_not_called()
+
+    def test_persisted_catalog_refetched_on_miss(self):
+        catalog.Catalog(path=self.path, ttl=60).get('images', 'name', 'trusty', self.fetch)
+
+        fetch = mock.MagicMock()
+        fetch.return_value = [{'id': 'img-3', 'name': 'bionic'}]
+        c = catalog.Catalog(path=self.path, ttl=60)
+        self.assertEqual(c.get('images', 'name', 'bionic', fetch)['id'], 'img-3')
+        self.assertEqual(len(fetch.call_args_list), 1)
+
+    def test_expired_catalog_ignored(self):
+        cache.save(self.path, {'images': {'fetched_at': time.time() - 120,
+                                          'records': [{'id': 'img-0', 'name': 'trusty'}]}})
+
+        c = catalog.Catalog(path=self.path, ttl=60)
+        self.assertEqual(c.get('images', 'name', 'trusty', self.fetch)['id'], 'img-1')
+        self.assertEqual(len(self.fetch.call_args_list), 1)
+
+    def test_concurrent_saves_keep_every_kind(self):
+        c = catalog.Catalog(path=self.path, ttl=60)
+        save = cache.save
+        threads = []
+
+        def slow_save(path, data):
+            if not threads:
+                # Fetch another kind while this older copy is being written.
+                threads.append(threading.Thread(target=c.records, args=('sizes', lambda: [{'id': 'size-1', 'name': 'small'}])))
+                threads[0].start()
+                time.sleep(0.1)
+            save(path, data)
+
+        with mock.patch('aasemble.deployment.cache.save', side_effect=slow_save):
+            c.records('images', self.fetch)
+            threads[0].join()
+
+        self.assertEqual(sorted(cache.load(self.path)), ['images', 'sizes'])
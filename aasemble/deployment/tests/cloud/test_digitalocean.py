@@ -1,6 +1,9 @@
+import json
 import os.path
 import unittest
 
+from libcloud.compute.base import NodeImage, NodeLocation, NodeSize
+
 import mock
 
 from six.moves import configparser
@@ -87,9 +90,38 @@ class DigitalOceanDriverTests(unittest.TestCase):
         self.assertEqual(node.security_group_names, set())
         self.assertEqual(node.private, donode)
 
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
+    def test_list_candidate_node_pages(self, connection):
+        responses = [{'droplets': [{'name': 'web1'}, {'name': 'web2'}],
+                      'links': {'pages': {'next': 'https://api.digitalocean.com/v2/droplets?page=2&per_page=200'}}},
+                     {'droplets': [{'name': 'web3'}], 'links': {}}]
+        requests = []
+
+        def request(path, params):
+            requests.append((path, dict(params)))
+            return mock.MagicMock(object=responses.pop(0))
+
+        connection.connection.request.side_effect = request
+        connection._to_node.side_effect = lambda droplet: droplet['name']
+
+        self.assertEqual(list(self.cloud_driver._list_candidate_node_pages()), [['web1', 'web2'], ['web3']])
+
+        self.assertEqual(requests, [('/v2/droplets', {'per_page': 200}),
+                                    ('/v2/droplets', {'per_page': 200, 'page': '2'})])
+
     def test_detect_firewalls(self):
         self.assertEqual(self.cloud_driver.detect_firewalls(), (set(), set()))
 
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._fetch_sizes')
+    def test_detection_stages_fetch_sizes(self, _fetch_sizes):
+        _fetch_sizes.return_value = [{'id': 's-1vcpu-1gb', 'name': 's-1vcpu-1gb', 'disk': 25}]
+        stages = dict((name, func) for name, func, requires in self.cloud_driver._detection_stages())
+
+        stages['sizes']({})
+
+        self.assertEqual(self.cloud_driver.catalog.get('sizes', 'name', 's-1vcpu-1gb', _fetch_sizes)['disk'], 25)
+        _fetch_sizes.assert_called_once_with()
+
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.apply_mappings')
     def test_get_image(self, apply_mappings, connection):
@@ -109,17 +141,14 @@ class DigitalOceanDriverTests(unittest.TestCase):
         _get_image_by_spec.assert_called_with('foo:bar')
 
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
-    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.get_name_by_image')
-    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.get_distribution_by_image')
-    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.apply_mappings')
-    def test_get_image_by_spec(self, apply_mappings, get_distribution_by_image, get_name_by_image, connection):
-        get_distribution_by_image.side_effect = lambda s: s.split(':')[0]
-        get_name_by_image.side_effect = lambda s: s.split(':')[1]
-
-        connection.list_images.return_value = ['Ubuntu:1404', 'Ubuntu:1604']
-        self.assertEqual(self.cloud_driver._get_image_by_spec('distribution:Ubuntu name:1404'), 'Ubuntu:1404')
-        self.assertEqual(self.cloud_driver._get_image_by_spec('distribution:Ubuntu name:1604'), 'Ubuntu:1604')
-        self.assertRaises(exceptions.ImageNotFoundException, self.cloud_driver._get_image_by_spec, 'distribution:foo name:1604')
+    def test_get_image_by_spec(self, connection):
+        connection.list_images.return_value = [NodeImage(id='1', name='14.04 x64', driver=connection, extra={'distribution': 'Ubuntu'}),
+                                               NodeImage(id='2', name='16.04 x64', driver=connection, extra={'distribution': 'Ubuntu'})]
+        self.assertEqual(self.cloud_driver._get_image_by_spec('distribution:Ubuntu name:14').id, '1')
+        self.assertEqual(self.cloud_driver._get_image_by_spec('distribution:Ubuntu name:16').id, '2')
+        self.assertRaises(exceptions.ImageNotFoundException, self.cloud_driver._get_image_by_spec, 'distribution:foo name:16')
+        self.assertEqual(len(connection.list_images.call_args_list), 1,
+                         'Did not cache image catalog')
 
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.apply_mappings')
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.get_size')
@@ -129,16 +158,23 @@ class DigitalOceanDriverTests(unittest.TestCase):
         get_size.assert_called_with(apply_mappings.return_value)
 
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
-    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._get_resource_by_attr')
-    def test_get_size(self, _get_resource_by_attr, connection):
-        self.assertEqual(self.cloud_driver.get_size('512mb'), _get_resource_by_attr.return_value)
-        _get_resource_by_attr.assert_called_with(connection.list_sizes, 'name', '512mb')
+    def test_get_size(self, connection):
+        connection.list_sizes.return_value = [NodeSize(id='1', name='512mb', ram=512, disk=20, bandwidth=1, price=5, driver=connection),
+                                              NodeSize(id='2', name='1gb', ram=1024, disk=30, bandwidth=2, price=10, driver=connection)]
+        self.assertEqual(self.cloud_driver.get_size('512mb').disk, 20)
+        self.assertEqual(self.cloud_driver.get_size('1gb').disk, 30)
+        self.assertRaises(KeyError, self.cloud_driver.get_size, '2gb')
+        self.assertEqual(len(connection.list_sizes.call_args_list), 1,
+                         'Did not cache size catalog')
 
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
-    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._get_resource_by_attr')
-    def test_get_location(self, _get_resource_by_attr, connection):
-        self.assertEqual(self.cloud_driver._get_location('fra1'), _get_resource_by_attr.return_value)
-        _get_resource_by_attr.assert_called_with(connection.list_locations, 'id', 'fra1')
+    def test_get_location(self, connection):
+        connection.list_locations.return_value = [NodeLocation(id='ams1', name='Amsterdam 1', country='NL', driver=connection),
+                                                  NodeLocation(id='fra1', name='Frankfurt 1', country='DE', driver=connection)]
+        self.assertEqual(self.cloud_driver._get_location('fra1').name, 'Frankfurt 1')
+        self.cloud_driver._get_location('fra1')
+        self.assertEqual(len(connection.list_locations.call_args_list), 1,
+                         'Did not cache location catalog')
 
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
     @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._get_size')
@@ -195,6 +231,109 @@ class DigitalOceanDriverTests(unittest.TestCase):
         find_or_import_keypair_by_key_material.assert_called_with('this is not a real key')
         self.assertEqual(kwargs, {'ex_create_attr': {'ssh_keys': ['thefingerprint']}})
 
+        self.cloud_driver._add_key_pair_info({})
+        self.assertEqual(len(find_or_import_keypair_by_key_material.call_args_list), 1,
+                         'Did not remember key pair')
+
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._launch_kwargs')
+    def test_create_nodes(self, _launch_kwargs, connection):
+        nodes = [cloud_models.Node(name='web%d' % i, image='127237412', flavor='512mb', networks=[], disk=20)
+                 for i in range(1, 4)]
+        _launch_kwargs.return_value = {'name': 'web1',
+                                       'size': NodeSize(id='512mb', name='512mb', ram=512, disk=20, bandwidth=None, price=None, driver=connection),
+                                       'image': NodeImage(id='127237412', name='trusty', driver=connection),
+                                       'location': NodeLocation(id='ams2', name='Amsterdam 2', country='NL', driver=connection),
+                                       'ex_user_data': 'script',
+                                       'ex_create_attr': {'ssh_keys': ['thefingerprint']}}
+        connection.connection.request.return_value.object = {'droplets': [{'name': 'web3'}, {'name': 'web1'}, {'name': 'web2'}]}
+
+        def _to_node(data):
+            donode = mock.MagicMock()
+            donode.name = data['name']
+            return donode
+
+        connection._to_node.side_effect = _to_node
+
+        self.cloud_driver.create_nodes(nodes)
+
+        _launch_kwargs.assert_called_once_with(nodes[0])
+        args, kwargs = connection.connection.request.call_args
+        self.assertEqual(args, ('/v2/droplets',))
+        self.assertEqual(kwargs['method'], 'POST')
+        self.assertEqual(json.loads(kwargs['data']), {'names': ['web1', 'web2', 'web3'],
+                                                      'size': '512mb',
+                                                      'image': '127237412',
+                                                      'region': 'ams2',
+                                                      'user_data': 'script',
+                                                      'ssh_keys': ['thefingerprint']})
+        self.assertEqual([node.private.name for node in nodes], ['web1', 'web2', 'web3'])
+
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._launch_kwargs')
+    def test_create_node_tags_launch(self, _launch_kwargs, connection):
+        node = cloud_models.Node(name='web1', image='127237412', flavor='512mb', networks=[], disk=20)
+        _launch_kwargs.return_value = {'name': 'web1', 'ex_create_attr': {'ssh_keys': ['thefingerprint']}}
+        connection.connection.request.return_value.object = {'droplets': []}
+        self.cloud_driver.stack_fingerprint = 'stack1'
+
+        self.cloud_driver.create_node(node)
+
+        tag = 'aasemble-launch-' + self.cloud_driver.idempotency_key([node])
+        connection.connection.request.assert_called_once_with('/v2/droplets', params={'tag_name': tag, 'per_page': 200})
+        connection.create_node.assert_called_once_with(name='web1', ex_create_attr={'ssh_keys': ['thefingerprint'],
+                                                                                    'tags': [tag]})
+        self.assertEqual(node.private, connection.create_node.return_value)
+
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
+    def test_create_node_already_launched(self, connection):
+        node = cloud_models.Node(name='web1', image='127237412', flavor='512mb', networks=[], disk=20)
+        droplet = mock.MagicMock()
+        droplet.name = 'web1'
+        connection.connection.request.return_value.object = {'droplets': [{'name': 'web1'}]}
+        connection._to_node.return_value = droplet
+        self.cloud_driver.stack_fingerprint = 'stack1'
+
+        self.cloud_driver.create_node(node)
+
+        self.assertEqual(node.private, droplet)
+        self.assertFalse(connection.create_node.called)
+
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver._launch_kwargs')
+    def test_create_nodes_launches_only_missing(self, _launch_kwargs, connection):
+        nodes = [cloud_models.Node(name='web%d' % i, image='127237412', flavor='512mb', networks=[], disk=20)
+                 for i in range(1, 4)]
+        _launch_kwargs.return_value = {'name': 'web1',
+                                       'size': NodeSize(id='512mb', name='512mb', ram=512, disk=20, bandwidth=None, price=None, driver=connection),
+                                       'image': NodeImage(id='127237412', name='trusty', driver=connection),
+                                       'location': NodeLocation(id='ams2', name='Amsterdam 2', country='NL', driver=connection)}
+        connection.connection.request.side_effect = [mock.MagicMock(object={'droplets': [{'name': 'web2'}]}),
+                                                     mock.MagicMock(object={'droplets': [{'name': 'web1'}, {'name': 'web3'}]})]
+
+        def _to_node(data):
+            donode = mock.MagicMock()
+            donode.name = data['name']
+            return donode
+
+        connection._to_node.side_effect = _to_node
+        self.cloud_driver.stack_fingerprint = 'stack1'
+
+        self.cloud_driver.create_nodes(nodes)
+
+        tag = 'aasemble-launch-' + self.cloud_driver.idempotency_key(nodes)
+        lookup, launch = connection.connection.request.call_args_list
+        self.assertEqual(lookup[1]['params']['tag_name'], tag)
+        self.assertEqual(json.loads(launch[1]['data'])['names'], ['web1', 'web3'])
+        self.assertEqual(json.loads(launch[1]['data'])['tags'], [tag])
+        self.assertEqual([node.private.name for node in nodes], ['web1', 'web2', 'web3'])
+
+    @mock.patch('aasemble.deployment.cloud.digitalocean.DigitalOceanDriver.create_node')
+    def test_create_nodes_single(self, create_node):
+        node = cloud_models.Node(name='web1', image='127237412', flavor='512mb', networks=[], disk=20)
+        self.cloud_driver.create_nodes([node])
+        create_node.assert_called_once_with(node)
+
     def test_add_script_info_no_script(self):
         node = cloud_models.Node(name='webapp',
                                  image='trusty',
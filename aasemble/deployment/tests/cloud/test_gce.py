@@ -1,20 +1,28 @@
 import os.path
 import unittest
 import unittest.util
+import uuid
 
 
+from libcloud.common.google import GoogleBaseError, QuotaExceededError, ResourceNotFoundError
+
 import mock
 
 from six.moves import configparser
 
 import aasemble.deployment.cloud.gce as gce
 import aasemble.deployment.cloud.models as cloud_models
+import aasemble.deployment.cloud.plan as plan
+from aasemble.deployment import exceptions
 
 
 class FakeThreadPool(object):
     def map(self, func, iterable):
         return list(map(func, iterable))
 
+    def apply_async(self, func, args):
+        func(*args)
+
 
 class GCENode(object):
     def __init__(self, name, size='n1-standard-1', image='ubuntu-1404-trusty-v20151113', tags=None, namespace=None):
@@ -46,28 +54,77 @@ class GCEDriverTestCase(unittest.TestCase):
                          {'gce_key_file': 'somekey.json',
                           'location': 'some.region'})
 
+    def test_get_kwargs_from_cloud_config_bulk_insert(self):
+        cp = configparser.ConfigParser()
+        cp.add_section('connection')
+        cp.set('connection', 'key_file', 'somekey.json')
+        cp.set('connection', 'location', 'some.region')
+        cp.set('connection', 'bulk_insert', 'yes')
+        self.assertEqual(gce.GCEDriver.get_kwargs_from_cloud_config(cp),
+                         {'gce_key_file': 'somekey.json',
+                          'location': 'some.region',
+                          'bulk_insert': True})
+
+    def test_bulk_insert_raises_batch_size(self):
+        self.assertEqual(self.cloud_driver.max_node_batch_size, 1)
+        cloud_driver = gce.GCEDriver(gce_key_file=self.gce_key_file, location='location1', bulk_insert=True)
+        self.assertEqual(cloud_driver.max_node_batch_size, gce.BULK_INSERT_MAX_COUNT)
+
     def test_get_driver_args_and_kwargs(self):
         self.assertEqual(self.cloud_driver._get_driver_args_and_kwargs(),
                          (('foobar@a-project-id.iam.gserviceaccount.com', self.gce_key_file),
                           {'project': 'a-project-id', 'datacenter': 'location1'}))
 
+    def test_is_throttling_error(self):
+        self.assertTrue(self.cloud_driver.is_throttling_error(GoogleBaseError('Rate Limit Exceeded', 403, 'rateLimitExceeded')))
+        self.assertTrue(self.cloud_driver.is_throttling_error(GoogleBaseError('Too many requests', 429, None)))
+        self.assertFalse(self.cloud_driver.is_throttling_error(QuotaExceededError('Quota CPUS exceeded', 200, 'QUOTA_EXCEEDED')))
+
+    def test_is_transient_error(self):
+        self.assertTrue(self.cloud_driver.is_transient_error(GoogleBaseError('Backend Error', 503, 'backendError')))
+        self.assertTrue(self.cloud_driver.is_transient_error(GoogleBaseError('Not ready', 400, 'resourceNotReady')))
+        self.assertFalse(self.cloud_driver.is_transient_error(QuotaExceededError('Quota CPUS exceeded', 200, 'QUOTA_EXCEEDED')))
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_fetch_disks(self, connection):
+        link = 'https://www.googleapis.com/compute/v1/projects/proj/zones/%s/disks/%s'
+        disks = {'zone1': [{'name': 'web1', 'sizeGb': '10', 'selfLink': link % ('zone1', 'web1'), 'sourceImage': 'images/trusty'},
+                           {'name': 'web2', 'sizeGb': '20', 'selfLink': link % ('zone1', 'web2')}],
+                 'zone2': [{'name': 'db1', 'sizeGb': '100', 'selfLink': link % ('zone2', 'db1')}]}
+        connection._ex_volume_dict = {}
+        connection.connection.request.side_effect = lambda path, method, params: mock.MagicMock(object={'items': disks[path.split('/')[2]]})
+
+        self.cloud_driver._fetch_disks([link % ('zone1', 'web2'), link % ('zone2', 'db1'), link % ('zone1', 'web1')])
+
+        self.assertEqual(self.cloud_driver._volume_size_map, {link % ('zone1', 'web1'): 10,
+                                                              link % ('zone1', 'web2'): 20,
+                                                              link % ('zone2', 'db1'): 100})
+        self.assertEqual(sorted((args[0], kwargs['params']['filter']) for args, kwargs in connection.connection.request.call_args_list),
+                         [('/zones/zone1/disks', '((name = "web1") OR (name = "web2"))'),
+                          ('/zones/zone2/disks', '((name = "db1"))')])
+        self.assertEqual(self.cloud_driver._volume_image_map[link % ('zone1', 'web1')], 'images/trusty')
+        self.assertEqual(connection._ex_volume_dict, {})
+
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
-    def test_volume_size_map(self, connection):
-        class GCEVolume(object):
-            def __init__(self, name, size):
-                self.extra = {'selfLink': 'http://link/to/{}'.format(name)}
-                self.size = size
+    def test_provider_node_skips_libcloud_boot_disk_lookup(self, connection):
+        link = 'https://www.googleapis.com/compute/v1/projects/proj/zones/zone1/disks/web1'
+        disks = [{'source': link, 'boot': True, 'type': 'PERSISTENT'}]
+        self.cloud_driver._volume_image_map[link] = 'https://www.googleapis.com/compute/v1/projects/ubuntu-os-cloud/global/images/trusty'
+        converted = []
 
-        connection.list_volumes.return_value = [GCEVolume('vol1', 100), GCEVolume('vol2', 200)]
+        def to_node(instance, use_disk_cache):
+            converted.append(instance)
+            gcenode = GCENode(instance['name'], image=None)
+            gcenode.extra['image'] = None
+            return gcenode
 
-        self.assertEquals(self.cloud_driver.volume_size_map,
-                          {'http://link/to/vol1': 100,
-                           'http://link/to/vol2': 200})
+        connection._to_node.side_effect = to_node
 
-        self.cloud_driver.volume_size_map
+        gcenode = self.cloud_driver._provider_node({'name': 'web1', 'disks': disks})
 
-        self.assertEqual(len(connection.list_volumes.call_args_list), 1,
-                         'Did not cache volume size map')
+        self.assertEqual([disk['boot'] for disk in converted[0]['disks']], [False])
+        self.assertEqual(gcenode.extra['disks'], disks)
+        self.assertEqual((gcenode.image, gcenode.extra['image']), ('trusty', 'trusty'))
 
     def test_aasemble_node_from_provider_node(self):
         gcenode = GCENode('testnode1', tags=['tag1', 'tag2'])
@@ -81,11 +138,11 @@ class GCEDriverTestCase(unittest.TestCase):
         self.assertEqual(node.security_group_names, set(['tag1', 'tag2']))
         self.assertEqual(node.private, gcenode)
 
-    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._list_candidate_node_pages')
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._is_node_relevant')
-    def test_get_relevant_nodes_ignores_irrelevant_nodes(self, _is_node_relevant, connection):
+    def test_get_relevant_nodes_ignores_irrelevant_nodes(self, _is_node_relevant, _list_candidate_node_pages):
         node1, node2 = GCENode('node1'), GCENode('node2')
-        connection.list_nodes.return_value = [node1, node2]
+        _list_candidate_node_pages.return_value = [[node1, node2]]
         _is_node_relevant.side_effect = lambda n: n == node1
 
         nodes = list(self.cloud_driver._get_relevant_nodes())
@@ -153,6 +210,38 @@ class GCEDriverTestCase(unittest.TestCase):
                                                      protocol='tcp'),
                       security_group_rules)
 
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_detect_firewalls_by_name(self, connection):
+        fw1, fw2, fw3, fw4 = self._get_firewalls()
+        connection.connection.request.side_effect = [mock.MagicMock(object={'items': ['fw3', 'fw4']}),
+                                                     mock.MagicMock(object={'items': []})]
+        connection._to_firewall.side_effect = {'fw3': fw3, 'fw4': fw4}.get
+
+        with mock.patch.object(gce, 'MAX_FILTER_NAMES', 2):
+            security_groups, security_group_rules = self.cloud_driver.detect_firewalls(set(['webapp', 'frontend', 'db']))
+
+        self.assertEqual([kwargs['params']['filter'] for args, kwargs in connection.connection.request.call_args_list],
+                         ['((targetTags = "db") OR (targetTags = "frontend"))',
+                          '((targetTags = "webapp"))'])
+        self.assertEqual([args[0] for args, kwargs in connection.connection.request.call_args_list],
+                         ['/global/firewalls', '/global/firewalls'])
+        self.assertFalse(connection.ex_list_firewalls.called)
+
+        # fw3 also targets dev, which wasn't asked for.
+        self.assertEqual(security_groups, set([cloud_models.SecurityGroup(name='webapp')]))
+        self.assertEqual(set((rule.security_group.name, rule.from_port) for rule in security_group_rules),
+                         set([('webapp', 443), ('webapp', 21)]))
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_detect_firewalls_global_lists_everything(self, connection):
+        connection.ex_list_firewalls.return_value = list(self._get_firewalls())
+
+        security_groups, security_group_rules = self.cloud_driver.detect_firewalls(set(['global']))
+
+        self.assertFalse(connection.connection.request.called)
+        self.assertEqual(security_groups, set([cloud_models.SecurityGroup(name='global')]))
+        self.assertEqual(len(security_group_rules), 2)
+
     def test_get_all_security_group_names(self):
         firewalls = set(self._get_firewalls())
         self.assertEqual(self.cloud_driver._get_all_security_group_names(firewalls),
@@ -189,77 +278,316 @@ class GCEDriverTestCase(unittest.TestCase):
                                                                            protocol='tcp'))
         return collection
 
+    def _create_node(self, connection, name):
+        connection.AUTH_URL = 'https://auth/'
+        node = self._example_collection().nodes[name]
+        self.cloud_driver.create_node(node)
+
+        args, kwargs = connection.connection.async_request.call_args
+        self.assertEqual(args, ('/zones/location1/instances',))
+        self.assertEqual(kwargs['method'], 'POST')
+        self.assertEqual(kwargs['data']['name'], name)
+        self.assertEqual(kwargs['data']['machineType'], 'zones/location1/machineTypes/n1-standard-2')
+        self.assertEqual(kwargs['data']['tags'], {'items': ['webapp']})
+        connection.ex_get_node.assert_called_once_with(name, 'location1')
+        self.assertEqual(node.private, connection.ex_get_node.return_value)
+        self.assertFalse(connection.create_node.called)
+        return kwargs
+
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._disk_struct')
     def test_create_node_without_namespace_without_script(self, _disk_struct, connection):
-        collection = self._example_collection()
-        node = collection.nodes['webapp']
-        self.cloud_driver.create_node(node)
-        connection.create_node.assert_any_call(name='webapp',
-                                               size='n1-standard-2',
-                                               image=None,
-                                               ex_disks_gce_struct=_disk_struct.return_value,
-                                               ex_tags=['webapp'])
+        kwargs = self._create_node(connection, 'webapp')
+        self.assertEqual(kwargs['data']['disks'], _disk_struct.return_value)
+        self.assertNotIn('metadata', kwargs['data'])
+        self.assertNotIn('labels', kwargs['data'])
+        self.assertIsNone(kwargs['params'])
 
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._disk_struct')
     def test_create_node_without_namespace_with_script(self, _disk_struct, connection):
-        collection = self._example_collection()
-        node = collection.nodes['webapp2']
-        self.cloud_driver.create_node(node)
-        connection.create_node.assert_any_call(name='webapp2',
-                                               size='n1-standard-2',
-                                               image=None,
-                                               ex_disks_gce_struct=_disk_struct.return_value,
-                                               ex_metadata={'items': [{'key': 'startup-script',
-                                                                       'value': '#!/bin/bash\necho hello\n'}]},
-                                               ex_tags=['webapp'])
+        kwargs = self._create_node(connection, 'webapp2')
+        self.assertEqual(kwargs['data']['metadata'], {'items': [{'key': 'startup-script',
+                                                                 'value': '#!/bin/bash\necho hello\n'}]})
+        self.assertNotIn('labels', kwargs['data'])
 
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._disk_struct')
     def test_create_node_with_namespace_no_script(self, _disk_struct, connection):
         self.cloud_driver.namespace = 'testns'
-        collection = self._example_collection()
-        node = collection.nodes['webapp']
-        self.cloud_driver.create_node(node)
-        connection.create_node.assert_any_call(name='webapp',
-                                               size='n1-standard-2',
-                                               image=None,
-                                               ex_disks_gce_struct=_disk_struct.return_value,
-                                               ex_metadata={'items': [{'key': 'aasemble_namespace',
-                                                                       'value': 'testns'}]},
-                                               ex_tags=['webapp'])
+        kwargs = self._create_node(connection, 'webapp')
+        self.assertEqual(kwargs['data']['metadata'], {'items': [{'key': 'aasemble_namespace',
+                                                                 'value': 'testns'}]})
+        self.assertEqual(kwargs['data']['labels'], {'aasemble_namespace': 'testns'})
 
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._disk_struct')
     def test_create_node_with_namespace_with_script(self, _disk_struct, connection):
         self.cloud_driver.namespace = 'testns'
-        collection = self._example_collection()
-        node = collection.nodes['webapp2']
-        self.cloud_driver.create_node(node)
-        connection.create_node.assert_any_call(name='webapp2',
-                                               size='n1-standard-2',
-                                               image=None,
-                                               ex_disks_gce_struct=_disk_struct.return_value,
-                                               ex_metadata={'items': [{'key': 'startup-script',
-                                                                       'value': '#!/bin/bash\necho hello\n'},
-                                                                      {'key': 'aasemble_namespace',
-                                                                       'value': 'testns'}]},
-                                               ex_tags=['webapp'])
+        kwargs = self._create_node(connection, 'webapp2')
+        self.assertEqual(kwargs['data']['metadata'], {'items': [{'key': 'startup-script',
+                                                                 'value': '#!/bin/bash\necho hello\n'},
+                                                                {'key': 'aasemble_namespace',
+                                                                 'value': 'testns'}]})
+        self.assertEqual(kwargs['data']['labels'], {'aasemble_namespace': 'testns'})
 
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._disk_struct')
-    def test_create_node_no_namespace(self, _disk_struct, connection):
-        collection = self._example_collection()
-        node = collection.nodes['webapp2']
+    def test_create_node_request_id(self, _disk_struct, connection):
+        self.cloud_driver.stack_fingerprint = 'stack1'
+        first = self._create_node(connection, 'webapp')['params']['requestId']
+        connection.ex_get_node.reset_mock()
+        second = self._create_node(connection, 'webapp')['params']['requestId']
+
+        self.assertEqual(first, second)
+        self.assertEqual(str(uuid.UUID(first)), first)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._disk_struct')
+    def test_create_node_request_id_of_deleted_instance(self, _disk_struct, connection):
+        self.cloud_driver.stack_fingerprint = 'stack1'
+        connection.ex_get_node.side_effect = [ResourceNotFoundError('gone', 404, 'notFound'), 'gcenode']
+        node = self._example_collection().nodes['webapp']
+        connection.AUTH_URL = 'https://auth/'
+
         self.cloud_driver.create_node(node)
-        connection.create_node.assert_any_call(name='webapp2',
-                                               size='n1-standard-2',
-                                               image=None,
-                                               ex_disks_gce_struct=_disk_struct.return_value,
-                                               ex_metadata={'items': [{'key': 'startup-script',
-                                                                       'value': '#!/bin/bash\necho hello\n'}]},
-                                               ex_tags=['webapp'])
+
+        self.assertEqual(node.private, 'gcenode')
+        request_ids = [kwargs['params']['requestId'] for args, kwargs in connection.connection.async_request.call_args_list]
+        self.assertEqual(len(set(request_ids)), 2)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._fetch_disks')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._bulk_disk_struct')
+    def test_create_nodes_bulk_insert(self, _bulk_disk_struct, _fetch_disks, connection):
+        self.cloud_driver.namespace = 'testns'
+        sg = cloud_models.SecurityGroup(name='webapp')
+        nodes = [cloud_models.Node(name='web%d' % i, flavor='n1-standard-2', image='trusty', disk=10,
+                                   networks=[], security_groups=set([sg]))
+                 for i in range(1, 4)]
+        connection.AUTH_URL = 'https://auth/'
+        connection.connection.request.return_value.object = {'items': [{'name': 'web3'}, {'name': 'web1'}, {'name': 'web2'}]}
+        connection._to_node.side_effect = lambda instance, use_disk_cache: GCENode(instance['name'])
+
+        self.cloud_driver.create_nodes(nodes)
+
+        connection.connection.async_request.assert_called_once_with(
+            '/zones/location1/instances/bulkInsert', method='POST', params=None,
+            data={'count': 3,
+                  'minCount': 3,
+                  'instanceProperties': {'machineType': 'n1-standard-2',
+                                         'disks': _bulk_disk_struct.return_value,
+                                         'networkInterfaces': [{'network': 'global/networks/default',
+                                                                'accessConfigs': [{'name': 'External NAT',
+                                                                                   'type': 'ONE_TO_ONE_NAT'}]}],
+                                         'serviceAccounts': [{'email': 'default',
+                                                              'scopes': ['https://auth/devstorage.read_only']}],
+                                         'tags': {'items': ['webapp']},
+                                         'metadata': {'items': [{'key': 'aasemble_namespace', 'value': 'testns'}]},
+                                         'labels': {'aasemble_namespace': 'testns'}},
+                  'perInstanceProperties': {'web1': {}, 'web2': {}, 'web3': {}}})
+        _bulk_disk_struct.assert_called_once_with(nodes[0])
+
+        # Only the batch's instances are looked up, not the whole zone.
+        connection.connection.request.assert_called_once_with('/zones/location1/instances', method='GET',
+                                                              params={'filter': '((name = "web1") OR (name = "web2") OR (name = "web3"))',
+                                                                      'maxResults': 500})
+        self.assertFalse(connection.list_nodes.called)
+        self.assertEqual([node.private.name for node in nodes], ['web1', 'web2', 'web3'])
+        self.assertFalse(connection.create_node.called)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.create_node')
+    def test_create_nodes_single(self, create_node):
+        node = cloud_models.Node(name='web1', flavor='n1-standard-2', image='trusty', disk=10, networks=[])
+        self.cloud_driver.create_nodes([node])
+        create_node.assert_called_once_with(node)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._instance_properties')
+    def test_create_node_tracked(self, _instance_properties, connection):
+        cloud_driver = gce.GCEDriver(gce_key_file=self.gce_key_file, location='location1', track_operations=True)
+        node = cloud_models.Node(name='web1', flavor='n1-standard-2', image='trusty', disk=10, networks=[])
+        _instance_properties.return_value = {'machineType': 'n1-standard-2'}
+        connection.connection.request.return_value.object = {'name': 'operation-1'}
+
+        cloud_driver.create_node(node)
+
+        connection.connection.request.assert_called_once_with('/zones/location1/instances', method='POST', params=None,
+                                                              data={'name': 'web1',
+                                                                    'machineType': 'zones/location1/machineTypes/n1-standard-2'})
+        self.assertFalse(connection.create_node.called)
+        self.assertEqual(node.server_status, 'PENDING')
+        self.assertEqual(cloud_driver.operation_tracker.pending, {('location1', 'operation-1'): [node]})
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_list_zone_operations_pages(self, connection):
+        connection.connection.request.side_effect = [mock.MagicMock(object={'items': [{'name': 'op1'}], 'nextPageToken': 'next'}),
+                                                     mock.MagicMock(object={'items': [{'name': 'op2'}]})]
+
+        self.assertEqual([op['name'] for op in self.cloud_driver.list_zone_operations('zone1')], ['op1', 'op2'])
+
+        self.assertEqual(len(connection.connection.request.call_args_list), 2)
+        args, kwargs = connection.connection.request.call_args
+        self.assertEqual(args, ('/zones/zone1/operations',))
+        self.assertEqual(kwargs['params']['pageToken'], 'next')
+        self.assertEqual(kwargs['params']['filter'], '(operationType = "insert") OR (operationType = "bulkInsert")')
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_wait_for_operations(self, connection):
+        cloud_driver = gce.GCEDriver(gce_key_file=self.gce_key_file, location='location1', track_operations=True)
+        node = cloud_models.Node(name='web1', flavor='n1-standard-2', image='trusty', disk=10, networks=[])
+        cloud_driver.operation_tracker.add('location1', {'name': 'op1'}, [node])
+        connection.connection.request.side_effect = [mock.MagicMock(object={'items': [{'name': 'op1', 'status': 'DONE'}]}),
+                                                     mock.MagicMock(object={'items': [{'name': 'web1'}]})]
+        connection._to_node.side_effect = lambda instance, use_disk_cache: GCENode(instance['name'])
+
+        cloud_driver.wait_for_operations()
+
+        self.assertEqual(node.server_status, 'DONE')
+        self.assertEqual(node.private.name, 'web1')
+
+    def test_wait_for_operations_untracked(self):
+        self.cloud_driver.wait_for_operations()
+
+    def test_namespace_label(self):
+        self.assertIsNone(self.cloud_driver.namespace_label)
+        self.cloud_driver.namespace = 'My.Stack'
+        self.assertEqual(self.cloud_driver.namespace_label, 'my-stack')
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_list_candidate_node_pages_without_namespace(self, connection):
+        connection.connection.request.return_value.object = {'items': [{'name': 'web1'}]}
+        connection._to_node.side_effect = lambda instance, use_disk_cache: GCENode(instance['name'])
+
+        self.assertEqual([[node.name for node in page] for page in self.cloud_driver._list_candidate_node_pages()], [['web1']])
+
+        connection.connection.request.assert_called_once_with('/zones/location1/instances', method='GET',
+                                                              params={'maxResults': 500})
+        self.assertFalse(connection.list_nodes.called)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._fetch_disks')
+    def test_live_node_ids(self, _fetch_disks, connection):
+        connection.connection.request.return_value.object = {'items': [{'name': 'web1', 'id': '1'},
+                                                                       {'name': 'other', 'id': '2'}]}
+
+        self.assertEqual(self.cloud_driver.live_node_ids(set(['web1', 'web2'])), set(['1']))
+
+        connection.connection.request.assert_called_once_with('/zones/location1/instances', method='GET',
+                                                              params={'filter': '((name = "web1") OR (name = "web2"))',
+                                                                      'maxResults': 500})
+        self.assertFalse(_fetch_disks.called)
+        self.assertFalse(connection._to_node.called)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver._fetch_disks')
+    def test_list_candidate_node_pages_fetches_boot_disks_per_page(self, _fetch_disks, connection):
+        connection.connection.request.side_effect = [mock.MagicMock(object={'items': [{'name': 'web1', 'disks': [{'source': 'disk1'}]},
+                                                                                      {'name': 'web2', 'disks': [{'source': 'disk2'}]}],
+                                                                            'nextPageToken': 'next'}),
+                                                     mock.MagicMock(object={'items': [{'name': 'web3', 'disks': [{'source': 'disk3'}]}]})]
+        fetched = []
+        _fetch_disks.side_effect = lambda links: fetched.append(list(links))
+
+        pages = self.cloud_driver._list_candidate_node_pages()
+        next(pages)
+        self.assertEqual(fetched, [['disk1', 'disk2']])
+
+        list(pages)
+        self.assertEqual(fetched, [['disk1', 'disk2'], ['disk3']])
+        self.assertEqual(connection.connection.request.call_args[1]['params']['pageToken'], 'next')
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_list_candidate_node_pages_filters_on_label(self, connection):
+        self.cloud_driver.namespace = 'testns'
+        connection.connection.request.return_value.object = {'items': [{'name': 'web1'}, {'name': 'web2'}]}
+        connection._to_node.side_effect = lambda instance, use_disk_cache: GCENode(instance['name'], namespace='testns')
+
+        self.assertEqual([[node.name for node in page] for page in self.cloud_driver._list_candidate_node_pages()], [['web1', 'web2']])
+
+        self.assertEqual(connection.connection.request.call_args_list,
+                         [mock.call('/zones/location1/instances', method='GET',
+                                    params={'filter': '(labels.aasemble_namespace = "testns")', 'maxResults': 500}),
+                          mock.call('/zones/location1/instances', method='GET',
+                                    params={'filter': '(NOT labels.aasemble_namespace:*)', 'maxResults': 500})])
+        self.assertFalse(connection.list_nodes.called)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_list_candidate_node_pages_filters_on_names(self, connection):
+        self.cloud_driver.namespace = 'testns'
+        connection.connection.request.return_value.object = {'items': []}
+
+        with mock.patch.object(gce, 'MAX_FILTER_NAMES', 2):
+            list(self.cloud_driver._list_candidate_node_pages(set(['web1', 'web2', 'web3'])))
+
+        self.assertEqual([kwargs['params']['filter'] for args, kwargs in connection.connection.request.call_args_list],
+                         ['(labels.aasemble_namespace = "testns") AND ((name = "web1") OR (name = "web2"))',
+                          '(labels.aasemble_namespace = "testns") AND ((name = "web3"))',
+                          '(NOT labels.aasemble_namespace:*) AND ((name = "web1") OR (name = "web2"))',
+                          '(NOT labels.aasemble_namespace:*) AND ((name = "web3"))'])
+
+    def _legacy_instance(self, name, namespace='testns', labels=None):
+        instance = {'name': name, 'id': name, 'labelFingerprint': 'fp-%s' % (name,),
+                    'metadata': {'items': [{'key': 'aasemble_namespace', 'value': namespace}]}}
+        if labels is not None:
+            instance['labels'] = labels
+        return instance
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_detect_finds_metadata_only_instances(self, connection):
+        self.cloud_driver.namespace = 'testns'
+        responses = {'(labels.aasemble_namespace = "testns")': [],
+                     '(NOT labels.aasemble_namespace:*)': [self._legacy_instance('old1', labels={'team': 'x'}),
+                                                           self._legacy_instance('other', namespace='otherns'),
+                                                           self._legacy_instance('new1', labels={'aasemble_namespace': 'testns'})]}
+
+        def request(path, method='GET', params=None, data=None):
+            if method == 'POST':
+                return mock.MagicMock(object={'name': 'op'})
+            return mock.MagicMock(object={'items': responses[params.get('filter')]})
+
+        connection.connection.request.side_effect = request
+        connection._to_node.side_effect = lambda instance, use_disk_cache: GCENode(instance['name'], namespace=instance['metadata']['items'][0]['value'])
+
+        nodes = [node for page in self.cloud_driver._get_relevant_node_pages() for node in page]
+
+        self.assertEqual([node.name for node in nodes], ['old1'])
+        # Detecting doesn't write; applying labels what it found.
+        self.assertFalse([c for c in connection.connection.request.call_args_list if c[1]['method'] == 'POST'])
+
+        self.cloud_driver._run_apply(mock.MagicMock())
+
+        connection.connection.request.assert_any_call('/zones/location1/instances/old1/setLabels', method='POST',
+                                                      data={'labels': {'team': 'x', 'aasemble_namespace': 'testns'},
+                                                            'labelFingerprint': 'fp-old1'})
+        self.assertEqual(len([c for c in connection.connection.request.call_args_list if c[1]['method'] == 'POST']), 1)
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_detect_finds_unlabelled_instances_alongside_labelled_ones(self, connection):
+        self.cloud_driver.namespace = 'testns'
+        responses = {'(labels.aasemble_namespace = "testns")': [self._legacy_instance('new1', labels={'aasemble_namespace': 'testns'})],
+                     '(NOT labels.aasemble_namespace:*)': [self._legacy_instance('old1')]}
+        connection.connection.request.side_effect = lambda path, method='GET', params=None: mock.MagicMock(object={'items': responses[params['filter']]})
+        connection._to_node.side_effect = lambda instance, use_disk_cache: GCENode(instance['name'], namespace='testns')
+
+        self.assertEqual([[node.name for node in page] for page in self.cloud_driver._get_relevant_node_pages()], [['new1'], ['old1']])
+
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_live_node_ids_finds_metadata_only_instances(self, connection):
+        self.cloud_driver.namespace = 'testns'
+        responses = {'(labels.aasemble_namespace = "testns") AND ((name = "new1") OR (name = "old1"))':
+                     [self._legacy_instance('new1', labels={'aasemble_namespace': 'testns'})],
+                     '(NOT labels.aasemble_namespace:*) AND ((name = "old1"))': [self._legacy_instance('old1')]}
+
+        def request(path, method='GET', params=None, data=None):
+            if method == 'POST':
+                return mock.MagicMock(object={'name': 'op'})
+            return mock.MagicMock(object={'items': responses[params['filter']]})
+
+        connection.connection.request.side_effect = request
+
+        self.assertEqual(self.cloud_driver.live_node_ids(set(['new1', 'old1'])), set(['new1', 'old1']))
+        self.assertFalse([c for c in connection.connection.request.call_args_list if c[1]['method'] == 'POST'])
 
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     def test_delete_node(self, connection):
@@ -273,6 +601,19 @@ class GCEDriverTestCase(unittest.TestCase):
         self.cloud_driver.delete_node(webapp)
         connection.destroy_node.assert_called_with(mock.sentinel.webapppriv)
 
+    @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
+    def test_update_node_sets_tags(self, connection):
+        current = cloud_models.Node(name='webapp', image='trusty', flavor='n1-standard-2', disk=37, networks=[],
+                                    private=mock.sentinel.webapppriv)
+        desired = cloud_models.Node(name='webapp', image='trusty', flavor='n1-standard-2', disk=37, networks=[],
+                                    security_groups=set([cloud_models.SecurityGroup(name='web'),
+                                                         cloud_models.SecurityGroup(name='ssh')]))
+
+        self.cloud_driver.update_node(plan.Change(plan.UPDATE, 'node', 'webapp', desired=desired, current=current,
+                                                  fields=('security_groups',)))
+
+        connection.ex_set_node_tags.assert_called_with(mock.sentinel.webapppriv, ['ssh', 'web'])
+
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     def test_delete_security_group_rule(self, connection):
         sg = cloud_models.SecurityGroup(name='sg')
@@ -309,6 +650,10 @@ class GCEDriverTestCase(unittest.TestCase):
         _resolve_image_name.assert_called_with('mappedtrusty')
         apply_mappings.assert_called_with('images', 'trusty')
 
+        # bulkInsert wants the disk type's name rather than its zonal URL.
+        self.assertEqual(self.cloud_driver._bulk_disk_struct(node)[0]['initializeParams']['diskType'], 'pd-ssd')
+        self.assertEqual(len(_get_disk_type.call_args_list), 1)
+
     @mock.patch('aasemble.deployment.cloud.gce.GCEDriver.connection')
     def test_resolve_image_name(self, connection):
         class NodeImage(mock.MagicMock):
@@ -467,3 +812,56 @@ class GCEDriverTestCase(unittest.TestCase):
                           'proxyconf': {'backends': ['somebackend'],
                                         'domains': {'example.com': {'/foo/bar': {'destination': 'somebackend/somepath',
                                                                                  'type': 'backend'}}}}})
+
+
+class OperationTrackerTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OperationTrackerTestCase, self).setUp()
+        self.driver = mock.MagicMock()
+        self.operations = {}
+        self.driver.list_zone_operations.side_effect = lambda zone: list(self.operations.get(zone, []))
+        self.sleeps = []
+        self.tracker = gce.OperationTracker(self.driver, interval=1, sleep=self.sleeps.append)
+
+    def _node(self, name):
+        return cloud_models.Node(name=name, flavor='n1-standard-2', image='trusty', disk=10, networks=[])
+
+    def test_wait_polls_each_zone_once_per_round(self):
+        web1, web2, web3 = self._node('web1'), self._node('web2'), self._node('web3')
+        self.tracker.add('zone1', {'name': 'op1'}, [web1])
+        self.tracker.add('zone1', {'name': 'op2'}, [web2])
+        self.tracker.add('zone2', {'name': 'op3'}, [web3])
+
+        def sleep(interval):
+            self.sleeps.append(interval)
+            self.operations['zone1'] = [{'name': 'op1', 'status': 'DONE'}, {'name': 'op2', 'status': 'DONE'}]
+
+        self.tracker.sleep = sleep
+        self.operations = {'zone1': [{'name': 'op1', 'status': 'DONE'}, {'name': 'op2', 'status': 'RUNNING'}],
+                           'zone2': [{'name': 'op3', 'status': 'DONE'}, {'name': 'unrelated', 'status': 'DONE'}]}
+
+        self.assertEqual(set(self.tracker.wait()), set([web1, web2, web3]))
+        self.assertEqual(self.driver.list_zone_operations.call_args_list,
+                         [mock.call('zone1'), mock.call('zone2'), mock.call('zone1')])
+        self.assertEqual(self.sleeps, [1])
+        self.assertEqual([n.server_status for n in (web1, web2, web3)], ['DONE', 'DONE', 'DONE'])
+
+    def test_wait_reports_failures(self):
+        web1, web2 = self._node('web1'), self._node('web2')
+        self.tracker.add('zone1', {'name': 'op1'}, [web1])
+        self.tracker.add('zone1', {'name': 'op2'}, [web2])
+        self.operations = {'zone1': [{'name': 'op1', 'status': 'DONE'},
+                                     {'name': 'op2', 'status': 'DONE',
+                                      'error': {'errors': [{'code': 'QUOTA_EXCEEDED', 'message': 'Quota CPUS exceeded'}]}}]}
+
+        self.assertRaises(exceptions.ProvisionFailedException, self.tracker.wait)
+        self.assertEqual(web1.server_status, 'DONE')
+        self.assertEqual(web2.server_status, 'FAILED')
+        self.assertEqual(self.tracker.pending, {})
+
+    def test_wait_times_out(self):
+        self.tracker.timeout = -1
+        self.tracker.add('zone1', {'name': 'op1'}, [self._node('web1')])
+
+        self.assertRaises(exceptions.ProvisionTimedOutException, self.tracker.wait)
+        self.assertEqual(self.tracker.pending, {})
@@ -0,0 +1,104 @@
+import unittest
+
+import mock
+
+from aasemble.deployment.cloud import limiter
+
+
+class Throttled(Exception):
+    pass
+
+
+def is_throttled(exc):
+    return isinstance(exc, Throttled)
+
+
+class OperationClassTests(unittest.TestCase):
+    def test_operation_class(self):
+        self.assertEqual(limiter.operation_class('create_node'), 'create')
+        self.assertEqual(limiter.operation_class('create_security_group_rule'), 'create')
+        self.assertEqual(limiter.operation_class('delete_node'), 'delete')
+        self.assertEqual(limiter.operation_class('detect_nodes'), 'list')
+        self.assertEqual(limiter.operation_class('something_else'), 'other')
+
+
+class AdaptiveLimitTests(unittest.TestCase):
+    def test_increases_on_success(self):
+        limit = limiter.AdaptiveLimit('test', initial=2, maximum=10)
+        for i in range(10):
+            limit.acquire()
+            limit.release()
+        self.assertGreater(limit.limit, 2)
+        self.assertLessEqual(limit.limit, 10)
+
+    def test_never_exceeds_maximum(self):
+        limit = limiter.AdaptiveLimit('test', initial=2, maximum=3)
+        for i in range(100):
+            limit.acquire()
+            limit.release()
+        self.assertEqual(limit.limit, 3)
+
+    def test_halves_on_throttle(self):
+        limit = limiter.AdaptiveLimit('test', initial=8, maximum=10)
+        limit.acquire()
+        limit.release(throttled=True)
+        self.assertEqual(limit.limit, 4)
+        self.assertEqual(limit.throttles, 1)
+
+    def test_never_below_minimum(self):
+        limit = limiter.AdaptiveLimit('test', initial=1, maximum=10)
+        limit.acquire()
+        limit.release(throttled=True)
+        self.assertEqual(limit.limit, 1)
+
+
+class AdaptiveLimiterTests(unittest.TestCase):
+    def setUp(self):
+        super(AdaptiveLimiterTests, self).setUp()
+        self.sleep = mock.MagicMock()
+        self.limiter = limiter.AdaptiveLimiter(10, sleep=self.sleep, random=lambda: 1.0)
+
+    def test_initial(self):
+        self.assertEqual(self.limiter.limit_for('EC2', 'create').limit, 5)
+        self.assertEqual(limiter.AdaptiveLimiter(1).initial, 1)
+
+    def test_limits_are_per_provider_and_class(self):
+        self.assertIsNot(self.limiter.limit_for('EC2', 'create'), self.limiter.limit_for('EC2', 'list'))
+        self.assertIsNot(self.limiter.limit_for('EC2', 'create'), self.limiter.limit_for('GCE', 'create'))
+        self.assertIs(self.limiter.limit_for('EC2', 'create'), self.limiter.limit_for('EC2', 'create'))
+
+    def test_call(self):
+        func = mock.MagicMock()
+        self.assertEqual(self.limiter.call('EC2', 'create', func, 'arg'), func.return_value)
+        func.assert_called_with('arg')
+        self.assertEqual(self.limiter.state()['EC2/create']['successes'], 1)
+
+    def test_call_does_not_retry(self):
+        func = mock.MagicMock()
+        func.side_effect = Throttled()
+        self.assertRaises(Throttled, self.limiter.call, 'EC2', 'create', func, 'arg')
+        self.assertEqual(len(func.call_args_list), 1)
+        self.assertEqual(self.limiter.state()['EC2/create']['in_flight'], 0)
+        self.assertEqual(self.limiter.state()['EC2/create']['successes'], 0)
+
+    def test_request_retries_throttled(self):
+        func = mock.MagicMock()
+        func.side_effect = [Throttled(), Throttled(), 'ok']
+        self.assertEqual(self.limiter.request('EC2', 'create', is_throttled, func, '/path', method='POST'), 'ok')
+        self.assertEqual(func.call_args_list, [mock.call('/path', method='POST')] * 3)
+        self.assertEqual(self.sleep.call_args_list, [mock.call(1.0), mock.call(2.0)])
+        self.assertEqual(self.limiter.state()['EC2/create']['throttles'], 2)
+        self.assertLess(self.limiter.state()['EC2/create']['limit'], self.limiter.initial)
+
+    def test_request_gives_up_eventually(self):
+        func = mock.MagicMock()
+        func.side_effect = Throttled()
+        self.assertRaises(Throttled, self.limiter.request, 'EC2', 'create', is_throttled, func, '/path')
+        self.assertEqual(len(func.call_args_list), self.limiter.max_throttle_retries + 1)
+
+    def test_request_does_not_retry_other_errors(self):
+        func = mock.MagicMock()
+        func.side_effect = ValueError()
+        self.assertRaises(ValueError, self.limiter.request, 'EC2', 'create', is_throttled, func, '/path')
+        self.assertEqual(len(func.call_args_list), 1)
+        self.sleep.assert_not_called()
@@ -0,0 +1,144 @@
+import json
+import unittest
+
+import mock
+
+from aasemble.deployment.cloud import metrics
+
+
+class FakeConnection(object):
+    def __init__(self, body='{"items": []}', error=None):
+        self.body = body
+        self.error = error
+        self.requests = []
+
+    def request(self, action, params=None, data=None, headers=None, method='GET'):
+        self.requests.append((action, params, data, method))
+        if self.error is not None:
+            raise self.error
+        return mock.Mock(body=self.body)
+
+
+class FakeDriver(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class CallNameTests(unittest.TestCase):
+    def test_query_api(self):
+        self.assertEqual(metrics.call_name('/', {'Action': 'RunInstances'}), 'RunInstances')
+
+    def test_rest_members(self):
+        self.assertEqual(metrics.call_name('/zones/europe-west1-b/instances/web1'), 'GET /zones/{}/instances/{}')
+        self.assertEqual(metrics.call_name('/v2/droplets/1234/actions', method='POST'), 'POST /v2/droplets/{}/actions')
+        self.assertEqual(metrics.call_name('/global/firewalls/webapp-tcp-443-443', method='DELETE'), 'DELETE /global/firewalls/{}')
+
+    def test_rest_custom_methods(self):
+        self.assertEqual(metrics.call_name('/zones/europe-west1-b/instances/bulkInsert', method='POST'),
+                         'POST /zones/{}/instances/bulkInsert')
+        self.assertEqual(metrics.call_name('/zones/europe-west1-b/instances/web1/setTags', method='POST'),
+                         'POST /zones/{}/instances/{}/setTags')
+
+
+class HistogramTests(unittest.TestCase):
+    def test_observe(self):
+        hist = metrics.Histogram((1, 10))
+        for value in (0.5, 1, 5, 20):
+            hist.observe(value)
+
+        self.assertEqual(hist.cumulative(), [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(hist.sum, 26.5)
+        self.assertEqual(hist.quantile(0.5), 1)
+        self.assertEqual(hist.quantile(0.99), float('inf'))
+        self.assertEqual(hist.as_dict()['buckets'], [[1, 2], [10, 3], ['+Inf', 4]])
+
+    def test_empty(self):
+        self.assertIsNone(metrics.Histogram((1, 10)).quantile(0.5))
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.now = [100.0]
+        self.metrics = metrics.Metrics(clock=lambda: self.now[0])
+
+    def _connection(self, latency=0.2, **kwargs):
+        connection = FakeConnection(**kwargs)
+        request = connection.request
+
+        def slow_request(*args, **kwargs):
+            self.now[0] += latency
+            return request(*args, **kwargs)
+
+        connection.request = slow_request
+        self.metrics.instrument(FakeDriver(connection), 'GCE')
+        return connection
+
+    def _operations(self):
+        return dict((op['operation'], op) for op in self.metrics.as_dict()['operations'])
+
+    def test_instrument(self):
+        connection = self._connection()
+
+        with self.metrics.operation('create_node'):
+            connection.request('/zones/zone1/instances', method='POST', data={'name': 'web1'})
+        connection.request('/zones/zone1/instances/web1')
+
+        operations = self._operations()
+        self.assertEqual(operations['create_node']['calls'], {'POST /zones/{}/instances': 1})
+        self.assertEqual(operations['create_node']['provider'], 'GCE')
+        self.assertAlmostEqual(operations['create_node']['latency']['sum'], 0.2)
+        self.assertEqual(operations['create_node']['latency']['p50'], 0.25)
+        self.assertEqual(operations['create_node']['request_bytes']['sum'], len(json.dumps({'name': 'web1'})))
+        self.assertEqual(operations['create_node']['response_bytes']['sum'], len('{"items": []}'))
+        self.assertEqual(operations['other']['calls'], {'GET /zones/{}/instances/{}': 1})
+        self.assertEqual(connection.requests[0], ('/zones/zone1/instances', None, {'name': 'web1'}, 'POST'))
+
+    def test_instrument_errors(self):
+        connection = self._connection(error=ValueError('boom'))
+
+        with self.metrics.operation('detect_nodes'):
+            self.assertRaises(ValueError, connection.request, '/aggregated/instances')
+
+        self.assertEqual(self._operations()['detect_nodes']['errors'], 1)
+        self.assertEqual(self._operations()['detect_nodes']['latency']['count'], 1)
+
+    def test_operation_nests(self):
+        with self.metrics.operation('outer'):
+            with self.metrics.operation('inner'):
+                self.assertEqual(self.metrics.current_operation(), 'inner')
+            self.assertEqual(self.metrics.current_operation(), 'outer')
+        self.assertIsNone(self.metrics.current_operation())
+
+    def test_retries_and_throttles(self):
+        self.metrics.retried('EC2', 'create_node')
+        self.metrics.retried('EC2', 'create_node')
+        self.metrics.throttled('EC2', 'create_node')
+
+        self.assertEqual(self._operations()['create_node']['retries'], 2)
+        self.assertEqual(self._operations()['create_node']['throttles'], 1)
+
+    def test_as_prometheus(self):
+        with self.metrics.operation('create_node'):
+            self.metrics.observe('EC2', 'RunInstances', 0.3, 100, 2000)
+        self.metrics.throttled('EC2', 'create_node')
+
+        lines = self.metrics.as_prometheus().splitlines()
+
+        self.assertIn('# TYPE aasemble_api_call_duration_seconds histogram', lines)
+        self.assertIn('aasemble_api_call_duration_seconds_bucket{le="0.25",operation="create_node",provider="EC2"} 0', lines)
+        self.assertIn('aasemble_api_call_duration_seconds_bucket{le="0.5",operation="create_node",provider="EC2"} 1', lines)
+        self.assertIn('aasemble_api_call_duration_seconds_bucket{le="+Inf",operation="create_node",provider="EC2"} 1', lines)
+        self.assertIn('aasemble_api_call_duration_seconds_count{operation="create_node",provider="EC2"} 1', lines)
+        self.assertIn('aasemble_api_response_bytes_sum{operation="create_node",provider="EC2"} 2000', lines)
+        self.assertIn('aasemble_api_calls_total{call="RunInstances",operation="create_node",provider="EC2"} 1', lines)
+        self.assertIn('aasemble_api_throttles_total{operation="create_node",provider="EC2"} 1', lines)
+
+    def test_write_json(self):
+        self.metrics.observe('EC2', 'DescribeInstances', 0.1)
+
+        with mock.patch('aasemble.deployment.cloud.metrics.open', mock.mock_open(), create=True) as m:
+            self.metrics.write('/some/metrics.json')
+
+        m.assert_called_once_with('/some/metrics.json', 'w')
+        written = ''.join(call[0][0] for call in m().write.call_args_list)
+        self.assertEqual(json.loads(written)['operations'][0]['calls'], {'DescribeInstances': 1})
@@ -105,6 +105,122 @@ class NamedSetTests(unittest.TestCase):
 
         self.assertEqual(s_, set())
 
+    def test_contains_other_item_with_same_name(self):
+        s = models.NamedSet()
+        s.add(NamedItem('thename'))
+        self.assertNotIn(NamedItem('thename'), s)
+        self.assertNotIn('thename', s)
+
+    def test_index(self):
+        s = models.NamedSet()
+        s.add_index('initial', lambda item: [item.name[0]])
+        item1 = NamedItem('apple')
+        item2 = NamedItem('avocado')
+        item3 = NamedItem('banana')
+        s.add(item1)
+        s.add(item2)
+        s.add(item3)
+
+        self.assertEqual(set(s.lookup('initial', 'a')), set([item1, item2]))
+        self.assertEqual(s.lookup('initial', 'b'), [item3])
+        self.assertEqual(s.lookup('initial', 'c'), [])
+
+        s.remove(item1)
+        self.assertEqual(s.lookup('initial', 'a'), [item2])
+
+        s.add(NamedItem('banana'))
+        self.assertNotIn(item3, s.lookup('initial', 'b'))
+
+    def test_index_existing_items(self):
+        s = models.NamedSet()
+        item = NamedItem('apple')
+        s.add(item)
+        s.add_index('initial', lambda item: [item.name[0]])
+        self.assertEqual(s.lookup('initial', 'a'), [item])
+
+    def test_reindex(self):
+        s = models.NamedSet()
+        s.add_index('tags', lambda item: getattr(item, 'tags', []))
+        item = NamedItem('thename')
+        s.add(item)
+
+        item.tags = ['tag1', 'tag2']
+        s.reindex(item)
+
+        self.assertEqual(s.lookup('tags', 'tag1'), [item])
+        self.assertEqual(s.lookup('tags', 'tag2'), [item])
+
+        item.tags = ['tag2']
+        s.reindex(item)
+
+        self.assertEqual(s.lookup('tags', 'tag1'), [])
+        self.assertEqual(s.lookup('tags', 'tag2'), [item])
+
+    def test_sub_keeps_indexes(self):
+        s1 = models.NamedSet()
+        s1.add_index('initial', lambda item: [item.name[0]])
+        s2 = models.NamedSet()
+        item1 = NamedItem('apple')
+        item2 = NamedItem('avocado')
+        s1.add(item1)
+        s1.add(item2)
+        s2.add(item1)
+
+        self.assertEqual((s1 - s2).lookup('initial', 'a'), [item2])
+
+    def _indexed(self, *names):
+        s = models.NamedSet()
+        s.add_index('initial', lambda item: [item.name[0]])
+        for name in names:
+            s.add(NamedItem(name))
+        return s
+
+    def test_update_indexes(self):
+        s = self._indexed('apple')
+        item = NamedItem('avocado')
+        s.update({'avocado': item})
+        s.update(banana=NamedItem('banana'))
+
+        self.assertIn(item, s.lookup('initial', 'a'))
+        self.assertEqual(sorted(s.index_keys('initial')), ['a', 'b'])
+
+    def test_setdefault_indexes(self):
+        s = self._indexed()
+        item = NamedItem('apple')
+
+        self.assertIs(s.setdefault('apple', item), item)
+        self.assertIs(s.setdefault('apple', NamedItem('apple')), item)
+        self.assertEqual(s.lookup('initial', 'a'), [item])
+
+    def test_pop_unindexes(self):
+        s = self._indexed('apple', 'banana')
+
+        self.assertEqual(s.pop('apple').name, 'apple')
+        self.assertEqual(s.lookup('initial', 'a'), [])
+        self.assertIsNone(s.pop('apple', None))
+        self.assertRaises(KeyError, s.pop, 'apple')
+
+        name, item = s.popitem()
+        self.assertEqual(s.lookup('initial', 'b'), [])
+        self.assertEqual(s.index_keys('initial'), [])
+
+    def test_clear_unindexes(self):
+        s = self._indexed('apple', 'banana')
+        s.clear()
+
+        self.assertEqual(s.index_keys('initial'), [])
+        s.add(NamedItem('cherry'))
+        self.assertEqual(s.index_keys('initial'), ['c'])
+
+    def test_copy_keeps_indexes(self):
+        s = self._indexed('apple')
+        copy = s.copy()
+        copy.add(NamedItem('avocado'))
+
+        self.assertIsInstance(copy, models.NamedSet)
+        self.assertEqual(len(copy.lookup('initial', 'a')), 2)
+        self.assertEqual(len(s.lookup('initial', 'a')), 1)
+
 
 class CollectionTests(unittest.TestCase):
     def test_init(self):
@@ -181,6 +297,24 @@ class CollectionTests(unittest.TestCase):
         self.assertIn(sg1, n.security_groups)
         self.assertIn(sg2, n.security_groups)
 
+    def test_connect_indexes_nodes(self):
+        c = models.Collection()
+        n1 = models.Node(name='node1', flavor='small', image='image', networks=[], disk=10)
+        n1.security_group_names = ['securitygroup1']
+        n2 = models.Node(name='node2', flavor='large', image='image', networks=[], disk=10)
+        n2.security_group_names = ['securitygroup1', 'securitygroup2']
+        c.nodes.add(n1)
+        c.nodes.add(n2)
+        c.security_groups.add(models.SecurityGroup(name='securitygroup1'))
+        c.security_groups.add(models.SecurityGroup(name='securitygroup2'))
+
+        c.connect()
+
+        self.assertEqual(set(c.nodes.lookup('security_group', 'securitygroup1')), set([n1, n2]))
+        self.assertEqual(c.nodes.lookup('security_group', 'securitygroup2'), [n2])
+        self.assertEqual(set(c.nodes.lookup('image', 'image')), set([n1, n2]))
+        self.assertEqual(c.nodes.lookup('flavor', 'large'), [n2])
+
 
 class CloudModelTests(unittest.TestCase):
     class TestClass(models.CloudModel):
@@ -201,6 +335,23 @@ class CloudModelTests(unittest.TestCase):
         tc2 = self.TestClass(mock.sentinel.attr1, mock.sentinel.not_attr2, mock.sentinel.attr3)
         self.assertNotEqual(tc1, tc2)
 
+    def test_hash_is_cached(self):
+        tc = self.TestClass('a', 'b', 'c')
+        self.assertEqual(hash(tc), hash(('a', 'b')))
+
+        with mock.patch.object(self.TestClass, '_identity') as _identity:
+            self.assertEqual(hash(tc), hash(('a', 'b')))
+
+        _identity.assert_not_called()
+
+    def test_invalidate_hash_after_changing_id_attr(self):
+        tc = self.TestClass('a', 'b', 'c')
+        hash(tc)
+        tc.attr2 = 'x'
+        tc._invalidate_hash()
+        self.assertEqual(hash(tc), hash(('a', 'x')))
+        self.assertNotEqual(tc, self.TestClass('a', 'b', 'c'))
+
 
 class NodeTests(unittest.TestCase):
     def test_as_dict(self):
@@ -213,6 +364,31 @@ class NodeTests(unittest.TestCase):
                                            'script': None,
                                            'security_groups': []})
 
+    def test_slots(self):
+        node = models.Node(name='nodename', image='someimage', flavor='someflavor', disk=27, networks=[])
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertRaises(AttributeError, setattr, node, 'not_an_attribute', 1)
+
+    def test_interns_flavor_and_image(self):
+        node1 = models.Node(name='node1', image=''.join(['some', 'image']), flavor=''.join(['some', 'flavor']), disk=27, networks=[])
+        node2 = models.Node(name='node2', image=''.join(['some', 'image']), flavor=''.join(['some', 'flavor']), disk=27, networks=[])
+        self.assertIs(node1.image, node2.image)
+        self.assertIs(node1.flavor, node2.flavor)
+
+    def test_connect_invalidates_node_hash(self):
+        collection = models.Collection()
+        node = models.Node(name='node1', image='someimage', flavor='someflavor', disk=27, networks=[])
+        node.security_group_names = ['webapp']
+        collection.nodes.add(node)
+        collection.security_groups.add(models.SecurityGroup(name='webapp'))
+
+        collection.connect()
+
+        expected = models.Node(name='node1', image='someimage', flavor='someflavor', disk=27, networks=[],
+                               security_groups=set([models.SecurityGroup(name='webapp')]))
+        self.assertEqual(node, expected)
+        self.assertEqual(hash(node), hash(expected))
+
 
 class SecurityGroupTests(unittest.TestCase):
     def test_as_dict(self):
@@ -0,0 +1,136 @@
+import unittest
+
+from aasemble.deployment.cloud import models, plan
+
+
+class DiffTests(unittest.TestCase):
+    def _collection(self, nodes=(), security_groups=(), rules=()):
+        collection = models.Collection()
+        for security_group in security_groups:
+            collection.security_groups.add(security_group)
+        for node in nodes:
+            collection.nodes.add(node)
+        collection.security_group_rules |= set(rules)
+        return collection
+
+    def _node(self, name, flavor='small', image='trusty', disk=10, security_groups=None, script=None):
+        return models.Node(name=name, flavor=flavor, image=image, networks=[], disk=disk,
+                           security_groups=security_groups, script=script)
+
+    def test_unchanged(self):
+        desired = self._collection([self._node('node1')])
+        current = self._collection([self._node('node1')])
+
+        self.assertEqual(list(plan.diff(desired, current)), [])
+
+    def test_create(self):
+        sg = models.SecurityGroup(name='webapp')
+        rule = models.SecurityGroupRule(security_group=sg, source_ip='0.0.0.0/0', from_port=443, to_port=443, protocol='tcp')
+        desired = self._collection([self._node('node1', security_groups=set([sg]))], [sg], [rule])
+
+        result = plan.diff(desired, self._collection())
+
+        self.assertEqual(set(result), set([plan.Change(plan.CREATE, 'node', 'node1'),
+                                           plan.Change(plan.CREATE, 'security_group', 'webapp'),
+                                           plan.Change(plan.CREATE, 'security_group_rule', repr(rule))]))
+        creations = result.creations()
+        self.assertEqual(list(creations.nodes.keys()), ['node1'])
+        self.assertEqual(list(creations.security_groups.keys()), ['webapp'])
+        self.assertEqual(creations.security_group_rules, set([rule]))
+        self.assertIs(creations.original_collection, desired)
+
+    def test_replace_lists_changed_fields(self):
+        desired = self._collection([self._node('node1', flavor='large', disk=20)])
+        current = self._collection([self._node('node1')])
+
+        result = plan.diff(desired, current)
+
+        self.assertEqual(list(result), [plan.Change(plan.REPLACE, 'node', 'node1', fields=('flavor', 'disk'))])
+        self.assertEqual(list(result.creations().nodes), [desired.nodes['node1']])
+        self.assertEqual(list(result.deletions().nodes), [current.nodes['node1']])
+
+    def test_update_in_place(self):
+        desired = self._collection([self._node('node1', security_groups=set([models.SecurityGroup(name='webapp')]))])
+        current = self._collection([self._node('node1')])
+
+        result = plan.diff(desired, current, update_fields=('security_groups',))
+
+        self.assertEqual(list(result), [plan.Change(plan.UPDATE, 'node', 'node1', fields=('security_groups',))])
+        self.assertEqual(len(result.creations().nodes), 0)
+        self.assertEqual(len(result.deletions().nodes), 0)
+
+    def test_update_needs_replace_when_not_updatable(self):
+        desired = self._collection([self._node('node1', security_groups=set([models.SecurityGroup(name='webapp')]))])
+        current = self._collection([self._node('node1')])
+
+        self.assertEqual(plan.diff(desired, current).select(plan.REPLACE, 'node')[0].fields, ('security_groups',))
+
+    def test_unreported_fields_are_ignored(self):
+        desired = self._collection([self._node('node1', script='#!/bin/sh')])
+        current = self._collection([self._node('node1', image=None)])
+
+        self.assertEqual(list(plan.diff(desired, current)), [])
+
+    def test_only_given_fields_are_compared(self):
+        desired = self._collection([self._node('node1', image='xenial')])
+        current = self._collection([self._node('node1')])
+
+        self.assertEqual(list(plan.diff(desired, current, fields=('flavor',))), [])
+
+    def test_desired_value(self):
+        desired = self._collection([self._node('node1', flavor='small')])
+        current = self._collection([self._node('node1', flavor='m4.large')])
+
+        def desired_value(node, field):
+            return {'small': 'm4.large'}.get(node.flavor) if field == 'flavor' else plan.node_value(node, field)
+
+        self.assertEqual(list(plan.diff(desired, current, desired_value=desired_value)), [])
+
+    def test_delete_only_when_pruning(self):
+        sg = models.SecurityGroup(name='old')
+        rule = models.SecurityGroupRule(security_group=sg, source_ip='0.0.0.0/0', from_port=22, to_port=22, protocol='tcp')
+        current = self._collection([self._node('node1', security_groups=set([sg]))], [sg], [rule])
+
+        self.assertEqual(list(plan.diff(self._collection(), current)), [])
+
+        result = plan.diff(self._collection(), current, prune=True)
+
+        self.assertEqual(set(result), set([plan.Change(plan.DELETE, 'node', 'node1'),
+                                           plan.Change(plan.DELETE, 'security_group', 'old'),
+                                           plan.Change(plan.DELETE, 'security_group_rule', repr(rule))]))
+        deletions = result.deletions()
+        self.assertEqual(deletions.nodes.lookup('security_group', 'old'), [current.nodes['node1']])
+        self.assertEqual(deletions.security_group_rules, set([rule]))
+
+    def test_as_dict(self):
+        desired = self._collection([self._node('node1', disk=20), self._node('node2')])
+        current = self._collection([self._node('node1')])
+
+        self.assertEqual(sorted(plan.diff(desired, current).as_dict()['changes'], key=lambda c: c['name']),
+                         [{'action': 'replace', 'kind': 'node', 'name': 'node1', 'fields': ['disk']},
+                          {'action': 'create', 'kind': 'node', 'name': 'node2'}])
+
+    def test_without_replacements(self):
+        desired = self._collection([self._node('node1', disk=20), self._node('node2')])
+        current = self._collection([self._node('node1')])
+
+        result = plan.diff(desired, current).without_replacements()
+
+        self.assertEqual(list(result), [plan.Change(plan.CREATE, 'node', 'node2')])
+        self.assertEqual(list(result.creations().nodes.keys()), ['node2'])
+
+    def test_without_replacements_keeps_groups_in_use(self):
+        web, app, old = [models.SecurityGroup(name=name) for name in ('web', 'app', 'old')]
+
+        def rule(security_group, source_group=None):
+            return models.SecurityGroupRule(security_group=security_group, source_ip=source_group is None and '0.0.0.0/0' or None,
+                                            source_group=source_group, from_port=22, to_port=22, protocol='tcp')
+        app_rule, web_from_app, old_rule = rule(app), rule(web, 'app'), rule(old)
+        desired = self._collection([self._node('app1', security_groups=set([web]))], [web])
+        current = self._collection([self._node('app1', security_groups=set([app]))], [web, app, old],
+                                   [app_rule, web_from_app, old_rule])
+
+        result = plan.diff(desired, current, prune=True).without_replacements()
+
+        self.assertEqual(set(result), set([plan.Change(plan.DELETE, 'security_group', 'old'),
+                                           plan.Change(plan.DELETE, 'security_group_rule', repr(old_rule))]))
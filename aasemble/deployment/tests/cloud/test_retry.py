@@ -0,0 +1,75 @@
+import unittest
+
+import mock
+
+from aasemble.deployment.cloud import models, retry
+
+
+class Transient(Exception):
+    pass
+
+
+def classify(exc):
+    return isinstance(exc, Transient) and retry.TRANSIENT or retry.PERMANENT
+
+
+class BackoffDelayTests(unittest.TestCase):
+    def test_exponential_with_cap(self):
+        delays = [retry.backoff_delay(attempt, 1.0, 10.0, random=lambda: 1.0) for attempt in range(6)]
+        self.assertEqual(delays, [1.0, 2.0, 4.0, 8.0, 10.0, 10.0])
+
+    def test_jitter(self):
+        self.assertEqual(retry.backoff_delay(3, 1.0, 10.0, random=lambda: 0.25), 2.0)
+
+
+class RetryPolicyTests(unittest.TestCase):
+    def setUp(self):
+        super(RetryPolicyTests, self).setUp()
+        self.sleep = mock.MagicMock()
+        self.policy = retry.RetryPolicy(attempts=3, sleep=self.sleep, random=lambda: 1.0)
+
+    def _node(self, name='node1', attempts_left=3):
+        return models.Node(name=name, flavor='small', image='trusty', networks=[], disk=10, attempts_left=attempts_left)
+
+    def test_retries_transient_errors(self):
+        func = mock.MagicMock(side_effect=[Transient(), Transient(), 'ok'])
+
+        self.assertEqual(self.policy.call(classify, func, 'arg'), 'ok')
+        self.assertEqual(self.sleep.call_args_list, [mock.call(1.0), mock.call(2.0)])
+
+    def test_gives_up_after_attempts(self):
+        func = mock.MagicMock(side_effect=Transient())
+
+        self.assertRaises(Transient, self.policy.call, classify, func, 'arg')
+        self.assertEqual(len(func.call_args_list), 3)
+
+    def test_does_not_retry_permanent_errors(self):
+        func = mock.MagicMock(side_effect=ValueError())
+
+        self.assertRaises(ValueError, self.policy.call, classify, func, 'arg')
+        self.assertEqual(len(func.call_args_list), 1)
+        self.sleep.assert_not_called()
+
+    def test_spends_node_budget(self):
+        node = self._node(attempts_left=2)
+        func = mock.MagicMock(side_effect=Transient())
+
+        self.assertRaises(Transient, self.policy.call, classify, func, node)
+        self.assertEqual(len(func.call_args_list), 2)
+        self.assertEqual(node.attempts_left, 0)
+
+    def test_batch_budget_is_the_smallest(self):
+        nodes = [self._node('node1', attempts_left=5), self._node('node2', attempts_left=1)]
+        func = mock.MagicMock(side_effect=Transient())
+
+        self.assertRaises(Transient, self.policy.call, classify, func, nodes)
+        self.assertEqual(len(func.call_args_list), 1)
+
+    def test_budgeted_resources(self):
+        node = self._node()
+        change = mock.Mock(desired=node)
+
+        self.assertEqual(retry.budgeted_resources(node), [node])
+        self.assertEqual(retry.budgeted_resources([node]), [node])
+        self.assertEqual(retry.budgeted_resources(change), [node])
+        self.assertEqual(retry.budgeted_resources(models.SecurityGroup(name='webapp')), [])
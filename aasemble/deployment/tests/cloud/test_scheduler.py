@@ -0,0 +1,114 @@
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from aasemble.deployment import exceptions
+from aasemble.deployment.cloud import scheduler
+
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        super(SchedulerTests, self).setUp()
+        self.pool = ThreadPool(4)
+        self.scheduler = scheduler.Scheduler(self.pool)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.pool.close()
+        super(SchedulerTests, self).tearDown()
+
+    def record(self, arg):
+        with self.lock:
+            self.events.append(arg)
+        return arg.upper()
+
+    def fail(self, arg):
+        raise ValueError(arg)
+
+    def test_runs_everything(self):
+        self.scheduler.add('a', self.record, 'a')
+        self.scheduler.add('b', self.record, 'b')
+
+        tasks = self.scheduler.run()
+
+        self.assertEqual(sorted(self.events), ['a', 'b'])
+        self.assertEqual([t.result for t in tasks], ['A', 'B'])
+        self.assertEqual([t.state for t in tasks], ['done', 'done'])
+
+    def test_respects_requirements(self):
+        self.scheduler.add('c', self.record, 'c', requires=['a', 'b'])
+        self.scheduler.add('b', self.record, 'b', requires=['a'])
+        self.scheduler.add('a', self.record, 'a')
+
+        self.scheduler.run()
+
+        self.assertEqual(self.events, ['a', 'b', 'c'])
+
+    def test_unknown_requirements_are_satisfied(self):
+        self.scheduler.add('a', self.record, 'a', requires=['nonexistent'])
+
+        self.scheduler.run()
+
+        self.assertEqual(self.events, ['a'])
+
+    def test_records_wait_time(self):
+        self.scheduler.add('a', self.record, 'a')
+        self.scheduler.add('b', self.record, 'b', requires=['a'])
+
+        a, b = self.scheduler.run()
+
+        self.assertGreaterEqual(a.wait_time, 0)
+        self.assertGreaterEqual(b.wait_time, a.wait_time)
+        self.assertGreaterEqual(b.ready_at, a.finished_at)
+
+    def test_failure_skips_dependents_and_raises(self):
+        self.scheduler.add('b', self.record, 'b', requires=['a'])
+        self.scheduler.add('c', self.record, 'c', requires=['b'])
+        self.scheduler.add('a', self.fail, 'a')
+        self.scheduler.add('d', self.record, 'd')
+
+        with self.assertRaises(exceptions.ResourcesFailedException) as cm:
+            self.scheduler.run()
+
+        self.assertEqual([(key, type(exc)) for key, exc in cm.exception.failures], [('a', ValueError)])
+        self.assertEqual(sorted(cm.exception.skipped), ['b', 'c'])
+        self.assertEqual(self.events, ['d'])
+        self.assertEqual(self.scheduler.tasks['a'].state, 'failed')
+        self.assertEqual(self.scheduler.tasks['b'].state, 'skipped')
+        self.assertEqual(self.scheduler.tasks['c'].state, 'skipped')
+        self.assertIsInstance(self.scheduler.tasks['c'].exception, exceptions.DependencyFailedException)
+
+    def test_reports_every_failure(self):
+        self.scheduler.add('a', self.fail, 'a')
+        self.scheduler.add('b', self.fail, 'b')
+        self.scheduler.add('c', self.record, 'c')
+
+        with self.assertRaises(exceptions.ResourcesFailedException) as cm:
+            self.scheduler.run()
+
+        self.assertEqual(sorted(key for key, exc in cm.exception.failures), ['a', 'b'])
+        self.assertEqual(self.events, ['c'])
+        self.assertIn('2 operations failed', str(cm.exception))
+
+    def test_interrupt_finishes_task_and_propagates(self):
+        def interrupt(arg):
+            raise KeyboardInterrupt()
+
+        self.scheduler.add('a', interrupt, 'a')
+        self.scheduler.add('b', self.record, 'b', requires=['a'])
+
+        self.assertRaises(KeyboardInterrupt, self.scheduler.run)
+        self.assertEqual(self.scheduler.tasks['a'].state, 'failed')
+        self.assertEqual(self.scheduler.tasks['b'].state, 'skipped')
+        self.assertEqual(self.events, [])
+
+    def test_duplicate_key(self):
+        self.scheduler.add('a', self.record, 'a')
+        self.assertRaises(exceptions.DuplicateResourceException, self.scheduler.add, 'a', self.record, 'a')
+
+    def test_cycle(self):
+        self.scheduler.add('a', self.record, 'a', requires=['b'])
+        self.scheduler.add('b', self.record, 'b', requires=['a'])
+        self.assertRaises(exceptions.DependencyCycleException, self.scheduler.run)
+        self.assertEqual(self.events, [])
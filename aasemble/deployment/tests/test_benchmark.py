@@ -0,0 +1,112 @@
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import six
+
+import aasemble.deployment.cloud.models as cloud_models
+from aasemble.deployment.benchmark import runner
+from aasemble.deployment.benchmark.simulated import SimulatedCloud, SimulatedDriver
+from aasemble.deployment.cloud.limiter import AdaptiveLimiter
+from aasemble.deployment.cloud.retry import RetryPolicy
+
+
+class SimulatedCloudTests(unittest.TestCase):
+    def test_pagination(self):
+        cloud = SimulatedCloud(latency=0, page_size=2)
+        cloud.request('/nodes', data={'names': ['a', 'b', 'c'], 'size': 's', 'image': 'i', 'disk': 10}, method='POST')
+
+        first = cloud.request('/nodes')
+        second = cloud.request('/nodes', params={'page': first['next']})
+
+        self.assertEqual([node['name'] for node in first['nodes']], ['a', 'b'])
+        self.assertEqual([node['name'] for node in second['nodes']], ['c'])
+        self.assertIsNone(second['next'])
+
+    def test_client_token(self):
+        cloud = SimulatedCloud(latency=0)
+        data = {'names': ['a'], 'size': 's', 'image': 'i', 'disk': 10, 'client_token': 'token1'}
+
+        first = cloud.request('/nodes', data=data, method='POST')
+        second = cloud.request('/nodes', data=data, method='POST')
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(cloud.nodes), 1)
+
+    def test_latency(self):
+        slept = []
+        cloud = SimulatedCloud(latency=0.1, jitter=0, sleep=slept.append)
+
+        cloud.request('/nodes')
+
+        self.assertEqual(slept, [0.1])
+
+
+class SimulatedDriverTests(unittest.TestCase):
+    def _driver(self, cloud):
+        return SimulatedDriver(cloud=cloud, namespace='test', pool=ThreadPool(4),
+                               limiter=AdaptiveLimiter(4, backoff=0, max_backoff=0),
+                               retry=RetryPolicy(backoff=0, max_backoff=0))
+
+    def _stack(self):
+        web = cloud_models.SecurityGroup(name='web')
+        node = cloud_models.Node(name='web1', flavor='small', image='trusty', disk=10, networks=[])
+        node.security_groups = set([web])
+
+        collection = cloud_models.Collection()
+        collection.nodes.add(node)
+        collection.security_groups.add(web)
+        collection.security_group_rules.add(cloud_models.SecurityGroupRule(security_group=web, source_ip='0.0.0.0/0',
+                                                                           from_port=443, to_port=443, protocol='tcp'))
+        return collection
+
+    def test_apply_detect_clean(self):
+        cloud = SimulatedCloud(latency=0, page_size=1)
+        driver = self._driver(cloud)
+
+        driver.apply_resources(self._stack())
+        detected = driver.detect_resources()
+
+        self.assertEqual([node.name for node in detected.nodes], ['web1'])
+        self.assertEqual([sg.name for sg in detected.security_groups], ['web'])
+        self.assertEqual(len(detected.security_group_rules), 1)
+
+        driver.clean_resources(detected)
+
+        self.assertEqual(cloud.nodes, {})
+        self.assertEqual(cloud.security_groups, {})
+
+    def test_retries_throttles_and_failures(self):
+        cloud = SimulatedCloud(latency=0, throttle_rate=0.2, failure_rate=0.2, seed=3)
+        driver = self._driver(cloud)
+
+        driver.apply_resources(self._stack(), 'stack1')
+
+        self.assertEqual([node['name'] for node in cloud.nodes.values()], ['web1'])
+        self.assertGreater(cloud.throttled + cloud.failed, 0)
+
+
+class RunnerTests(unittest.TestCase):
+    def test_percentile(self):
+        self.assertIsNone(runner.percentile([], 0.5))
+        self.assertEqual(runner.percentile([3, 1, 2], 0.5), 2)
+        self.assertEqual(runner.percentile(range(1, 101), 0.99), 99)
+        self.assertEqual(runner.percentile([5], 0.99), 5)
+
+    def test_stack_data(self):
+        data = runner.stack_data(5)
+
+        self.assertEqual(data['nodes']['web']['count'] + data['nodes']['app']['count'], 5)
+        self.assertNotIn('app', runner.stack_data(1)['nodes'])
+
+    def test_main(self):
+        out = six.StringIO()
+
+        report = runner.main(['--scales', '1,4', '--repeat', '2', '--latency', '0', '--no-memory'], out=out)
+
+        self.assertEqual([result['nodes'] for result in report['results']], [1, 4])
+        apply = report['results'][1]['scenarios']['apply']
+        self.assertEqual(apply['runs'], 2)
+        self.assertEqual(apply['failed'], 0)
+        self.assertEqual(apply['operations']['create_nodes']['count'], 4)
+        self.assertEqual(report['results'][1]['scenarios']['clean']['operations']['delete_node']['count'], 8)
+        self.assertIn('4 nodes', out.getvalue())
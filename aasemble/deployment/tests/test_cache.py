@@ -0,0 +1,44 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from aasemble.deployment import cache
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        super(CacheTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(CacheTests, self).tearDown()
+
+    def test_cache_path_depends_on_parts(self):
+        path1 = cache.cache_path(self.tmpdir, 'catalog', 'AWSDriver', {'region': 'us-east-1'})
+        path2 = cache.cache_path(self.tmpdir, 'catalog', 'AWSDriver', {'region': 'us-west-1'})
+        self.assertNotEqual(path1, path2)
+        self.assertEqual(path1, cache.cache_path(self.tmpdir, 'catalog', 'AWSDriver', {'region': 'us-east-1'}))
+        self.assertTrue(os.path.basename(path1).startswith('catalog-'))
+
+    def test_save_and_load(self):
+        path = os.path.join(self.tmpdir, 'sub', 'foo.json')
+        cache.save(path, {'foo': ['bar']})
+        self.assertEqual(cache.load(path), {'foo': ['bar']})
+
+    def test_load_missing(self):
+        self.assertIsNone(cache.load(os.path.join(self.tmpdir, 'nonexistent.json')))
+
+    def test_remove(self):
+        path = os.path.join(self.tmpdir, 'foo.json')
+        cache.save(path, {})
+        cache.remove(path)
+        cache.remove(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_is_fresh(self):
+        self.assertTrue(cache.is_fresh(100, 60, now=130))
+        self.assertFalse(cache.is_fresh(100, 60, now=170))
+        self.assertFalse(cache.is_fresh(100, 0, now=130))
+        self.assertFalse(cache.is_fresh(None, 60, now=130))
@@ -1,11 +1,19 @@
+import json
+import os.path
+import shutil
+import tempfile
 import unittest
 
 import mock
 
+import six
+
 import aasemble.client
 import aasemble.deployment.cli
 import aasemble.deployment.cloud.base
 import aasemble.deployment.cloud.models as cloud_models
+import aasemble.deployment.cloud.plan as cloud_plan
+import aasemble.deployment.exceptions
 
 
 class CliTestCase(unittest.TestCase):
@@ -14,27 +22,33 @@ class CliTestCase(unittest.TestCase):
             aasemble.deployment.cli.main(args=[])
         self.assertEqual(exit.exception.code, 2)
 
+    @mock.patch('aasemble.deployment.cli.get_apply_record')
     @mock.patch('aasemble.deployment.cli.load_cloud_config')
     @mock.patch('aasemble.deployment.cli.loader')
     @mock.patch('aasemble.deployment.cli.handle_cluster_opts')
     @mock.patch('aasemble.client')
-    def _test_apply(self, assume_empty, client, handle_cluster_opts, loader, load_cloud_config):
+    def _test_apply(self, assume_empty, client, handle_cluster_opts, loader, load_cloud_config, get_apply_record, targeted=False):
         client.AasembleClient.side_effect = Exception('should not invoke the aaSemble client')
 
         options = mock.MagicMock()
         options.assume_empty = assume_empty
+        options.targeted = targeted
         options.new_cluster = False
         options.cluster = False
         options.threads = 1
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 0
         options.json = False
 
         resources = loader.load.return_value
 
         with mock.patch.multiple('aasemble.deployment.cloud.base.CloudDriver',
                                  detect_resources=mock.DEFAULT,
-                                 apply_resources=mock.DEFAULT) as values:
+                                 plan=mock.DEFAULT,
+                                 apply_plan=mock.DEFAULT) as values:
             detect_resources = values['detect_resources']
-            apply_resources = values['apply_resources']
+            plan = values['plan']
+            plan.return_value = cloud_plan.Plan(resources)
 
             load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
 
@@ -44,12 +58,15 @@ class CliTestCase(unittest.TestCase):
 
         if assume_empty:
             detect_resources.assert_not_called()
-            expected_resources = resources
+            self.assertEqual(plan.call_args[0][1].nodes, cloud_models.NamedSet())
+        elif targeted:
+            detect_resources.assert_called_with(desired=resources)
+            plan.assert_called_with(resources, detect_resources.return_value, prune=options.prune)
         else:
             detect_resources.assert_called_with()
-            expected_resources = resources - detect_resources.return_value
+            plan.assert_called_with(resources, detect_resources.return_value, prune=options.prune)
 
-        apply_resources.assert_called_with(expected_resources)
+        values['apply_plan'].assert_called_with(plan.return_value, mock.ANY)
         handle_cluster_opts.assert_called_with(options, {})
 
     def test_apply_no_assume_empty(self):
@@ -58,10 +75,260 @@ class CliTestCase(unittest.TestCase):
     def test_apply_assume_empty(self):
         self._test_apply(True)
 
+    def test_apply_targeted(self):
+        self._test_apply(False, targeted=True)
+
+    def _apply_options(self, cache_dir):
+        options = mock.MagicMock()
+        options.assume_empty = False
+        options.targeted = False
+        options.refresh = False
+        options.prune = False
+        options.replace = False
+        options.new_cluster = False
+        options.cluster = False
+        options.threads = 1
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 0
+        options.compact = False
+        options.metrics = None
+        options.profiler = None
+        options.cache_dir = cache_dir
+        options.cloud = 'default'
+        options.namespace = 'testns'
+        return options
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.loader')
+    def test_apply_skips_unchanged_stack(self, loader, load_cloud_config):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        options = self._apply_options(cache_dir)
+
+        class TestDriver(aasemble.deployment.cloud.base.CloudDriver):
+            def create_node(selff, node):
+                node.private = mock.Mock(id='i-1', public_ips=['10.0.0.1'])
+
+            def update_cluster(selff, collection):
+                pass
+
+        load_cloud_config.return_value = (TestDriver, {}, {})
+
+        def load(stack, substitutions):
+            collection = cloud_models.Collection()
+            collection.nodes.add(cloud_models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+            return collection
+        loader.load.side_effect = load
+
+        with mock.patch.multiple(TestDriver,
+                                 detect_resources=mock.DEFAULT,
+                                 live_node_ids=mock.DEFAULT) as values:
+            values['detect_resources'].return_value = cloud_models.Collection()
+            values['live_node_ids'].return_value = set(['i-1'])
+
+            aasemble.deployment.cli.apply(options)
+            self.assertEqual(len(values['detect_resources'].call_args_list), 1)
+
+            aasemble.deployment.cli.apply(options)
+            self.assertEqual(len(values['detect_resources'].call_args_list), 1)
+            values['live_node_ids'].assert_called_with(set(['node1']))
+
+            values['live_node_ids'].return_value = set()
+            aasemble.deployment.cli.apply(options)
+            self.assertEqual(len(values['detect_resources'].call_args_list), 2)
+
+    def _test_apply_replacement(self, replace, loader, load_cloud_config):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        options = self._apply_options(cache_dir)
+        options.replace = replace
+        self.events = []
+
+        class TestDriver(aasemble.deployment.cloud.base.CloudDriver):
+            def create_node(selff, node):
+                self.events.append(('create', node.name))
+                node.private = mock.Mock(id='i-2', public_ips=['10.0.0.2'])
+
+            def delete_node(selff, node):
+                self.events.append(('delete', node.name))
+
+            def update_cluster(selff, collection):
+                pass
+
+        load_cloud_config.return_value = (TestDriver, {}, {})
+
+        def load(stack, substitutions):
+            collection = cloud_models.Collection()
+            collection.nodes.add(cloud_models.Node(name='node1', flavor='large', image='trusty', networks=[], disk=10))
+            return collection
+        loader.load.side_effect = load
+
+        current = cloud_models.Collection()
+        current.nodes.add(cloud_models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10,
+                                            private=mock.Mock(id='i-1')))
+
+        with mock.patch.multiple(TestDriver, detect_resources=mock.DEFAULT) as values:
+            values['detect_resources'].return_value = current
+            aasemble.deployment.cli.apply(options)
+
+        return aasemble.deployment.cli.get_apply_record(options)
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.loader')
+    def test_apply_skips_replacements(self, loader, load_cloud_config):
+        record = self._test_apply_replacement(False, loader, load_cloud_config)
+
+        self.assertEqual(self.events, [])
+        # Still not what the stack asks for, so the next apply looks again.
+        self.assertFalse(os.path.exists(record.path))
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.loader')
+    def test_apply_replaces_when_asked(self, loader, load_cloud_config):
+        self._test_apply_replacement(True, loader, load_cloud_config)
+
+        self.assertEqual(self.events, [('delete', 'node1'), ('create', 'node1')])
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.loader')
+    def test_apply_prunes_from_live_detection(self, loader, load_cloud_config):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        options = self._apply_options(cache_dir)
+        options.snapshot_ttl = 300
+        options.prune = True
+        deleted = []
+
+        class TestDriver(aasemble.deployment.cloud.base.CloudDriver):
+            def delete_security_group_rule(selff, security_group_rule):
+                deleted.append(security_group_rule.private)
+
+            def update_cluster(selff, collection):
+                pass
+
+        load_cloud_config.return_value = (TestDriver, {}, {})
+
+        web = cloud_models.SecurityGroup(name='web')
+        rule = cloud_models.SecurityGroupRule(security_group=web, source_ip='0.0.0.0/0', from_port=22, to_port=22, protocol='tcp')
+
+        def load(stack, substitutions):
+            collection = cloud_models.Collection()
+            collection.security_groups.add(cloud_models.SecurityGroup(name='web'))
+            return collection
+        loader.load.side_effect = load
+
+        live = cloud_models.Collection()
+        live.security_groups.add(web)
+        rule.private = mock.sentinel.firewall
+        live.security_group_rules.add(rule)
+        _, snapshot = aasemble.deployment.cli.get_cloud_driver(options)
+        snapshot.save(live)
+
+        with mock.patch.multiple(TestDriver, detect_resources=mock.DEFAULT) as values:
+            values['detect_resources'].return_value = live
+            aasemble.deployment.cli.apply(options)
+
+        # The snapshot had the rule but not its firewall.
+        self.assertEqual(len(values['detect_resources'].call_args_list), 1)
+        self.assertEqual(deleted, [mock.sentinel.firewall])
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.loader')
+    def test_apply_refreshes_created_nodes_for_snapshot(self, loader, load_cloud_config):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        options = self._apply_options(cache_dir)
+        options.snapshot_ttl = 300
+
+        class TestDriver(aasemble.deployment.cloud.base.CloudDriver):
+            def create_node(selff, node):
+                node.private = mock.Mock(id='i-1', public_ips=[])
+
+            def update_cluster(selff, collection):
+                pass
+
+        load_cloud_config.return_value = (TestDriver, {}, {})
+
+        def load(stack, substitutions):
+            collection = cloud_models.Collection()
+            collection.nodes.add(cloud_models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10))
+            return collection
+        loader.load.side_effect = load
+
+        def detected(public_ips):
+            node = cloud_models.Node(name='node1', flavor='small', image='trusty', networks=[], disk=10)
+            node.private = cloud_models.NodeRecord(id='i-1', public_ips=public_ips)
+            return set([node])
+
+        with mock.patch.multiple(TestDriver,
+                                 detect_resources=mock.DEFAULT,
+                                 detect_nodes=mock.DEFAULT) as values:
+            values['detect_resources'].return_value = cloud_models.Collection()
+
+            # Still no address, so there's no snapshot to trust.
+            values['detect_nodes'].return_value = detected([])
+            options.refresh = True
+            aasemble.deployment.cli.apply(options)
+            values['detect_nodes'].assert_called_with(set(['node1']))
+            _, snapshot = aasemble.deployment.cli.get_cloud_driver(options)
+            self.assertIsNone(snapshot.load())
+
+            values['detect_nodes'].return_value = detected(['10.0.0.1'])
+            aasemble.deployment.cli.apply(options)
+            self.assertEqual(snapshot.load().nodes['node1'].private.public_ips, ['10.0.0.1'])
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    def test_get_cloud_driver_profiles_backoff(self, load_cloud_config):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        options = self._apply_options(cache_dir)
+        options.profiler = mock.MagicMock()
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+
+        cloud_driver, _ = aasemble.deployment.cli.get_cloud_driver(options)
+
+        self.assertIs(cloud_driver.retry.sleep, options.profiler.backoff)
+        self.assertIs(cloud_driver.limiter.sleep, options.profiler.backoff)
+
+    def test_unchanged_since_last_apply_without_record(self):
+        record = mock.MagicMock()
+        record.load.return_value = None
+        cloud_driver = mock.MagicMock()
+
+        self.assertFalse(aasemble.deployment.cli.unchanged_since_last_apply(cloud_driver, record, 'fp'))
+        record.load.assert_called_with('fp')
+        cloud_driver.live_node_ids.assert_not_called()
+
+    def test_unchanged_since_last_apply_probes_security_groups(self):
+        record = mock.MagicMock()
+        record.load.return_value = {'nodes': {}, 'security_groups': ['web']}
+        cloud_driver = mock.MagicMock()
+        cloud_driver.live_node_ids.return_value = set()
+
+        cloud_driver.live_security_group_names.return_value = set()
+        self.assertFalse(aasemble.deployment.cli.unchanged_since_last_apply(cloud_driver, record, 'fp'))
+        cloud_driver.live_security_group_names.assert_called_with(set(['web']))
+
+        cloud_driver.live_security_group_names.return_value = set(['web'])
+        self.assertTrue(aasemble.deployment.cli.unchanged_since_last_apply(cloud_driver, record, 'fp'))
+
+    def test_detect_resources_targeted_skips_snapshot_save(self):
+        cloud_driver = mock.MagicMock()
+        snapshot = mock.MagicMock()
+        snapshot.load.return_value = None
+
+        result = aasemble.deployment.cli.detect_resources(cloud_driver, snapshot, desired=mock.sentinel.desired)
+
+        self.assertEqual(result, cloud_driver.detect_resources.return_value)
+        cloud_driver.detect_resources.assert_called_with(desired=mock.sentinel.desired)
+        snapshot.save.assert_not_called()
+
     @mock.patch('aasemble.deployment.cli.load_cloud_config')
     def test_detect(self, load_cloud_config):
         options = mock.MagicMock()
         options.threads = 1
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 0
         options.json = False
         with mock.patch('aasemble.deployment.cloud.base.CloudDriver.detect_resources') as detect_resources:
             load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
@@ -75,6 +342,8 @@ class CliTestCase(unittest.TestCase):
     def test_clean(self, format_collection, load_cloud_config):
         options = mock.MagicMock()
         options.threads = 1
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 0
         options.json = False
         with mock.patch.multiple('aasemble.deployment.cloud.base.CloudDriver',
                                  clean_resources=mock.DEFAULT,
@@ -87,6 +356,23 @@ class CliTestCase(unittest.TestCase):
         values['detect_resources'].assert_called_with()
         values['clean_resources'].assert_called_with(mock.sentinel.resources)
 
+    @mock.patch('aasemble.deployment.cli.get_apply_record')
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    def test_clean_invalidates_apply_record(self, load_cloud_config, get_apply_record):
+        options = mock.MagicMock()
+        options.threads = 1
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 0
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+
+        with mock.patch.multiple('aasemble.deployment.cloud.base.CloudDriver',
+                                 clean_resources=mock.DEFAULT,
+                                 detect_resources=mock.DEFAULT):
+            aasemble.deployment.cli.clean(options)
+
+        get_apply_record.assert_called_with(options)
+        get_apply_record.return_value.invalidate.assert_called_with()
+
     @mock.patch('aasemble.deployment.cli.detect')
     def test_main_calls_detect(self, detect):
         aasemble.deployment.cli.main(['detect'])
@@ -94,6 +380,193 @@ class CliTestCase(unittest.TestCase):
         options = detect.call_args_list[0][0][0]
         self.assertEqual(options.cloud, 'default')
 
+    @mock.patch('aasemble.deployment.cli.detect')
+    def test_main_reports_failures(self, detect):
+        detect.side_effect = aasemble.deployment.exceptions.ResourcesFailedException([(('node', 'web1'), ValueError('boom'))])
+
+        with self.assertRaises(SystemExit) as exit:
+            aasemble.deployment.cli.main(['detect'])
+
+        self.assertEqual(exit.exception.code, 1)
+
+    @mock.patch('aasemble.deployment.cli.detect')
+    def test_main_writes_metrics(self, detect):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'metrics.prom')
+
+        def detect_side_effect(options):
+            with options.metrics.operation('detect_nodes'):
+                options.metrics.observe('Amazon EC2', 'DescribeInstances', 0.2)
+            raise aasemble.deployment.exceptions.ResourcesFailedException([(('node', 'web1'), ValueError('boom'))])
+
+        detect.side_effect = detect_side_effect
+
+        with self.assertRaises(SystemExit):
+            aasemble.deployment.cli.main(['--metrics-file', path, '--metrics-format', 'prometheus', 'detect'])
+
+        with open(path) as fp:
+            self.assertIn('aasemble_api_calls_total{call="DescribeInstances",operation="detect_nodes",provider="Amazon EC2"} 1\n',
+                          fp.read())
+
+    @mock.patch('aasemble.deployment.cli.detect')
+    def test_main_profiles(self, detect):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        aasemble.deployment.cli.main(['--profile', tmpdir, 'detect'])
+
+        self.assertIsNotNone(detect.call_args[0][0].profiler)
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'main.prof')))
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'summary.json')))
+
+    @mock.patch('aasemble.deployment.cli.detect')
+    def test_main_without_metrics(self, detect):
+        aasemble.deployment.cli.main(['detect'])
+        self.assertIsNone(detect.call_args[0][0].metrics)
+        self.assertIsNone(detect.call_args[0][0].profiler)
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    def test_detect_uses_catalog_settings(self, load_cloud_config):
+        options = mock.MagicMock()
+        options.threads = 1
+        options.json = False
+        options.cache_dir = '/some/cache/dir'
+        options.catalog_ttl = 3600
+        options.snapshot_ttl = 0
+        options.metrics = None
+        options.profiler = None
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+
+        with mock.patch('aasemble.deployment.cloud.base.CloudDriver.detect_resources'):
+            with mock.patch('aasemble.deployment.cli.Catalog') as Catalog:
+                aasemble.deployment.cli.detect(options)
+
+        Catalog.assert_called_with(path=mock.ANY, ttl=3600)
+        self.assertTrue(Catalog.call_args[1]['path'].startswith('/some/cache/dir/catalog-'))
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.Snapshot')
+    def test_detect_uses_snapshot(self, Snapshot, load_cloud_config):
+        options = mock.MagicMock()
+        options.threads = 1
+        options.json = False
+        options.refresh = False
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 300
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+        Snapshot.return_value.load.return_value = cloud_models.Collection()
+
+        with mock.patch('aasemble.deployment.cloud.base.CloudDriver.detect_resources') as detect_resources:
+            aasemble.deployment.cli.detect(options)
+
+        detect_resources.assert_not_called()
+        Snapshot.return_value.save.assert_not_called()
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.Snapshot')
+    def test_detect_refresh_ignores_snapshot(self, Snapshot, load_cloud_config):
+        options = mock.MagicMock()
+        options.threads = 1
+        options.json = False
+        options.refresh = True
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 300
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+
+        with mock.patch('aasemble.deployment.cloud.base.CloudDriver.detect_resources') as detect_resources:
+            aasemble.deployment.cli.detect(options)
+
+        Snapshot.return_value.load.assert_not_called()
+        detect_resources.assert_called_with()
+        Snapshot.return_value.save.assert_called_with(detect_resources.return_value)
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.Snapshot')
+    def test_clean_invalidates_snapshot(self, Snapshot, load_cloud_config):
+        options = mock.MagicMock()
+        options.threads = 1
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 300
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+
+        with mock.patch.multiple('aasemble.deployment.cloud.base.CloudDriver',
+                                 clean_resources=mock.DEFAULT,
+                                 detect_resources=mock.DEFAULT):
+            aasemble.deployment.cli.clean(options)
+
+        Snapshot.return_value.load.assert_not_called()
+        Snapshot.return_value.invalidate.assert_called_with()
+
+    def test_stream_json(self):
+        sg = cloud_models.SecurityGroup(name='webapp')
+        sgr = cloud_models.SecurityGroupRule(security_group=sg, source_ip='0.0.0.0/0', from_port=443, to_port=443, protocol='tcp')
+
+        class ProviderNode(object):
+            public_ips = ['10.0.0.1']
+
+        class TestDriver(aasemble.deployment.cloud.base.CloudDriver):
+            def iter_nodes(selff):
+                for name in ('web1', 'web2'):
+                    node = cloud_models.Node(name=name, flavor='small', image='trusty', networks=[], disk=10, private=ProviderNode())
+                    node.security_group_names = set(['webapp', 'other'])
+                    yield node
+
+            def detect_firewalls(selff):
+                return set([sg]), set([sgr])
+
+        out = six.StringIO()
+        cloud_driver = TestDriver()
+        aasemble.deployment.cli.stream_json(cloud_driver, out)
+
+        # Firewalls are fetched on the driver's pool, not an executor.
+        self.assertIsNone(cloud_driver._executor)
+
+        # Under asyncio they're fetched on the executor, so --threads applies.
+        asyncio_out = six.StringIO()
+        asyncio_driver = TestDriver(engine='asyncio')
+        aasemble.deployment.cli.stream_json(asyncio_driver, asyncio_out)
+        self.assertIsNone(asyncio_driver._pool)
+        self.assertEqual(asyncio_out.getvalue(), out.getvalue())
+
+        collection = cloud_models.Collection()
+        collection.nodes.add(cloud_models.Node(name='web1', flavor='small', image='trusty', networks=[], disk=10,
+                                               security_groups=set([sg]), private=ProviderNode()))
+        collection.nodes.add(cloud_models.Node(name='web2', flavor='small', image='trusty', networks=[], disk=10,
+                                               security_groups=set([sg]), private=ProviderNode()))
+        collection.security_groups.add(sg)
+        collection.security_group_rules.add(sgr)
+        self.assertEqual(out.getvalue(), json.dumps(collection.as_dict()) + '\n')
+
+    def test_stream_json_without_nodes(self):
+        class TestDriver(aasemble.deployment.cloud.base.CloudDriver):
+            def iter_nodes(selff):
+                return iter([])
+
+            def detect_firewalls(selff):
+                return set(), set()
+
+        out = six.StringIO()
+        aasemble.deployment.cli.stream_json(TestDriver(), out)
+
+        self.assertEqual(json.loads(out.getvalue()), cloud_models.Collection().as_dict())
+
+    @mock.patch('aasemble.deployment.cli.load_cloud_config')
+    @mock.patch('aasemble.deployment.cli.stream_json')
+    def test_detect_json_streams_without_snapshot(self, stream_json, load_cloud_config):
+        options = mock.MagicMock()
+        options.threads = 1
+        options.json = True
+        options.catalog_ttl = 0
+        options.snapshot_ttl = 0
+        load_cloud_config.return_value = (aasemble.deployment.cloud.base.CloudDriver, {}, {})
+
+        with mock.patch('aasemble.deployment.cloud.base.CloudDriver.detect_resources') as detect_resources:
+            aasemble.deployment.cli.detect(options)
+
+        detect_resources.assert_not_called()
+        self.assertEqual(len(stream_json.call_args_list), 1)
+
     def test_extract_substitutions(self):
         extract_substitutions = aasemble.deployment.cli.extract_substitutions
         self.assertEqual(extract_substitutions([]), {})
@@ -102,6 +575,30 @@ class CliTestCase(unittest.TestCase):
         self.assertEqual(extract_substitutions(['foo=bar', 'bar=baz']), {'foo': 'bar', 'bar': 'baz'})
         self.assertEqual(extract_substitutions(['foo=bar', 'foo=baz']), {'foo': 'baz'})
 
+    def test_extract_operation_limits(self):
+        extract_operation_limits = aasemble.deployment.cli.extract_operation_limits
+        self.assertEqual(extract_operation_limits([]), {})
+        self.assertEqual(extract_operation_limits(['create_node=20', 'delete_node=5']),
+                         {'create_node': 20, 'delete_node': 5})
+
+    @unittest.skipIf(six.PY2, 'The asyncio engine needs Python 3')
+    @mock.patch('aasemble.deployment.cli.detect')
+    def test_main_asyncio_engine(self, detect):
+        aasemble.deployment.cli.main(['--engine', 'asyncio', '--operation-limit', 'create_node=20', 'detect'])
+        options = detect.call_args_list[0][0][0]
+        self.assertEqual(options.engine, 'asyncio')
+        kwargs = aasemble.deployment.cli.get_engine_kwargs(options)
+        self.assertEqual(kwargs['operation_limits'], {'create_node': 20})
+        self.assertNotIn('pool', kwargs)
+
+    @mock.patch('aasemble.deployment.cli.detect')
+    def test_main_threads_engine(self, detect):
+        aasemble.deployment.cli.main(['--threads', '3', 'detect'])
+        kwargs = aasemble.deployment.cli.get_engine_kwargs(detect.call_args_list[0][0][0])
+        self.assertEqual(list(kwargs), ['pool'])
+        self.assertEqual(kwargs['pool']._processes, 3)
+        kwargs['pool'].close()
+
     def test_format_collection(self):
         collection = cloud_models.Collection()
 
@@ -0,0 +1,99 @@
+import json
+import os.path
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from aasemble.deployment import profiling
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), 'profile')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.directory))
+
+    def _profile(self):
+        profiler = profiling.Profiler(self.directory)
+        driver = profiler.instrument(mock.Mock(connection=mock.Mock(request=lambda action: time.sleep(0.05))))
+
+        def worker():
+            with profiler.task('create_node'):
+                driver.connection.request('/nodes')
+                profiler.record('limiter', 0.5)
+                profiler.backoff(0.02)
+            with profiler.task('create_node'):
+                busy(10000)
+
+        profiler.start()
+        try:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+            data = [str(i) for i in range(1000)]
+        finally:
+            profiler.stop()
+        self.assertEqual(len(data), 1000)
+        return profiler
+
+    def test_summary(self):
+        profiler = self._profile()
+        summary = profiler.summary()
+
+        self.assertGreaterEqual(summary['wall'], 0.05)
+        self.assertIsNotNone(summary['cpu'])
+        self.assertGreater(summary['peak_memory'], 0)
+        create_node = summary['tasks']['create_node']
+        self.assertEqual(create_node['count'], 2)
+        self.assertGreaterEqual(create_node['wall'], 0.07)
+        self.assertGreaterEqual(create_node['wait'], 0.05)
+        self.assertLess(create_node['wait'], 0.07)
+        self.assertEqual(create_node['limiter'], 0.5)
+        self.assertGreaterEqual(create_node['backoff'], 0.02)
+        if profiling.thread_time is not None:
+            self.assertLess(create_node['cpu'], create_node['wall'])
+
+    def test_record_outside_tasks(self):
+        profiler = profiling.Profiler(self.directory)
+
+        profiler.record('wait', 1.0)
+        with profiler.task('detect_nodes'):
+            with profiler.task('list_disks'):
+                profiler.record('wait', 2.0)
+            profiler.record('wait', 3.0)
+
+        tasks = profiler.summary()['tasks']
+        self.assertEqual(tasks['list_disks']['wait'], 2.0)
+        self.assertEqual(tasks['detect_nodes']['wait'], 3.0)
+
+    def test_write(self):
+        profiler = self._profile()
+        profiler.write()
+
+        self.assertTrue(pstats.Stats(os.path.join(self.directory, 'main.prof')).total_calls > 0)
+        if profiler.workers:
+            worker_functions = [func[2] for func in pstats.Stats(os.path.join(self.directory, 'workers.prof')).stats]
+            self.assertIn('busy', worker_functions)
+        with open(os.path.join(self.directory, 'allocations.txt')) as fp:
+            self.assertTrue(fp.readline().startswith('Peak traced memory: '))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'allocations.tracemalloc')))
+        with open(os.path.join(self.directory, 'summary.json')) as fp:
+            self.assertEqual(json.load(fp)['tasks']['create_node']['count'], 2)
+
+    def test_stops_profiling_new_threads(self):
+        profiler = self._profile()
+        workers = len(profiler.workers)
+
+        thread = threading.Thread(target=busy, args=(10,))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(len(profiler.workers), workers)
@@ -0,0 +1,133 @@
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import aasemble.deployment.cloud.models as cloud_models
+import aasemble.deployment.cloud.plan as plan
+from aasemble.deployment import cache, snapshot
+
+
+class ProviderNode(object):
+    def __init__(self, id, public_ips):
+        self.id = id
+        self.public_ips = public_ips
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'snapshot.json')
+
+        self.collection = cloud_models.Collection()
+        sg = cloud_models.SecurityGroup(name='webapp')
+        node = cloud_models.Node(name='webapp1', flavor='small', image='trusty', disk=10, networks=[],
+                                 script='#!/bin/sh\n', private=ProviderNode('i-1234', ['10.0.0.1']))
+        node.security_group_names = set(['webapp'])
+        self.collection.nodes.add(node)
+        self.collection.security_groups.add(sg)
+        self.collection.security_group_rules.add(cloud_models.SecurityGroupRule(security_group=sg, source_ip='0.0.0.0/0',
+                                                                                from_port=0, to_port=65535, protocol='tcp'))
+        self.collection.security_group_rules.add(cloud_models.SecurityGroupRule(security_group=sg, source_group='webapp',
+                                                                                from_port=22, to_port=22, protocol='tcp'))
+        self.collection.connect()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(SnapshotTests, self).tearDown()
+
+    def test_round_trip(self):
+        restored = snapshot.restore(snapshot.dump(self.collection))
+
+        self.assertEqual(restored.nodes, self.collection.nodes)
+        self.assertEqual(restored.security_groups, self.collection.security_groups)
+        self.assertEqual(restored.security_group_rules, self.collection.security_group_rules)
+        self.assertEqual(restored.nodes['webapp1'].private.id, 'i-1234')
+        self.assertEqual(restored.nodes['webapp1'].private.public_ips, ['10.0.0.1'])
+
+        difference = self.collection - restored
+        self.assertEqual(difference.nodes, set())
+        self.assertEqual(difference.security_group_rules, set())
+
+    def test_disabled_without_ttl(self):
+        s = snapshot.Snapshot(self.path)
+        s.save(self.collection)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(s.load())
+
+    def test_save_and_load(self):
+        s = snapshot.Snapshot(self.path, ttl=60)
+        s.save(self.collection)
+        self.assertEqual(s.load().nodes, self.collection.nodes)
+
+    def test_expired(self):
+        data = snapshot.dump(self.collection)
+        data['created_at'] = time.time() - 120
+        cache.save(self.path, data)
+        self.assertIsNone(snapshot.Snapshot(self.path, ttl=60).load())
+
+    def test_invalidate(self):
+        s = snapshot.Snapshot(self.path, ttl=60)
+        s.save(self.collection)
+        s.invalidate()
+        self.assertIsNone(s.load())
+
+    def test_merge(self):
+        applied = cloud_models.Collection()
+        applied.nodes.add(cloud_models.Node(name='webapp2', flavor='small', image='trusty', disk=10, networks=[]))
+
+        merged = snapshot.merge(self.collection, applied)
+
+        self.assertEqual(set(merged.nodes.keys()), set(['webapp1', 'webapp2']))
+        self.assertEqual(merged.security_group_rules, self.collection.security_group_rules)
+
+    def test_fingerprint_ignores_ordering(self):
+        reloaded = snapshot.restore(snapshot.dump(self.collection))
+        self.assertEqual(snapshot.fingerprint(reloaded, 'mappings'), snapshot.fingerprint(self.collection, 'mappings'))
+
+    def test_fingerprint_ignores_provider_details(self):
+        before = snapshot.fingerprint(self.collection)
+        self.collection.nodes['webapp1'].private = None
+        self.assertEqual(snapshot.fingerprint(self.collection), before)
+
+    def test_fingerprint_changes(self):
+        before = snapshot.fingerprint(self.collection, 'mappings')
+
+        self.assertNotEqual(snapshot.fingerprint(self.collection, 'other mappings'), before)
+
+        self.collection.nodes['webapp1'].disk = 20
+        self.assertNotEqual(snapshot.fingerprint(self.collection, 'mappings'), before)
+
+    def test_fingerprint_covers_urls(self):
+        before = snapshot.fingerprint(self.collection)
+        self.collection.urls.append(cloud_models.URLConfStatic(hostname='example.com', path='/', local_path='/srv'))
+        self.assertNotEqual(snapshot.fingerprint(self.collection), before)
+
+
+class ApplyRecordTests(unittest.TestCase):
+    def setUp(self):
+        super(ApplyRecordTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.record = snapshot.ApplyRecord(os.path.join(self.tmpdir, 'applied.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ApplyRecordTests, self).tearDown()
+
+    def test_load_missing(self):
+        self.assertIsNone(self.record.load('fp'))
+
+    def test_save_and_load(self):
+        self.record.save('fp', plan.Plan(cloud_models.Collection()), {'webapp1': 'i-1234'}, ['web', 'db'])
+
+        applied = self.record.load('fp')
+        self.assertEqual(applied['nodes'], {'webapp1': 'i-1234'})
+        self.assertEqual(applied['security_groups'], ['db', 'web'])
+        self.assertIsNone(self.record.load('other'))
+
+    def test_invalidate(self):
+        self.record.save('fp', plan.Plan(cloud_models.Collection()), {})
+        self.record.invalidate()
+        self.assertIsNone(self.record.load('fp'))